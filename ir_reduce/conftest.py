@@ -1,5 +1,7 @@
 import pytest
 
+from ir_reduce import Pool, PoolDummy
+
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -21,3 +23,13 @@ def pytest_collection_modifyitems(config, items):
     for item in items:
         if "integration" in item.keywords:
             item.add_marker(skip_int)
+
+
+@pytest.fixture(params=['dummy', 'pool'])
+def pool(request):
+    """every test using it runs in this process and with a process pool, which is closed afterwards"""
+    if request.param == 'dummy':
+        yield PoolDummy()
+    else:
+        with Pool(2) as pool:
+            yield pool
@@ -1,10 +1,67 @@
 # flake8: noqa
-from .main import *
-from .run_sextractor_scamp import *
-from .transient_detection import *
-from .cli import cli_main
-from . import classifier_common
-from . import notcam_classifier
-from . import alfosc_classifier
-from . import image_type_classifier
-# from . import
+"""
+The package namespace is filled lazily: ``ir_reduce.reduce_image``, ``ir_reduce.run_astroref`` etc. are the same
+names as before, but the modules behind them (and astropy, ccdproc, scipy, matplotlib, ...) are only imported on
+first access. This keeps the startup of the command line interface and of server clients short.
+"""
+import importlib.util
+import sys
+import types
+
+# names that are not found in the star-exporting modules below
+_explicit = {'cli_main': 'cli',
+             'find_jobs': 'batch',
+             'run_batch': 'batch'}
+# submodules that were always imported with the package, all others are imported on access too
+_submodules = ('classifier_common', 'notcam_classifier', 'alfosc_classifier', 'image_type_classifier')
+# modules whose public names are available on the package, looked up in this order
+_star_modules = ('main', 'run_sextractor_scamp', 'transient_detection')
+
+
+def _import(module_name: str) -> types.ModuleType:
+    # the import statement machinery instead of importlib.import_module, only that shows up in python -X importtime
+    __import__(f'{__name__}.{module_name}')
+    return sys.modules[f'{__name__}.{module_name}']
+
+
+def _public(module: types.ModuleType) -> dict:
+    return {name: value for name, value in vars(module).items() if not name.startswith('_')}
+
+
+class _LazyPackage(types.ModuleType):
+    """
+    resolves missing attributes of the package by importing the module that defines them
+    (a module level __getattr__ would do, but needs python 3.7)
+    """
+
+    def __getattr__(self, name: str):
+        if name == '__all__':
+            names = set(_explicit) | set(_submodules)
+            for module_name in _star_modules:
+                names |= set(_public(_import(module_name)))
+            return sorted(names)
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        if name in _submodules:
+            value = _import(name)
+        elif name in _explicit:
+            value = getattr(_import(_explicit[name]), name)
+        else:
+            for module_name in _star_modules:
+                module = _import(module_name)
+                if not name.startswith('_') and name in vars(module):
+                    value = vars(module)[name]
+                    break
+            else:
+                if importlib.util.find_spec(f'{__name__}.{name}') is None:
+                    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+                value = _import(name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(self.__all__))
+
+
+sys.modules[__name__].__class__ = _LazyPackage
@@ -0,0 +1,42 @@
+"""
+Parameters of SourceExtractor and scamp. Kept apart from run_sextractor_scamp so the command line interface can
+build its defaults without importing astropy
+"""
+import os
+
+this_dir, this_file = os.path.split(__file__)
+# RAM backed file system for the images handed to SExtractor, they are read once and deleted right after
+shm_dir = '/dev/shm'
+
+
+class Config:
+    """
+    a helper class to bundle parameters for scamp/sextractor
+
+    TODO: maybe allow to override parameters from the config files here with an "additional params"-entry
+    and pass them like "sex -MYPARAM MYVAL"
+    """
+
+    def __init__(self):
+        self.sextractor_param = os.path.join(this_dir, 'default.param')
+        self.sextractor_config = os.path.join(this_dir, 'sex.config')
+        self.sextractor_neural = os.path.join(this_dir, 'default.nnw')
+        self.scamp_config = os.path.join(this_dir, 'scamp.config')
+        self.working_dir = ''
+        self.sextractor_outfile = 'sexout.fits'
+        self.sex_cmd = 'sex'
+        self.scamp_cmd = 'scamp'
+        self.sextractor_conv = 'default.conv'
+
+        self.sextractor_overrides = ['']
+        self.scamp_overrides = ['']
+        # directory of a local RefcatStore, scamp uses cutouts of it instead of querying the catalog server
+        self.refcat_store = ''
+        # extract sources in process with source_extraction instead of running sex, scamp still runs
+        self.native_extractor = False
+        # in-memory images are written here for SExtractor, falls back to the working directory (where they are kept)
+        self.input_dir = shm_dir if os.access(shm_dir, os.W_OK) else ''
+
+    @staticmethod
+    def default():
+        return Config()
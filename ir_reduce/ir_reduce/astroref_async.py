@@ -0,0 +1,151 @@
+"""
+asyncio runner for SExtractor and scamp. The output of the tools goes to the log line by line while they run, the
+timeouts grow with the image size, and astroreferencing many images is pipelined: SExtractor works on the next image
+while scamp solves the previous one, so the wall clock time approaches that of the slowest stage instead of the sum.
+astroref_pipeline is the coroutine, run_astroref_pipelined the blocking wrapper
+"""
+import asyncio
+import collections
+import logging
+import os
+import subprocess as sp
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Deque, Iterable, List, Sequence, Tuple, Union
+
+from astropy.nddata.ccddata import CCDData
+
+from .astromatic_config import Config
+from .run_sextractor_scamp import image_pixels, is_config_valid, isolated_config, local_refcat, native_extraction, \
+    output_lines, prepare_working_dir, read_astroref_results, read_reference_catalog, scamp_args, sextractor_args, \
+    sextractor_input, tool_timeout
+
+# lines of tool output kept for the message of a failed run
+kept_output_lines = 50
+
+
+def _log_lines(stream: IO[bytes], name: str, kept: Deque[str]) -> None:
+    for line in iter(stream.readline, b''):
+        for part in output_lines(line.decode(errors='replace')):
+            logging.info(f'{name}: {part}')
+            kept.append(part)
+
+
+async def run_tool(args: Sequence[str], working_dir: str, timeout: float) -> None:
+    """
+    run a tool, its stdout and stderr are logged while it runs. It is killed on timeout or when the calling task is
+    cancelled.
+    The process is waited for and read in threads of its own instead of with asyncio subprocesses: those need a child
+    watcher attached to the loop before python 3.8, which is only possible in the main thread
+    :raises subprocess.TimeoutExpired: if it takes longer than timeout seconds
+    :raises RuntimeError: if it fails
+    """
+    name = os.path.basename(args[0])
+    logging.info(f'running {list(args)} in {working_dir}')
+    loop = asyncio.get_event_loop()
+    output = collections.deque(maxlen=kept_output_lines)
+    process = sp.Popen(args, cwd=working_dir, stdout=sp.PIPE, stderr=sp.PIPE)
+    # not the default executor, blocked readers of several tools could fill it up
+    with ThreadPoolExecutor(3) as executor:
+        done = asyncio.gather(*[loop.run_in_executor(executor, _log_lines, stream, name, output)
+                                for stream in (process.stdout, process.stderr)],
+                              loop.run_in_executor(executor, process.wait))
+        try:
+            finished, _ = await asyncio.wait([done], timeout=timeout)
+        finally:
+            if process.poll() is None:
+                process.kill()
+            await done  # the readers reach the end of the output once the tool is gone
+    process.stdout.close()
+    process.stderr.close()
+    if not finished:
+        raise sp.TimeoutExpired(list(args), timeout, '\n'.join(output))
+    if process.returncode != 0:
+        output = '\n'.join(output)
+        raise RuntimeError(
+            f'''{name} failed to run
+            args:
+            {list(args)}
+            output:
+            {output}''')
+
+
+async def run_sextractor_async(input_data: Union[str, CCDData], config: Config, working_dir: str,
+                               catalog: str = '', input_name: str = 'sextractorInput.fits') -> str:
+    """run_sextractor as a coroutine, :return: the name of the catalog"""
+    catalog = catalog or config.sextractor_outfile
+    loop = asyncio.get_event_loop()
+    if config.native_extractor:
+        await loop.run_in_executor(None, native_extraction, input_data, config, working_dir, catalog)
+        return catalog
+
+    pixels = await loop.run_in_executor(None, image_pixels, input_data)
+    fname, temporary_input = await loop.run_in_executor(None, sextractor_input, input_data, config, working_dir,
+                                                        input_name)
+    try:
+        await run_tool(sextractor_args(fname, config, catalog), working_dir, tool_timeout(pixels))
+    finally:
+        if temporary_input:
+            os.remove(fname)
+    return catalog
+
+
+async def run_scamp_async(catalogs: List[str], config: Config, working_dir: str, pixels: int,
+                          extra_args: Sequence[str] = ()) -> None:
+    """
+    run_scamp as a coroutine
+    :param pixels: of the images of all catalogs together, for the timeout
+    """
+    await run_tool(scamp_args(catalogs, config, extra_args), working_dir, tool_timeout(pixels, len(catalogs)))
+
+
+async def astroref_async(input_data: Union[str, CCDData], config: Config, sextractor_slots: asyncio.Semaphore,
+                         scamp_slots: asyncio.Semaphore) -> Tuple[str, bytes, bytes]:
+    """run_astroref as a coroutine, each stage waits for one of its slots"""
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        working_dir = config.working_dir or tmpdir
+        prepare_working_dir(config, working_dir)
+        async with sextractor_slots:
+            catalog = await run_sextractor_async(input_data, config, working_dir)
+        async with scamp_slots:
+            extra_args = await loop.run_in_executor(None, local_refcat, config, [input_data], working_dir)
+            pixels = await loop.run_in_executor(None, image_pixels, input_data)
+            await run_scamp_async([catalog], config, working_dir, pixels, extra_args)
+        scamp_data, sextractor_data = read_astroref_results(catalog, working_dir)
+        return scamp_data, sextractor_data, read_reference_catalog(working_dir)
+
+
+async def astroref_pipeline(inputs: Iterable[Union[str, CCDData]], config: Config = Config.default(),
+                            stage_jobs: int = 1) -> List[Tuple[str, bytes, bytes]]:
+    """
+    astroreference many images, SExtractor and scamp run in a pipeline: while scamp solves one image SExtractor already
+    works on the next one. Every image gets its own working directory like in run_astroref_concurrent
+    :param stage_jobs: how many SExtractor and how many scamp runs at the same time
+    :return: tuple(scamp_data, sextractor_data, reference_catalog_data) for every input, in the same order
+    """
+    if not is_config_valid(config):
+        raise ValueError("Errors found in scamp/source extractor configuration")
+
+    sextractor_slots, scamp_slots = asyncio.Semaphore(stage_jobs), asyncio.Semaphore(stage_jobs)
+    jobs = [asyncio.ensure_future(astroref_async(input_data, isolated_config(config, f'job{index}'), sextractor_slots,
+                                                 scamp_slots))
+            for index, input_data in enumerate(inputs)]
+    try:
+        return list(await asyncio.gather(*jobs))
+    except BaseException:
+        # don't leave the tools of the other images running
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+        raise
+
+
+def run_astroref_pipelined(inputs: Iterable[Union[str, CCDData]], config: Config = Config.default(),
+                           stage_jobs: int = 1) -> List[Tuple[str, bytes, bytes]]:
+    """astroref_pipeline for code without an event loop, see there"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(astroref_pipeline(inputs, config, stage_jobs))
+    finally:
+        loop.close()
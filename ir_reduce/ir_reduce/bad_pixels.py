@@ -0,0 +1,181 @@
+"""
+Replacing bad pixels. fix_pix works on the bounding boxes of the bad pixel domains instead of scanning the whole image
+for every domain, the interpolation plans only touch the neighbourhood of bad pixels and are shared by all frames
+with the same mask
+"""
+import functools
+from collections import namedtuple
+from typing import Tuple
+
+import numpy as np
+import scipy.ndimage as ndimage
+
+
+def domain_boxes(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    label the domains around bad pixels (bad pixels dilated by one) and get their bounding boxes
+    :param mask: True where the image is bad
+    :return: (labels, boxes) labels has the shape of mask, 0 outside of domains. boxes is (domains, 4) with
+             y0, y1, x0, x1 of domain label (index + 1)
+    """
+    domains, n = ndimage.label(ndimage.binary_dilation(mask))
+    boxes = np.array([(rows.start, rows.stop, columns.start, columns.stop)
+                      for rows, columns in ndimage.find_objects(domains)], dtype=np.intp).reshape(n, 4)
+    return domains, boxes
+
+
+def summed_area(values: np.ndarray) -> np.ndarray:
+    """summed-area table with a leading row and column of zeros, so box sums need no special case at the border"""
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.float64)
+    np.cumsum(values, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def box_sums(table: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """sums of all boxes (see domain_boxes) from a summed-area table"""
+    y0, y1, x0, x1 = boxes.T
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+def fix_pix_data(data: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    replace every bad pixel with the mean of the good pixels in the bounding box of its domain.
+    All domains are handled at once with summed-area tables of the good pixels
+
+    :param data: image
+    :param mask: True where data is bad
+    :return: copy of data with bad pixels replaced
+    """
+    domains, boxes = domain_boxes(mask)
+    cleaned = data.copy()
+    if not len(boxes):
+        return cleaned
+
+    good = ~mask
+    finite = np.isfinite(data)
+    counts = box_sums(summed_area(good), boxes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = box_sums(summed_area(np.where(good & finite, data, 0.)), boxes) / counts
+
+    # nan/inf in the good pixels would spread through the whole table, redo those few boxes directly
+    nonfinite = np.flatnonzero(box_sums(summed_area(good & ~finite), boxes))
+    for idx in nonfinite:
+        y0, y1, x0, x1 = boxes[idx]
+        means[idx] = data[y0:y1, x0:x1][good[y0:y1, x0:x1]].mean()
+
+    # label 0 is outside of any domain, bad pixels are always inside one
+    cleaned[mask] = np.concatenate(([np.nan], means))[domains[mask]]
+    return cleaned
+
+
+InterpolationPlan = namedtuple('InterpolationPlan', ['bad', 'neighbours', 'weights'])
+InterpolationPlan.__doc__ = """
+precomputed interpolation for one bad pixel mask: the value of the flat index bad[i] is
+sum(data.flat[neighbours[i]] * weights[i])
+"""
+
+
+def _last_good(good: np.ndarray, axis: int) -> np.ndarray:
+    """index of the last good pixel before or at every pixel along axis, -1 if there is none"""
+    positions = np.arange(good.shape[axis]).reshape((-1, 1) if axis == 0 else (1, -1))
+    return np.maximum.accumulate(np.where(good, positions, -1), axis=axis)
+
+
+def _linear_neighbours(good: np.ndarray, axis: int, rows: np.ndarray, columns: np.ndarray) -> Tuple[np.ndarray,
+                                                                                                     np.ndarray]:
+    """
+    nearest good pixel on both sides of every bad pixel (rows, columns) along axis and the weights for a linear
+    interpolation between them. If there is only one side it gets all the weight, if none both weights are 0
+    """
+    length = good.shape[axis]
+    before = _last_good(good, axis)[rows, columns]
+    flipped = np.flip(good, axis=axis)
+    after = length - 1 - np.flip(_last_good(flipped, axis), axis=axis)[rows, columns]  # no good one -> length
+    position = rows if axis == 0 else columns
+
+    has_before, has_after = before >= 0, after < length
+    both = has_before & has_after
+    span = np.where(both, after - before, 1)
+    weight_before = np.where(both, (after - position) / span, has_before.astype(float))
+    weight_after = np.where(both, (position - before) / span, has_after.astype(float))
+
+    before, after = np.clip(before, 0, length - 1), np.clip(after, 0, length - 1)
+    if axis == 0:
+        neighbours = np.stack([np.ravel_multi_index((before, columns), good.shape),
+                               np.ravel_multi_index((after, columns), good.shape)], axis=1)
+    else:
+        neighbours = np.stack([np.ravel_multi_index((rows, before), good.shape),
+                               np.ravel_multi_index((rows, after), good.shape)], axis=1)
+    return neighbours, np.stack([weight_before, weight_after], axis=1)
+
+
+def _nearest_neighbours(bad: np.ndarray, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    """flat index of the nearest good pixel of every bad pixel (rows, columns)"""
+    _, (nearest_rows, nearest_columns) = ndimage.distance_transform_edt(bad, return_indices=True)
+    return np.ravel_multi_index((nearest_rows[rows, columns], nearest_columns[rows, columns]), bad.shape)
+
+
+def interpolation_plan(bad: np.ndarray, method: str = 'bilinear') -> InterpolationPlan:
+    """
+    precompute which pixels each bad pixel is interpolated from, only looking at the neighbourhood of bad pixels
+
+    :param bad: True where the image is bad
+    :param method: 'bilinear': average of the linear interpolations between the nearest good pixels along the row and
+                   along the column, 'nearest': value of the nearest good pixel
+    :return: plan for apply_plan
+    """
+    if method not in ('bilinear', 'nearest'):
+        raise ValueError('method needs to be either bilinear or nearest')
+    rows, columns = np.nonzero(bad)
+    bad_index = np.ravel_multi_index((rows, columns), bad.shape)
+    if bad.all() or not len(bad_index):
+        return InterpolationPlan(bad_index, np.zeros((len(bad_index), 0), dtype=np.intp), np.zeros((len(bad_index), 0)))
+
+    nearest = _nearest_neighbours(bad, rows, columns).reshape(-1, 1)
+    if method == 'nearest':
+        return InterpolationPlan(bad_index, nearest, np.ones(nearest.shape))
+
+    good = ~bad
+    row_neighbours, row_weights = _linear_neighbours(good, 1, rows, columns)
+    column_neighbours, column_weights = _linear_neighbours(good, 0, rows, columns)
+    # average the directions that have a good pixel, nearest neighbour if a pixel has none in either direction
+    directions = row_weights.sum(axis=1, keepdims=True) + column_weights.sum(axis=1, keepdims=True)
+    row_weights /= np.maximum(1, directions)
+    column_weights /= np.maximum(1, directions)
+    isolated = (directions == 0).astype(float)
+
+    neighbours = np.hstack([row_neighbours, column_neighbours, nearest])
+    weights = np.hstack([row_weights, column_weights, isolated])
+    # unused neighbours point at a good pixel, so a nan in a bad pixel can't leak in through a zero weight
+    neighbours = np.where(weights == 0, nearest, neighbours)
+    return InterpolationPlan(bad_index, neighbours, weights)
+
+
+@functools.lru_cache(maxsize=4)
+def _cached_plan(packed: bytes, shape: Tuple[int, int], method: str) -> InterpolationPlan:
+    bad = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=int(np.prod(shape))).reshape(shape).astype(bool)
+    return interpolation_plan(bad, method)
+
+
+def cached_plan(bad: np.ndarray, method: str = 'bilinear') -> InterpolationPlan:
+    """
+    interpolation_plan, but only built once per process for the same mask. All frames of a stack share the
+    bad pixel mask, so the plan gets reused for every frame a worker handles
+    """
+    return _cached_plan(np.packbits(bad).tobytes(), bad.shape, method)
+
+
+def apply_plan(data: np.ndarray, plan: InterpolationPlan) -> np.ndarray:
+    """
+    :param data: image with the shape the plan was made for
+    :param plan: see interpolation_plan
+    :return: copy of data with the bad pixels interpolated
+    """
+    interpolated = np.array(data, dtype=np.result_type(data.dtype, np.float64))
+    flat = interpolated.reshape(-1)
+    if plan.neighbours.shape[1]:
+        flat[plan.bad] = np.einsum('ij,ij->i', flat[plan.neighbours], plan.weights)
+    else:  # nothing to interpolate from
+        flat[plan.bad] = np.nan
+    return interpolated
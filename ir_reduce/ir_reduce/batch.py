@@ -0,0 +1,183 @@
+"""
+Reduction of a whole night at once: the exposures are grouped into jobs by target (OBJECT), band and pointing, all
+jobs share the bad pixel maps and flats and run on one long lived pool. A failing job is logged and skipped, the
+other ones continue.
+"""
+import logging
+import os
+import re
+import time
+import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS, FITSFixedWarning
+
+from .classifier_common import Band
+from .image_discovery import ImageGroup
+from .main import PoolDummy, astroref, n_cpu, reduce_group, sort_paths, write_output
+from .run_sextractor_scamp import Config
+
+# header keyword with the name of the target
+object_keyword = 'OBJECT'
+# exposures of the same target further apart than this (in degrees) are separate pointings
+default_pointing_radius = 5. / 60
+
+Job = namedtuple('Job', ['name', 'band', 'paths'])
+Job.__doc__ = """
+one reduction: all exposures of a target in one band and pointing. paths is an ImageGroup with the bad pixel maps,
+the flats of the band and the exposures in the order they were taken
+"""
+JobResult = namedtuple('JobResult', ['job', 'output', 'seconds', 'error'])
+JobResult.__doc__ = """
+outcome of a job: the file that was written, how long it took and the exception if it failed (output is None then)
+"""
+
+
+def pointing(header: fits.Header) -> Optional[np.ndarray]:
+    """unit vector of the sky position of the center of a frame, None if it has no celestial WCS"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FITSFixedWarning)
+        wcs = WCS(header)
+    if not wcs.has_celestial:
+        return None
+    ra, dec = np.radians(wcs.celestial.pixel_to_world_values((header.get('NAXIS1', 1) - 1) / 2,
+                                                             (header.get('NAXIS2', 1) - 1) / 2))
+    return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def group_pointings(vectors: Sequence[Optional[np.ndarray]], radius: float = default_pointing_radius) -> List[int]:
+    """
+    index of the pointing for every frame. A frame belongs to the pointing with the nearest first frame if that is
+    within radius, otherwise it starts a new one. Frames without position form a pointing of their own
+    :param vectors: see pointing
+    :param radius: in degrees
+    """
+    centers, indices = [], []
+    # index of the pointing of the frames without position, created when the first one comes up
+    unknown: Optional[int] = None
+    for vector in vectors:
+        if vector is None:
+            if unknown is None:
+                unknown = len(centers)
+                centers.append(None)
+            indices.append(unknown)
+            continue
+        distances = [np.inf if center is None else np.degrees(np.arccos(np.clip(np.dot(vector, center), -1, 1)))
+                     for center in centers]
+        if distances and min(distances) <= radius:
+            indices.append(int(np.argmin(distances)))
+        else:
+            indices.append(len(centers))
+            centers.append(vector)
+    return indices
+
+
+def job_name(target: str, band_id: Band, pointing_index: int) -> str:
+    """file system friendly name of a job, e.g. SN2018xyz_J_0"""
+    return f"{re.sub(r'[^A-Za-z0-9_.+-]+', '_', target.strip()) or 'unknown'}_{band_id.name}_{pointing_index}"
+
+
+def find_jobs(bads: Iterable[str], flats: Iterable[str], images: Iterable[str],
+              pool: Union[PoolDummy, Pool] = PoolDummy(),
+              pointing_radius: float = default_pointing_radius) -> List[Job]:
+    """
+    group the exposures by target, band and pointing. Exposures of bands without flat are skipped with a warning
+
+    :param bads: bad pixel maps, used for all jobs
+    :param flats: flats of all bands
+    :param images: exposures of all targets, in the order they were taken
+    :param pool: multiprocessing pool or PoolDummy to read the headers
+    :param pointing_radius: see group_pointings
+    :return: jobs ordered by target, band and pointing
+    """
+    images = list(images)
+    image_headers = pool.map(fits.getheader, images)
+    sorted_paths = sort_paths(bads, flats, images, pool, exposure_headers=image_headers)
+    headers = dict(zip(images, image_headers))
+
+    groups: Dict[Tuple[str, Band, int], List[str]] = dict()
+    for band_id, group in sorted_paths.items():
+        if not group.images:
+            continue
+        if not group.flat:
+            logging.warning(f'no flat for band {band_id.name}, skipping {len(group.images)} exposures')
+            continue
+        by_target: Dict[str, List[str]] = dict()
+        for path in group.images:
+            by_target.setdefault(str(headers[path].get(object_keyword, '')), []).append(path)
+        for target, paths in by_target.items():
+            indices = group_pointings([pointing(headers[path]) for path in paths], pointing_radius)
+            for path, index in zip(paths, indices):
+                groups.setdefault((target, band_id, index), []).append(path)
+
+    return [Job(job_name(target, band_id, index), band_id,
+                ImageGroup(list(sorted_paths[band_id].bad), sorted_paths[band_id].flat, paths))
+            for (target, band_id, index), paths in sorted(groups.items(), key=lambda item: (item[0][0],
+                                                                                           item[0][1].name,
+                                                                                           item[0][2]))]
+
+
+def run_job(job: Job, pool: Union[PoolDummy, Pool], output_dir: str, astromatic_cfg: Optional[Config] = None,
+            **reduce_params) -> str:
+    """reduce (and astroreference) a single job, see reduce_group for reduce_params. returns the output path"""
+    output = os.path.join(output_dir, job.name + '.fits')
+    reduced = reduce_group(job.paths, job.band, pool, **reduce_params)
+    if astromatic_cfg is None:
+        write_output(output, reduced, None, None, None)
+    else:
+        write_output(output, *astroref(reduced, astromatic_cfg))
+    return output
+
+
+def run_batch(jobs: Sequence[Job], output_dir: str, astromatic_cfg: Optional[Config] = None,
+              single_thread: bool = False, concurrent_jobs: int = 1, **reduce_params) -> List[JobResult]:
+    """
+    run all jobs on one pool and log the progress. Failing jobs don't stop the others
+
+    :param jobs: see find_jobs
+    :param output_dir: every job writes <name>.fits here (and the astromatic output next to it)
+    :param astromatic_cfg: astroreference the results with this config, only reduce if None
+    :param single_thread: don't use multiprocessing
+    :param concurrent_jobs: how many jobs feed the pool at the same time, more keep it busier during the serial
+                            parts of a reduction at the cost of memory for their frame stores
+    :param reduce_params: combine, skyscale_method, calibration, cache_dir, ... see reduce_group
+    :return: result of every job in the order of jobs
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    _Pool = PoolDummy if single_thread else Pool
+    start = time.perf_counter()
+    results: List[Optional[JobResult]] = [None] * len(jobs)
+
+    def run(index: int) -> JobResult:
+        job_start = time.perf_counter()
+        try:
+            output = run_job(jobs[index], pool, output_dir, astromatic_cfg, **reduce_params)
+            return JobResult(jobs[index], output, time.perf_counter() - job_start, None)
+        except Exception as err:  # one broken job should not cost the rest of the night
+            logging.exception(f'job {jobs[index].name} failed')
+            return JobResult(jobs[index], None, time.perf_counter() - job_start, err)
+
+    with _Pool(n_cpu) as pool, ThreadPoolExecutor(max(1, concurrent_jobs)) as executor:
+        futures = {executor.submit(run, index): index for index in range(len(jobs))}
+        for done, future in enumerate(as_completed(futures), 1):
+            result = results[futures[future]] = future.result()
+            status = 'failed' if result.error is not None else f'wrote {result.output}'
+            logging.info(f'[{done}/{len(jobs)}] {result.job.name} ({len(result.job.paths.images)} frames) '
+                         f'{status} in {result.seconds:.1f}s')
+
+    log_summary(results, time.perf_counter() - start)
+    return results
+
+
+def log_summary(results: Sequence[JobResult], seconds: float) -> None:
+    failed = [result for result in results if result.error is not None]
+    frames = sum(len(result.job.paths.images) for result in results if result.error is None)
+    logging.info(f'batch done: {len(results) - len(failed)} of {len(results)} jobs in {seconds:.1f}s, '
+                 f'{frames / max(seconds, 1e-9):.2f} frames/s')
+    for result in failed:
+        logging.warning(f'failed: {result.job.name}: {result.error!r}')
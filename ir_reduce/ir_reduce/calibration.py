@@ -0,0 +1,180 @@
+"""
+Vectorized calibration of whole stacks of frames. Gives the same result as ccdproc.ccd_process with a master flat,
+bad pixel mask, gain and readnoise, but works on a (frames, rows, columns) array in one go
+"""
+import functools
+import itertools
+import os
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from astropy import units as u
+from astropy.io.fits import Header
+from astropy.nddata import CCDData, StdDevUncertainty
+
+from .frame_store import FrameStore, ArrayHandle, FrameMeta, open_stack, resolve
+
+
+def gain_readnoise(header: Header) -> Tuple[float, float]:
+    """
+    get gain and readnoise out of the header
+    :return: (gain [electron/count], readnoise [electron])
+    """
+    if "GAIN" in header:  # ALF
+        gain = header['GAIN']
+        readnoise = header['RDNOISE']
+    else:  # NOTCAM
+        # TODO that's from the quicklook-package, probably would want to do this individually for every sensor area
+        gain = (header['GAIN1'] + header['GAIN2'] + header['GAIN3'] + header['GAIN4']) / 4
+        readnoise = (header['RDNOISE1'] + header['RDNOISE2'] + header['RDNOISE3'] + header['RDNOISE4']) / 4
+    return gain, readnoise
+
+
+def quadrant_slices(shape: Tuple[int, int]) -> List[Tuple[slice, slice]]:
+    """
+    the regions of the four NOTCam amplifiers, index 0 belongs to GAIN1/RDNOISE1 and so on
+    Tiling: http://www.not.iac.es/instruments/notcam/guide/observe.html#reductions
+    """
+    rows, columns = shape[0] // 2, shape[1] // 2
+    return [np.s_[rows:, :columns], np.s_[rows:, columns:], np.s_[:rows, columns:], np.s_[:rows, :columns]]
+
+
+@functools.lru_cache(maxsize=16)
+def _quadrant_maps(gains: Tuple[float, ...], readnoises: Tuple[float, ...],
+                   shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    gain_map, readnoise_map = np.empty(shape), np.empty(shape)
+    for tile, gain, readnoise in zip(quadrant_slices(shape), gains, readnoises):
+        gain_map[tile] = gain
+        readnoise_map[tile] = readnoise
+    # cached, so nobody should be able to change them
+    gain_map.flags.writeable = False
+    readnoise_map.flags.writeable = False
+    return gain_map, readnoise_map
+
+
+def quadrant_values(header: Header) -> Tuple[Tuple[float, ...], Tuple[float, ...]]:
+    """gain and readnoise for each of the four quadrants"""
+    if "GAIN" in header:  # ALF, only one amplifier
+        gain, readnoise = gain_readnoise(header)
+        return (gain,) * 4, (readnoise,) * 4
+    return (tuple(header['GAIN' + str(idx)] for idx in range(1, 5)),
+            tuple(header['RDNOISE' + str(idx)] for idx in range(1, 5)))
+
+
+def quadrant_maps(header: Header, shape: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    per pixel gain and readnoise from the per amplifier GAIN1..4/RDNOISE1..4 keywords. The maps are cached for
+    every combination of values and shape, so they only get built once per process for a typical sequence
+
+    :param header: image header
+    :param shape: image shape
+    :return: read only (gain, readnoise) maps
+    """
+    gains, readnoises = quadrant_values(header)
+    return _quadrant_maps(gains, readnoises, tuple(shape))
+
+
+def normalized_flat(flat: CCDData) -> np.ndarray:
+    """flat divided by its mean, masked pixels set to one. Same as in ccdproc.flat_correct"""
+    flat_normed = flat.data / flat.data.mean()
+    if flat.mask is not None:
+        flat_normed[flat.mask] = 1.
+    return flat_normed
+
+
+def calibrate_stack(data: np.ndarray, gain: Union[float, np.ndarray], readnoise: Union[float, np.ndarray],
+                    flat_normed: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    gain correct and flat field a stack of frames and calculate the uncertainty from poisson noise and readnoise.
+    Negative values get a nan uncertainty like in ccdproc.create_deviation
+
+    :param data: (frames, rows, columns) raw data in counts
+    :param gain: per frame (shape (frames, 1, 1)) or anything else that broadcasts to data, in electron/count
+    :param readnoise: same as gain, in electron
+    :param flat_normed: normalized master flat
+    :return: (calibrated data, uncertainty) in electron
+    """
+    electrons = np.multiply(data, gain, dtype=np.float64)
+
+    uncertainty = np.where(electrons < 0, np.nan, electrons)
+    uncertainty += np.square(readnoise)
+    np.sqrt(uncertainty, out=uncertainty)
+    uncertainty /= np.abs(flat_normed)
+
+    electrons /= flat_normed
+    return electrons, uncertainty
+
+
+def quadrant_reduction(image: CCDData, bad: Optional[np.ndarray], flat_normed: np.ndarray,
+                       gain: Optional[np.ndarray] = None, readnoise: Optional[np.ndarray] = None) -> CCDData:
+    """
+    calibrate a single image with the gain and readnoise of each NOTCam amplifier in one pass
+    :param image: raw image
+    :param bad: combined bad pixel mask
+    :param flat_normed: normalized master flat, see normalized_flat
+    :param gain: gain map, taken from the header if not passed
+    :param readnoise: readnoise map, taken from the header if not passed
+    :return: calibrated image in electrons
+    """
+    if gain is None or readnoise is None:
+        gain, readnoise = quadrant_maps(image.header, image.shape)
+    data, uncertainty = calibrate_stack(image.data, gain, readnoise, flat_normed)
+    return CCDData(data, uncertainty=StdDevUncertainty(uncertainty), mask=bad.astype(bool) if bad is not None else None,
+                   unit=image.unit * u.electron / u.count, header=image.header, wcs=image.wcs)
+
+
+def _per_frame(values: List[float]) -> np.ndarray:
+    return np.array(values, dtype=np.float64).reshape(-1, 1, 1)
+
+
+def batch_process(bad: Optional[np.ndarray], flat: CCDData, images: List[CCDData]) -> List[CCDData]:
+    """
+    replacement for calling ccdproc.ccd_process for every image, see main.single_reduction
+    :param bad: combined bad pixel mask
+    :param flat: master flat
+    :param images: all need to have the same shape and unit
+    :return: calibrated images
+    """
+    gains, readnoises = zip(*(gain_readnoise(image.header) for image in images))
+    data, uncertainty = calibrate_stack(np.stack([image.data for image in images]), _per_frame(gains),
+                                        _per_frame(readnoises), normalized_flat(flat))
+    mask = bad.astype(bool) if bad is not None else None
+    return [CCDData(frame_data, uncertainty=StdDevUncertainty(frame_uncertainty), mask=mask,
+                    unit=image.unit * u.electron / u.count, header=image.header, wcs=image.wcs)
+            for frame_data, frame_uncertainty, image in zip(data, uncertainty, images)]
+
+
+def _batch_process_frames(directory: str, frames: slice, gains: List[float], readnoises: List[float],
+                          bad: Optional[ArrayHandle], flat_normed: ArrayHandle) -> None:
+    data, mask, uncertainty = open_stack(directory, 'r+')
+    data[frames], uncertainty[frames] = calibrate_stack(data[frames], _per_frame(gains), _per_frame(readnoises),
+                                                        resolve(flat_normed))
+    mask[frames] = resolve(bad) if bad is not None else False
+
+
+def batch_process_store(bad: Optional[np.ndarray], flat: CCDData, store: FrameStore, pool,
+                        n_chunks: int = 0) -> FrameStore:
+    """
+    like batch_process, but in place on a FrameStore. The frames are split into chunks that get calibrated in
+    the pool workers
+
+    :param bad: combined bad pixel mask
+    :param flat: master flat
+    :param store: images to calibrate
+    :param pool: multiprocessing pool or PoolDummy
+    :param n_chunks: how many chunks to split the frames into, defaults to one per cpu
+    :return: store
+    """
+    n_chunks = min(len(store), n_chunks or os.cpu_count() or 1)
+    bounds = np.linspace(0, len(store), n_chunks + 1).astype(int)
+    chunks = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    gains, readnoises = zip(*(gain_readnoise(meta.header) for meta in store.metas))
+    bad_handle = store.put('bad', bad.astype(bool)) if bad is not None else None
+    flat_handle = store.put('flat_normed', normalized_flat(flat))
+
+    pool.starmap(_batch_process_frames, zip(itertools.repeat(store.directory), chunks,
+                                            (gains[chunk] for chunk in chunks), (readnoises[chunk] for chunk in chunks),
+                                            itertools.repeat(bad_handle), itertools.repeat(flat_handle)))
+    store.metas = [FrameMeta(meta.header, meta.wcs, meta.unit * u.electron / u.count, True) for meta in store.metas]
+    return store
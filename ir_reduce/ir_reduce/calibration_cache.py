@@ -0,0 +1,165 @@
+"""
+On-disk cache for derived calibration products (combined bad pixel mask, normalized flat, gain maps).
+Products are stored as .npy files named after a hash of the content of the input files and the parameters
+used to create them, so they can be shared between runs and processes. The workers can memory map them directly.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+from astropy.io.fits import Header
+
+from .calibration import quadrant_maps, quadrant_values
+from .frame_store import ArrayHandle
+
+default_max_bytes = 2 * 1024 ** 3
+# seconds after its last use a product can't be evicted, another job may have its handle but not have loaded it yet.
+# Also the age after which a left over temporary file counts as abandoned
+default_grace_seconds = 600.
+# bump this if the way any of the products is calculated changes
+cache_version = 1
+
+# (path, size, mtime) -> sha256 of the content, so unchanged files only get hashed once per process
+_file_hashes: Dict[Tuple[str, int, int], str] = dict()
+
+
+def file_hash(path: str) -> str:
+    """sha256 of the content of a file"""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                sha.update(chunk)
+        _file_hashes[memo_key] = sha.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def content_key(product: str, files: Sequence[str] = (), **params) -> str:
+    """
+    key of a product, changes if the content of any of the files or any parameter changes
+    :param product: name of the product, e.g. 'bad_mask'
+    :param files: input files, their order does not matter
+    :param params: anything else the product depends on, needs a stable repr
+    :return: hex digest
+    """
+    sha = hashlib.sha256()
+    sha.update(f'{product} {cache_version}'.encode())
+    for digest in sorted(file_hash(path) for path in files):
+        sha.update(digest.encode())
+    for key, value in sorted(params.items()):
+        sha.update(f'{key}={value!r}'.encode())
+    return sha.hexdigest()
+
+
+class CalibrationCache:
+    """
+    Directory of cached calibration products with size based eviction of the least recently used ones
+    """
+
+    def __init__(self, directory: str, max_bytes: int = default_max_bytes,
+                 grace_seconds: float = default_grace_seconds):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.grace_seconds = grace_seconds
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, product: str, files: Sequence[str] = (), **params) -> str:
+        return os.path.join(self.directory, f'{product}_{content_key(product, files, **params)}.npy')
+
+    def get(self, product: str, factory: Callable[[], np.ndarray], files: Sequence[str] = (),
+            **params) -> ArrayHandle:
+        """
+        Get a product from the cache, create it with factory if it does not exist yet
+        :param product: name of the product
+        :param factory: creates the product if it's not in the cache
+        :param files: input files of the product
+        :param params: other parameters the product depends on
+        :return: handle to the .npy file
+        """
+        path = self.path(product, files, **params)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:  # not created yet or evicted by another process, create it again
+            pass
+        else:
+            logging.info(f'using cached {product} {path}')
+            return ArrayHandle(path)
+
+        array = factory()
+        # write to a temporary file first so other processes never see a half written product
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict(keep=path)
+        return ArrayHandle(path)
+
+    def load(self, product: str, factory: Callable[[], np.ndarray], files: Sequence[str] = (), **params) -> np.ndarray:
+        """like get, but return the array"""
+        return np.load(self.get(product, factory, files, **params).path)
+
+    def size(self) -> int:
+        """bytes of the products and the temporary files of products being written"""
+        return sum(size for _, size, _ in self._entries('.npy') + self._entries('.npy.tmp'))
+
+    def _entries(self, suffix: str) -> List[Tuple[float, int, str]]:
+        """(mtime, size, path) of the files with suffix, oldest first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(suffix):
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except FileNotFoundError:  # another process was faster
+                pass
+        return sorted(entries)
+
+    def evict(self, keep: str = '') -> None:
+        """
+        delete the least recently used products until the cache is smaller than max_bytes. Products used within
+        grace_seconds are kept even if the cache stays larger, temporary files older than that were abandoned by a
+        failed process and are deleted
+        """
+        cutoff = time.time() - self.grace_seconds
+        for mtime, _, path in self._entries('.npy.tmp'):
+            if mtime < cutoff:
+                try:
+                    os.remove(path)
+                    logging.info(f'removed abandoned {path} from calibration cache')
+                except FileNotFoundError:
+                    pass
+
+        entries = self._entries('.npy')
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes or mtime >= cutoff:
+                break
+            if path == keep:
+                continue
+            total -= size
+            try:
+                os.remove(path)
+                logging.info(f'evicted {path} from calibration cache')
+            except FileNotFoundError:
+                pass
+
+
+def cached_quadrant_maps(cache: CalibrationCache, header: Header,
+                         shape: Tuple[int, int]) -> Tuple[ArrayHandle, ArrayHandle]:
+    """gain and readnoise maps (see calibration.quadrant_maps) from the cache"""
+    gains, readnoises = quadrant_values(header)
+    params = dict(gains=gains, readnoises=readnoises, shape=tuple(shape))
+    return (cache.get('gain_map', lambda: quadrant_maps(header, shape)[0], **params),
+            cache.get('readnoise_map', lambda: quadrant_maps(header, shape)[1], **params))
@@ -0,0 +1,133 @@
+"""
+Checkpoints of the frame store after every stage of the reduction, so a rerun resumes after the last stage that is
+still valid. A stage is keyed by its own parameters and the key of the stage before it, the first one also by the
+content of the input files, so changing a parameter invalidates only that stage and the ones after it. Changing
+just the combine method doesn't invalidate any of them.
+"""
+import logging
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from typing import Callable, List, Optional, Sequence
+
+from .calibration_cache import content_key, file_hash
+from .frame_store import FrameStore
+
+default_max_bytes = 16 * 1024 ** 3
+
+Stage = namedtuple('Stage', ['name', 'run', 'params'])
+Stage.__doc__ = """
+one step of the reduction: run(store) processes the store in place, params are everything it depends on apart from
+the input files and the previous stages
+"""
+
+
+def stage_keys(stages: Sequence[Stage], files: Sequence[str] = (), images: Sequence[str] = (),
+               **params) -> List[str]:
+    """
+    :param stages: the stages in the order they run
+    :param files: input files whose order does not matter, e.g. bad pixel frames and flats
+    :param images: input files whose order matters
+    :param params: parameters of the whole reduction, e.g. the band
+    :return: key of every stage
+    """
+    key = content_key('input', files, images=tuple(file_hash(path) for path in images), **params)
+    keys = []
+    for stage in stages:
+        key = content_key(stage.name, previous=key, **stage.params)
+        keys.append(key)
+    return keys
+
+
+class Checkpoints:
+    """
+    Directory with a copy of the frame store (see FrameStore.save) after every stage. The least recently used
+    checkpoints are removed once they take up more than max_bytes
+    """
+
+    def __init__(self, directory: str, max_bytes: int = default_max_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, name: str, key: str) -> str:
+        return os.path.join(self.directory, f'{name}_{key}')
+
+    def latest(self, stages: Sequence[Stage], keys: Sequence[str]) -> int:
+        """index of the last stage that has a checkpoint, -1 if there is none"""
+        for index in reversed(range(len(stages))):
+            if os.path.isdir(self.path(stages[index].name, keys[index])):
+                return index
+        return -1
+
+    def restore(self, name: str, key: str) -> FrameStore:
+        path = self.path(name, key)
+        logging.info(f'resuming after stage {name} from {path}')
+        os.utime(path)  # mark as recently used
+        return FrameStore.load(path)
+
+    def save(self, store: FrameStore, name: str, key: str) -> None:
+        path = self.path(name, key)
+        # write to a temporary directory first so a crash never leaves a half written checkpoint behind
+        tmp_path = tempfile.mkdtemp(prefix='.tmp_', dir=self.directory)
+        try:
+            store.save(tmp_path)
+            os.rename(tmp_path, path)
+        except OSError:  # e.g. another process saved the same checkpoint in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        self.evict(keep=path)
+
+    def size(self) -> int:
+        return sum(self._size(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+    @staticmethod
+    def _size(path: str) -> int:
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def evict(self, keep: str = '') -> None:
+        """delete the least recently used checkpoints until all of them are smaller than max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if not name.startswith('.tmp_'):
+                    entries.append((os.stat(path).st_mtime, self._size(path), path))
+            except FileNotFoundError:  # another process was faster
+                pass
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            total -= size
+            shutil.rmtree(path, ignore_errors=True)
+            logging.info(f'evicted checkpoint {path}')
+
+
+def run_stages(stages: Sequence[Stage], read: Callable[[], FrameStore], checkpoints: Optional[Checkpoints] = None,
+               keys: Sequence[str] = ()) -> FrameStore:
+    """
+    run the stages on a store, starting after the last one that has a checkpoint
+    :param stages: stages in the order they run
+    :param read: creates the store from the input files if there is no checkpoint
+    :param checkpoints: where to save/restore checkpoints. If None, all stages run
+    :param keys: key of every stage, see stage_keys
+    :return: the processed store, the caller needs to close it
+    """
+    done = checkpoints.latest(stages, keys) if checkpoints is not None else -1
+    store = checkpoints.restore(stages[done].name, keys[done]) if done >= 0 else read()
+    try:
+        for index in range(done + 1, len(stages)):
+            stages[index].run(store)
+            if checkpoints is not None:
+                checkpoints.save(store, stages[index].name, keys[index])
+    except BaseException:
+        store.close()
+        raise
+    return store
@@ -5,10 +5,13 @@ import os
 from textwrap import dedent
 from typing import Iterable, Any, Sequence
 
+# keep the imports here light, the reduction itself (astropy, ccdproc, ...) is only imported by the subcommands that
+# need it. test_import_time keeps track of this
 import ir_reduce
-import ir_reduce.run_sextractor_scamp
+import ir_reduce.server
 
-from .image_type_classifier import Band
+from .astromatic_config import Config
+from .classifier_common import Band
 
 # todo tmp
 logging.getLogger().setLevel(logging.DEBUG)
@@ -16,30 +19,63 @@ logging.getLogger().setLevel(logging.DEBUG)
 VERSION = '0.1'
 
 output_default = 'reduced.fits'
+# arcmin, see batch.default_pointing_radius
+batch_pointing_radius = 5.
+# degrees, see refcat_store.default_tile_size
+refcat_tile_size = 1.
+
+
+def reduction_params(flags: argparse.Namespace) -> dict:
+    """parameters of reduce_image/reduce_group that are set by the global flags"""
+    return dict(combine='average' if flags.average else 'median',
+                skyscale_method='running' if flags.running_sky else 'subtract' if flags.subtract else 'divide',
+                calibration=flags.calibration,
+                cache_dir=flags.cache_dir,
+                sky_window=flags.sky_window,
+                register_images=flags.register_images,
+                distortion_correct=flags.distortion_correct,
+                checkpoint_dir=flags.checkpoint_dir)
 
 
 def astroref_and_or_reduce(bads: Iterable[str],
                            flats: Iterable[str],
                            images: Iterable[str],
                            flags: argparse.Namespace,
-                           astromatic_cfg: ir_reduce.run_sextractor_scamp.Config) -> None:
-    if flags.no_ref:
-        to_call = ir_reduce.do_only_reduce
+                           astromatic_cfg: Config) -> None:
+    command = 'do_only_reduce' if flags.no_ref else 'do_everything'
+
+    kwargs = dict(output=flags.output,
+                  band_id='all' if flags.filter[0] == 'all' else Band.lookup(flags.filter[0]),
+                  single_thread=flags.single_thread,
+                  **reduction_params(flags))
+    if not flags.no_ref:
+        kwargs['astromatic_cfg'] = astromatic_cfg
+
+    if flags.server:
+        send_to_server(command, flags.server, bads=bads, flats=flats, images=images, **kwargs)
     else:
-        to_call = ir_reduce.do_everything
-
-    to_call(bads, flats, images,
-            output=flags.output,
-            band_id=Band.lookup(flags.filter[0]),
-            combine='average' if flags.average else 'median',
-            skyscale_method='subtract' if flags.subtract else 'divide',
-            astromatic_cfg=astromatic_cfg,
-            single_thread=flags.single_thread)
-    # register=flags.register_images,
+        getattr(ir_reduce, command)(bads, flats, images, **kwargs)
     # verbosity=flags.verbose,
     # force=flags.force)
 
 
+def send_to_server(command: str, socket_path: str, **kwargs) -> None:
+    """run a job on a running 'serve' process instead of in this one"""
+
+    def absolute(value):
+        if isinstance(value, str) and value:
+            return os.path.abspath(value)
+        return [absolute(item) for item in value] if isinstance(value, (list, set, tuple)) else value
+
+    # the server has its own working directory
+    for key in ('bads', 'flats', 'images', 'output', 'cache_dir', 'checkpoint_dir'):
+        if key in kwargs:
+            kwargs[key] = absolute(kwargs[key])
+    reply = ir_reduce.server.submit(command, socket_path, **kwargs)
+    logging.info(f'server finished {command} after {reply["waited"]:.2f}s in the queue and {reply["seconds"]:.2f}s '
+                 f'running')
+
+
 def extract_textfile_if_present(arguments: Sequence[str]):
     """slightly hacky way to implement @list syntax"""
     if any('@' in arg for arg in arguments):
@@ -74,7 +110,13 @@ def do_only_astroref(args: argparse.Namespace):
 
     astromatic_cfg = parse_astromatic_config(args)
 
-    ir_reduce.do_only_astroref(args.images, args.output, astromatic_cfg)
+    if args.server:
+        send_to_server('do_only_astroref', args.server, images=args.images, output=args.output,
+                       astromatic_cfg=astromatic_cfg, concurrent_jobs=args.jobs, single_scamp=args.single_scamp,
+                       pipelined=args.pipeline)
+    else:
+        ir_reduce.do_only_astroref(args.images, args.output, astromatic_cfg, concurrent_jobs=args.jobs,
+                                   single_scamp=args.single_scamp, pipelined=args.pipeline)
 
 
 def do_discover(args: argparse.Namespace):
@@ -108,6 +150,44 @@ def do_discover(args: argparse.Namespace):
     return astroref_and_or_reduce(bads, flats, images, args, astromatic_cfg)
 
 
+def do_batch(args: argparse.Namespace):
+    from ir_reduce import batch, image_discovery
+    if args.method == 'file':
+        bads, flats, images = image_discovery.discover_filename(args.folder)
+    else:
+        bads, flats, images = image_discovery.discover_header(args.folder)
+
+    # file names of the exposures are in the order they were taken
+    jobs = batch.find_jobs(sorted(bads), sorted(flats), sorted(images), pointing_radius=args.pointing_radius / 60)
+    if not jobs:
+        raise ValueError('No exposures with a matching flat found')
+    for job in jobs:
+        logging.info(f'job {job.name}: {len(job.paths.images)} exposures')
+
+    astromatic_cfg = None if args.no_ref else parse_astromatic_config(args)
+    results = batch.run_batch(jobs, args.output_dir, astromatic_cfg, single_thread=args.single_thread,
+                              concurrent_jobs=args.jobs, **reduction_params(args))
+    if any(result.error is not None for result in results):
+        exit(1)
+
+
+def do_serve(args: argparse.Namespace):
+    if args.status:
+        for key, value in ir_reduce.server.request(dict(command='status'), args.socket).items():
+            print(f'{key}: {value}')
+    elif args.stop:
+        ir_reduce.server.request(dict(command='shutdown'), args.socket)
+    else:
+        ir_reduce.server.serve(args.socket, args.cache_dir, args.single_thread, args.jobs)
+
+
+def do_refcat(args: argparse.Namespace):
+    from ir_reduce.refcat_store import RefcatStore
+    store = RefcatStore(args.store, args.tile_size)
+    added = store.ingest(extract_textfile_if_present(args.catalogs))
+    logging.info(f'added {added} sources, {sum(store.index["tiles"].values())} in {len(store.index["tiles"])} tiles')
+
+
 def do_transient_detection(args: argparse.Namespace):
     from ir_reduce.transient_detection import transient_detection
 
@@ -118,8 +198,8 @@ def do_nothing(*_: Any) -> None:
     pass
 
 
-def parse_astromatic_config(args: argparse.Namespace) -> ir_reduce.run_sextractor_scamp.Config:
-    cfg = ir_reduce.run_sextractor_scamp.Config.default()
+def parse_astromatic_config(args: argparse.Namespace) -> Config:
+    cfg = Config.default()
 
     for filelist in (args.sextractor_config, args.sextractor_params, args.scamp_config):
         if not os.path.exists(filelist[0]):
@@ -128,9 +208,13 @@ def parse_astromatic_config(args: argparse.Namespace) -> ir_reduce.run_sextracto
     cfg.sextractor_config = os.path.abspath(args.sextractor_config[0])
     cfg.sextractor_params = os.path.abspath(args.sextractor_params[0])
     cfg.scamp_config = os.path.abspath(args.scamp_config[0])
-    cfg.working_dir = os.path.abspath(args.wdir[0])
+    # without --wdir every run works in a temporary directory that is removed afterwards
+    cfg.working_dir = os.path.abspath(args.wdir[0]) if args.wdir[0] else ''
     cfg.scamp_overrides = args.scamp_overrides
     cfg.sextractor_overrides = args.sextractor_overrides
+    if args.refcat_store:
+        cfg.refcat_store = os.path.abspath(args.refcat_store)
+    cfg.native_extractor = args.native_extractor
 
     return cfg
 
@@ -144,14 +228,33 @@ group.add_argument('-a', '--average', action='store_true', help='combine images
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-s', '--subtract', action='store_true', help='skyscale images by subtraction')
 group.add_argument('-d', '--divide', action='store_true', default=True, help='skyscale images by division')
+group.add_argument('-rs', '--running-sky', action='store_true',
+                   help='subtract a running sky made of the median of the temporally neighbouring images')
+parser.add_argument('--sky-window', '-sw', type=int, default=5,
+                    help='number of neighbouring images for the running sky')
 parser.add_argument('-r', '--register-images', action='store_true',
-                    help='[not implemented] images are aligned with cross correlation, not just based on WCS')
+                    help='images are aligned with cross correlation, not just based on WCS')
+parser.add_argument('-dc', '--distortion-correct', action='store_true',
+                    help='correct the distortion of NOTCam images with the geomap model shipped in notcam.db')
 parser.add_argument('--filter', '-fl', nargs=1, default='J',
-                    help='What image filter/spectral Band do we want to process?')
+                    help='What image filter/spectral Band do we want to process? \'all\' reduces every band and '
+                         'writes one output per band')
 parser.add_argument('--no-ref', '-n', action='store_true', default=False,
                     help='the output image won\'t be astroreferenced')
 parser.add_argument('--single-thread', '-si', action='store_true', default=False, help="don't use multiprocessing,"
                                                                                        "helps for clearer errors")
+parser.add_argument('--calibration', '-ca', choices=['ccdproc', 'batch', 'quadrant'], default='ccdproc',
+                    help='calibrate every image with ccdproc, the whole stack at once with numpy (faster) or with '
+                         'the gain/readnoise of every NOTCam amplifier')
+parser.add_argument('--cache-dir', '-cd', default=None,
+                    help='keep the combined bad pixel mask, normalized flat and gain maps in this directory and reuse '
+                         'them in later runs with the same calibration files')
+parser.add_argument('--checkpoint-dir', '-cp', default=None,
+                    help='keep the images after every reduction stage in this directory, a rerun continues after the '
+                         'last stage whose inputs and parameters did not change')
+parser.add_argument('--server', '-S', nargs='?', default=None, const=ir_reduce.server.default_socket,
+                    help='send the job to a running "serve" process listening on this socket instead of running it '
+                         'here')
 
 parser.add_argument('--verbose', '-v', action='count', default=0, help='No effect yet')
 parser.add_argument('--version', action='version', version=VERSION)
@@ -160,7 +263,7 @@ parser.set_defaults(func=do_nothing)
 
 
 def add_astromatic_params(_parser):
-    astromatic_cfg = ir_reduce.run_sextractor_scamp.Config.default()
+    astromatic_cfg = Config.default()
     _parser.add_argument('--sextractor-config', '-sexc', nargs=1, type=str, default=[astromatic_cfg.sextractor_config],
                          help='override inbuilt source extractor config file')
     _parser.add_argument('--sextractor-params', '-sexp', nargs=1, type=str, default=[astromatic_cfg.sextractor_param],
@@ -174,6 +277,12 @@ def add_astromatic_params(_parser):
     _parser.add_argument('--sextractor-overrides', '-sexo', nargs='+',
                          default=astromatic_cfg.sextractor_overrides, type=str,
                          help='override configuration values for source extractor as "KEY0=VAL0 KEY1=VAL1"')
+    _parser.add_argument('--refcat-store', '-rc', default=astromatic_cfg.refcat_store,
+                         help='use cutouts of this local reference catalog store (see the refcat subcommand) instead '
+                              'of downloading the reference catalog')
+    _parser.add_argument('--native-extractor', '-ne', action='store_true', default=astromatic_cfg.native_extractor,
+                         help='extract sources in process with numpy/scipy instead of running source extractor, faster '
+                              'but without deblending')
 
 
 sub_parsers = parser.add_subparsers(title='subcommands', description='', help='sub commands')
@@ -202,15 +311,54 @@ sub_parser.add_argument('-o', '--output', nargs='?', type=str, default=output_de
 add_astromatic_params(sub_parser)
 sub_parser.set_defaults(func=do_discover)
 
+sub_parser = sub_parsers.add_parser('batch', aliases=['b'],
+                                    help='Reduce all targets in a directory, one output per target, band and pointing')
+sub_parser.add_argument('folder', nargs='?', type=str, default=os.getcwd(),
+                        help='folder to search for files to analyze')
+sub_parser.add_argument('-m', '--method', nargs='?', type=str, default='file',
+                        help='use filename ("file", default) or else header to find bad pixel maps and flats')
+sub_parser.add_argument('-o', '--output-dir', type=str, default='reduced',
+                        help='directory for the outputs, named <OBJECT>_<band>_<pointing>.fits')
+sub_parser.add_argument('-p', '--pointing-radius', type=float, default=batch_pointing_radius,
+                        help='exposures of a target further apart than this (arcmin) are separate pointings')
+sub_parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of reductions that share the process pool at the same time')
+add_astromatic_params(sub_parser)
+sub_parser.set_defaults(func=do_batch)
+
+sub_parser = sub_parsers.add_parser('serve', help='Keep warm workers and the calibration cache (--cache-dir) in a '
+                                                  'long running process and take jobs from --server clients')
+sub_parser.add_argument('--socket', default=ir_reduce.server.default_socket, help='Unix socket to listen on')
+sub_parser.add_argument('-j', '--jobs', type=int, default=1, help='number of jobs that share the workers at a time')
+sub_parser.add_argument('--status', action='store_true', help='show queue depth and latency of a running server')
+sub_parser.add_argument('--stop', action='store_true', help='stop a running server')
+sub_parser.set_defaults(func=do_serve)
+
 sub_parser = sub_parsers.add_parser(
     'astroref', aliases=['ref'], help='only perform astrorefferencing with sextractor/scamp on already reduced image')
 sub_parser.add_argument('-i', '--images', metavar='images', nargs='+', type=str,
                         help='image(s) to astroreff. Can use @textfile')
 sub_parser.add_argument('-o', '--output', nargs='+', type=str, default=[output_default],
                         help='output file(s) to write to, default: reduced.fits, can use @textfile')
+sub_parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of images astroreferenced at the same time, default: one per CPU')
+sub_parser.add_argument('-ss', '--single-scamp', action='store_true',
+                        help='run SExtractor on every image and solve all of them in one scamp run with a shared '
+                             'reference catalog')
+sub_parser.add_argument('-p', '--pipeline', action='store_true',
+                        help='run SExtractor on the next image while scamp solves the previous one, -j sets how many '
+                             'runs of each tool at a time (default: one)')
 add_astromatic_params(sub_parser)
 sub_parser.set_defaults(func=do_only_astroref)
 
+sub_parser = sub_parsers.add_parser('refcat', help='Ingest reference catalogs (e.g. the ones scamp saved) into a local '
+                                                   'store for --refcat-store')
+sub_parser.add_argument('store', help='directory of the store, created if it does not exist')
+sub_parser.add_argument('catalogs', nargs='+', help='FITS_LDAC catalogs or FITS tables. Can use @textfile')
+sub_parser.add_argument('--tile-size', type=float, default=refcat_tile_size,
+                        help='size of the sky tiles of a new store in degrees')
+sub_parser.set_defaults(func=do_refcat)
+
 sub_parser = sub_parsers.add_parser('transient', aliases=['t'],
                                     help='use a reduced and astroreferenced image, source extractor output and'
                                          ' scamp reference cataloge to find divergences')
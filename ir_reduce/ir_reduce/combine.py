@@ -0,0 +1,94 @@
+"""
+Combining a stack of frames block by block, so the whole stack never has to be in memory at once.
+Does the same as ccdproc.Combiner.median_combine/average_combine
+"""
+import itertools
+import os
+import warnings
+from typing import List, Tuple
+
+import numpy as np
+from astropy.nddata import CCDData, StdDevUncertainty
+from numpy.lib.format import open_memmap
+
+from .frame_store import FrameStore, open_stack
+
+# how much input data (bytes) a single block may contain, the working memory per worker is a small multiple of this
+default_block_bytes = 32 * 1024 ** 2
+
+
+def row_blocks(shape: Tuple[int, int, int], block_bytes: int = default_block_bytes, min_blocks: int = 1) -> List[slice]:
+    """
+    split the rows of a (frames, rows, columns) stack into blocks that fit into block_bytes
+    :param shape: shape of the stack
+    :param block_bytes: upper limit for the float64 input data of a single block
+    :param min_blocks: split into at least this many blocks, e.g. to keep all workers busy
+    :return: slices selecting the rows
+    """
+    n_frames, n_rows, n_columns = shape
+    rows = max(1, block_bytes // (8 * n_frames * n_columns))
+    rows = min(rows, -(-n_rows // max(1, min_blocks)))
+    return [slice(start, min(start + rows, n_rows)) for start in range(0, n_rows, rows)]
+
+
+def combine_block(data: np.ndarray, mask: np.ndarray, method: str = 'median') -> Tuple[np.ndarray, np.ndarray,
+                                                                                       np.ndarray]:
+    """
+    combine a (frames, rows, columns) block along the first axis, ignoring masked and nan values
+    :param data: pixel values
+    :param mask: True where data is bad
+    :param method: either 'median' or 'average'
+    :return: (combined, mask, uncertainty)
+    """
+    values = np.where(mask, np.nan, data)
+    masked_values = np.isnan(values).sum(axis=0)
+    n_valid = len(values) - masked_values
+
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-nan pixels, they end up masked
+        if method == 'median':
+            combined = np.nanmedian(values, axis=0)
+            # same as ccdproc.sigma_func
+            uncertainty = 1.4826 * np.nanmedian(np.abs(values - np.nanmedian(values, axis=0)), axis=0)
+        elif method == 'average':
+            combined = np.nanmean(values, axis=0)
+            uncertainty = np.nanstd(values, axis=0)
+        else:
+            raise ValueError('method needs to be either median or average')
+        uncertainty /= np.sqrt(n_valid)
+
+    return combined, masked_values == len(values), uncertainty
+
+
+def _combine_rows(directory: str, rows: slice, method: str) -> None:
+    data, mask, _ = open_stack(directory, 'r')
+    combined, combined_mask, uncertainty = combine_block(data[:, rows], mask[:, rows], method)
+
+    for name, result in zip(('data', 'mask', 'uncertainty'), (combined, combined_mask, uncertainty)):
+        np.load(os.path.join(directory, 'combined_' + name + '.npy'), mmap_mode='r+')[rows] = result
+
+
+def tile_combine(store: FrameStore, method: str, pool, block_bytes: int = default_block_bytes) -> CCDData:
+    """
+    median/average combine all frames in store. The output is split into blocks of rows that get combined in
+    the pool workers, so the memory needed depends on block_bytes and not on the number of frames.
+
+    :param store: the frames to combine, need to have the same unit
+    :param method: either 'median' or 'average'
+    :param pool: multiprocessing pool or PoolDummy
+    :param block_bytes: upper limit for the input data of a single block
+    :return: combined image with mask and uncertainty like ccdproc.Combiner
+    """
+    blocks = row_blocks(store.shape, block_bytes, min_blocks=os.cpu_count() or 1)
+
+    # only create the output files, the workers fill them
+    for name, dtype in (('data', np.float64), ('mask', bool), ('uncertainty', np.float64)):
+        open_memmap(os.path.join(store.directory, 'combined_' + name + '.npy'), 'w+', dtype, store.shape[1:])
+
+    pool.starmap(_combine_rows, zip(itertools.repeat(store.directory), blocks, itertools.repeat(method)))
+
+    data, mask, uncertainty = (np.load(os.path.join(store.directory, 'combined_' + name + '.npy'))
+                               for name in ('data', 'mask', 'uncertainty'))
+    combined = CCDData(data, mask=mask, uncertainty=StdDevUncertainty(uncertainty), unit=store.metas[0].unit)
+    combined.meta['NCOMBINE'] = len(store)
+    return combined
@@ -0,0 +1,203 @@
+"""
+Distortion correction with IRAF geomap databases like the shipped notcam.db. The surfaces of a record are evaluated
+once into a displacement map for every band and image shape (binning), the resampling itself happens together with
+the reprojection, see resample.reproject_frame, so every frame is only interpolated once
+"""
+import functools
+import logging
+import os
+from collections import namedtuple
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.ndimage as ndimage
+from astropy.io.fits import Header
+from numpy.polynomial import chebyshev, legendre, polynomial
+
+from .calibration_cache import CalibrationCache
+from .classifier_common import Band, Instrument
+from .frame_store import ArrayHandle, resolve
+from .image_type_classifier import band, determine_instrument
+
+this_dir, this_file = os.path.split(__file__)
+default_db = os.path.join(this_dir, 'notcam.db')
+
+# records in the database for each band
+notcam_records = {Band.J: 'dist-j.dat', Band.H: 'dist-h.dat', Band.Ks: 'dist-k.dat'}
+
+Surface = namedtuple('Surface', ['function', 'xorder', 'yorder', 'xterms', 'xmin', 'xmax', 'ymin', 'ymax',
+                                 'coefficients'])
+Surface.__doc__ = """
+one IRAF gsurfit surface. function: 1 chebyshev, 2 legendre, 3 power series. xterms: 0 none, 1 full, 2 half
+"""
+GeomapRecord = namedtuple('GeomapRecord', ['name', 'parameters', 'x_surfaces', 'y_surfaces'])
+GeomapRecord.__doc__ = """
+one 'begin' block of a geomap database. The surfaces map reference (corrected) coordinates to input (raw)
+coordinates, x_surfaces/y_surfaces are summed up (linear part + residual distortion)
+"""
+
+_vander = {1: chebyshev.chebvander, 2: legendre.legvander, 3: polynomial.polyvander}
+
+
+def parse_surface(values: Sequence[float]) -> Surface:
+    """
+    :param values: one column of a surface in a geomap database: type, xorder, yorder, xterms, xmin, xmax, ymin, ymax,
+                   coefficients
+    """
+    function, xorder, yorder, xterms = (int(value) for value in values[:4])
+    if function not in _vander:
+        raise ValueError(f'unknown surface type {function}')
+    return Surface(function, xorder, yorder, xterms, *values[4:8], np.array(values[8:], dtype=np.float64))
+
+
+def read_geomap_db(path: str) -> Dict[str, GeomapRecord]:
+    """
+    parse a geomap database
+    :param path: database file
+    :return: records by name
+    """
+    records = dict()
+    with open(path) as f:
+        lines = [line.split() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+    name, parameters, surfaces = None, dict(), []
+    index = 0
+    while index < len(lines):
+        key, *values = lines[index]
+        index += 1
+        if key == 'begin':
+            if name is not None:
+                records[name] = GeomapRecord(name, parameters, [s[0] for s in surfaces], [s[1] for s in surfaces])
+            name, parameters, surfaces = values[0], dict(), []
+        elif key.startswith('surface'):
+            rows = lines[index:index + int(values[0])]
+            index += int(values[0])
+            columns = np.array(rows, dtype=np.float64).T
+            surfaces.append((parse_surface(columns[0]), parse_surface(columns[1])))
+        else:
+            parameters[key] = values[0] if len(values) == 1 else values
+    if name is not None:
+        records[name] = GeomapRecord(name, parameters, [s[0] for s in surfaces], [s[1] for s in surfaces])
+    return records
+
+
+def _terms(surface: Surface) -> List[Tuple[int, int]]:
+    """(x power, y power) for every coefficient in the order of gsurfit, x varying fastest"""
+    if surface.xterms == 0:
+        return [(i, 0) for i in range(surface.xorder)] + [(0, j) for j in range(1, surface.yorder)]
+    max_order = max(surface.xorder, surface.yorder)
+    return [(i, j) for j in range(surface.yorder) for i in range(surface.xorder)
+            if surface.xterms == 1 or i + j < max_order]
+
+
+def evaluate_surface(surface: Surface, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """value of the surface at IRAF (1 based) coordinates x, y"""
+    x_normalized = (2 * np.asarray(x, dtype=np.float64) - (surface.xmax + surface.xmin)) / (surface.xmax - surface.xmin)
+    y_normalized = (2 * np.asarray(y, dtype=np.float64) - (surface.ymax + surface.ymin)) / (surface.ymax - surface.ymin)
+    x_basis = _vander[surface.function](x_normalized, surface.xorder - 1)
+    y_basis = _vander[surface.function](y_normalized, surface.yorder - 1)
+
+    terms = _terms(surface)
+    if len(terms) != len(surface.coefficients):
+        raise ValueError(f'surface has {len(surface.coefficients)} coefficients but needs {len(terms)}')
+    result = sum(coefficient * x_basis[..., i] * y_basis[..., j]
+                 for (i, j), coefficient in zip(terms, surface.coefficients))
+    return np.reshape(result, np.broadcast(x_normalized, y_normalized).shape)
+
+
+def transform(record: GeomapRecord, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """raw (x, y) for corrected (x, y), both IRAF coordinates"""
+    return (sum(evaluate_surface(surface, x, y) for surface in record.x_surfaces),
+            sum(evaluate_surface(surface, x, y) for surface in record.y_surfaces))
+
+
+def displacement_map(record: GeomapRecord, shape: Sequence[int]) -> np.ndarray:
+    """
+    displacement from corrected to raw pixel for every pixel of an image. The surfaces are defined on the unbinned
+    detector, smaller images are taken as binned
+
+    :param record: geomap record
+    :param shape: image shape
+    :return: (2, rows, columns), raw[:, r, c] = (r, c) + displacement[:, r, c] in numpy pixels
+    """
+    surface = record.x_surfaces[0]
+    binning = np.array([(surface.ymax - surface.ymin + 1) / shape[0], (surface.xmax - surface.xmin + 1) / shape[1]])
+    rows, columns = np.indices(shape, dtype=np.float64)
+    # numpy pixel index -> unbinned IRAF coordinate and back
+    x_raw, y_raw = transform(record, (columns + 0.5) * binning[1] + 0.5, (rows + 0.5) * binning[0] + 0.5)
+    return np.stack([(y_raw - 0.5) / binning[0] - 0.5 - rows, (x_raw - 0.5) / binning[1] - 0.5 - columns])
+
+
+@functools.lru_cache(maxsize=4)
+def _read_cached(path: str, mtime: float) -> Dict[str, GeomapRecord]:
+    return read_geomap_db(path)
+
+
+def geomap_record(name: str, db_path: str = default_db) -> GeomapRecord:
+    """a record from a database, the database only gets parsed once per process"""
+    records = _read_cached(os.path.abspath(db_path), os.path.getmtime(db_path))
+    if name not in records:
+        raise ValueError(f'no record {name} in {db_path}')
+    return records[name]
+
+
+class DistortionMap:
+    """
+    displacement map of a geomap record for one image shape in a .npy file, so the workers can memory map it.
+    Only the name and a handle get pickled
+    """
+
+    def __init__(self, name: str, handle: ArrayHandle):
+        self.name = name
+        self.handle = handle
+
+    @classmethod
+    def create(cls, name: str, shape: Sequence[int], db_path: str = default_db, directory: Optional[str] = None,
+               cache: Optional[CalibrationCache] = None) -> 'DistortionMap':
+        """
+        :param name: record in the database
+        :param shape: image shape
+        :param db_path: geomap database
+        :param directory: where to put the map, e.g. FrameStore.directory. Ignored if cache is passed
+        :param cache: keep the map in this cache, keyed by database content, record and shape
+        """
+        def factory():
+            return displacement_map(geomap_record(name, db_path), shape)
+
+        if cache is not None:
+            handle = cache.get('distortion', factory, [db_path], record=name, shape=tuple(shape))
+        else:
+            path = os.path.join(directory, 'distortion.npy')
+            np.save(path, factory())
+            handle = ArrayHandle(path)
+        return cls(name, handle)
+
+    @property
+    def displacement(self) -> np.ndarray:
+        return resolve(self.handle)
+
+    def raw_coordinates(self, coordinates: np.ndarray) -> np.ndarray:
+        """
+        :param coordinates: (2, ...) corrected numpy pixel coordinates
+        :return: where they are in the raw frame
+        """
+        displacement = self.displacement
+        return coordinates + np.stack([ndimage.map_coordinates(displacement[axis], coordinates, order=1,
+                                                               mode='nearest') for axis in range(2)])
+
+
+def notcam_distortion(header: Header, shape: Sequence[int], db_path: str = default_db,
+                      directory: Optional[str] = None,
+                      cache: Optional[CalibrationCache] = None) -> Optional[DistortionMap]:
+    """
+    distortion map for a frame, None if there is no model for its instrument and band
+    :param header: header of one of the frames
+    :param shape: image shape
+    :param db_path: geomap database with dist-j.dat/dist-h.dat/dist-k.dat records
+    :param directory: see DistortionMap.create
+    :param cache: see DistortionMap.create
+    """
+    if determine_instrument(header) != Instrument.NOTCAM or band(header) not in notcam_records:
+        logging.warning('no distortion model for this instrument/band, skipping distortion correction')
+        return None
+    return DistortionMap.create(notcam_records[band(header)], shape, db_path, directory, cache)
@@ -0,0 +1,224 @@
+"""
+Memory mapped storage for stacks of equally sized frames. Pool workers only get small handles and open the
+scratch files themselves, so the pixel data is not pickled back and forth between the processes at every step.
+Only headers, WCS and units cross the process boundary.
+"""
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+from collections import namedtuple
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import CCDData, StdDevUncertainty
+from numpy.lib.format import open_memmap
+
+# which frame in which store
+FrameHandle = namedtuple('FrameHandle', ['directory', 'index'])
+# a single array that is the same for all frames, e.g. combined bad pixel mask
+ArrayHandle = namedtuple('ArrayHandle', ['path'])
+# a single frame with unit and header, e.g. the master flat
+CCDHandle = namedtuple('CCDHandle', ['path', 'header', 'unit'])
+# everything except the pixels
+FrameMeta = namedtuple('FrameMeta', ['header', 'wcs', 'unit', 'has_uncertainty'])
+
+shm_dir = '/dev/shm'
+
+
+def scratch_dir(required_bytes: int = 0) -> Optional[str]:
+    """
+    Where to put the scratch files: tmpfs if it has enough room, so the data never needs to hit the disk,
+    otherwise the default temporary directory
+    """
+    if os.path.isdir(shm_dir) and os.access(shm_dir, os.W_OK):
+        stat = os.statvfs(shm_dir)
+        if stat.f_bavail * stat.f_frsize > 2 * required_bytes:
+            return shm_dir
+    return None
+
+
+def _paths(directory: str) -> Tuple[str, str, str]:
+    return (os.path.join(directory, 'data.npy'),
+            os.path.join(directory, 'mask.npy'),
+            os.path.join(directory, 'uncertainty.npy'))
+
+
+def open_stack(directory: str, mode: str = 'r') -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get memory mapped (frames, rows, columns) arrays of data, mask and uncertainty of a whole store
+    :param directory: directory of the store
+    :param mode: mmap_mode for numpy.load
+    :return: (data, mask, uncertainty)
+    """
+    return tuple(np.load(path, mmap_mode=mode) for path in _paths(directory))
+
+
+def open_frame(handle: FrameHandle, mode: str = 'r+') -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get memory mapped views of data, mask and uncertainty of a frame. Changes to them end up in the store
+    :param handle: which frame to open
+    :param mode: mmap_mode for numpy.load
+    :return: (data, mask, uncertainty)
+    """
+    return tuple(array[handle.index] for array in open_stack(handle.directory, mode))
+
+
+def resolve(arg):
+    """turn array/ccd handles back into (memory mapped) arrays/CCDData, leave anything else as it is"""
+    if isinstance(arg, ArrayHandle):
+        return np.load(arg.path, mmap_mode='r')
+    if isinstance(arg, CCDHandle):
+        return CCDData(np.load(arg.path, mmap_mode='r'), header=arg.header, unit=arg.unit)
+    return arg
+
+
+def frame_ccd(handle: FrameHandle, meta: FrameMeta, mode: str = 'r+') -> CCDData:
+    """CCDData that is backed by the store, no copy of the data involved"""
+    data, mask, uncertainty = open_frame(handle, mode)
+    return CCDData(data, mask=mask, uncertainty=StdDevUncertainty(uncertainty) if meta.has_uncertainty else None,
+                   header=meta.header, wcs=meta.wcs, unit=meta.unit)
+
+
+def write_frame(handle: FrameHandle, ccd: CCDData) -> FrameMeta:
+    """
+    Put the data of ccd into the store
+    :return: the new metadata of the frame
+    """
+    data, mask, uncertainty = open_frame(handle, 'r+')
+    if not ccd.shape == data.shape:
+        raise ValueError('image dimension mismatch', ccd)
+
+    data[...] = ccd.data
+    mask[...] = ccd.mask if ccd.mask is not None else False
+    if ccd.uncertainty is not None:
+        uncertainty[...] = ccd.uncertainty.array
+    return FrameMeta(ccd.header, ccd.wcs, ccd.unit, ccd.uncertainty is not None)
+
+
+def _read_into(path: str, handle: FrameHandle) -> FrameMeta:
+    return write_frame(handle, CCDData.read(path))
+
+
+def _apply(fun: Callable, handle: FrameHandle, meta: FrameMeta, args: Sequence) -> FrameMeta:
+    result = fun(frame_ccd(handle, meta), *map(resolve, args))
+    return write_frame(handle, result)
+
+
+def _apply_reduce(fun: Callable, handle: FrameHandle, meta: FrameMeta, args: Sequence):
+    return fun(frame_ccd(handle, meta, 'r'), *map(resolve, args))
+
+
+class FrameStore:
+    """
+    A stack of frames in memory mapped .npy files in a scratch directory, tmpfs if possible.
+
+    Use it as a context manager or call close() to get rid of the scratch files.
+    """
+
+    def __init__(self, n_frames: int, shape: Tuple[int, int], directory: Optional[str] = None):
+        self.shape = (n_frames,) + tuple(shape)
+        required_bytes = int(np.prod(self.shape)) * (8 + 8 + 1)
+        self.directory = tempfile.mkdtemp(prefix='ir_reduce_', dir=directory or scratch_dir(required_bytes))
+
+        data_path, mask_path, uncertainty_path = _paths(self.directory)
+        self.data = open_memmap(data_path, 'w+', np.float64, self.shape)
+        self.mask = open_memmap(mask_path, 'w+', bool, self.shape)
+        self.uncertainty = open_memmap(uncertainty_path, 'w+', np.float64, self.shape)
+        self.metas = [FrameMeta(fits.Header(), None, None, False)] * n_frames
+
+    @classmethod
+    def from_ccds(cls, ccds: Sequence[CCDData], directory: Optional[str] = None) -> 'FrameStore':
+        store = cls(len(ccds), ccds[0].shape, directory)
+        store.metas = [write_frame(handle, ccd) for handle, ccd in zip(store.handles(), ccds)]
+        return store
+
+    @classmethod
+    def read(cls, paths: Sequence[str], pool, directory: Optional[str] = None) -> 'FrameStore':
+        """
+        Read fits files directly into a new store from the worker processes
+        :param paths: files to read, the dimensions are taken from the first one
+        :param pool: multiprocessing pool or PoolDummy
+        :param directory: where to put the scratch files
+        """
+        header = fits.getheader(paths[0])
+        store = cls(len(paths), (header['NAXIS2'], header['NAXIS1']), directory)
+        store.metas = list(pool.starmap(_read_into, zip(paths, store.handles())))
+        return store
+
+    @classmethod
+    def load(cls, directory: str, scratch: Optional[str] = None) -> 'FrameStore':
+        """
+        copy of a store that was saved with save
+        :param directory: where it was saved to
+        :param scratch: where to put the scratch files of the copy
+        """
+        saved = open_stack(directory, 'r')
+        store = cls(len(saved[0]), saved[0].shape[1:], scratch)
+        for array, saved_array in zip((store.data, store.mask, store.uncertainty), saved):
+            array[...] = saved_array
+        with open(os.path.join(directory, 'metas.pickle'), 'rb') as f:
+            store.metas = pickle.load(f)
+        return store
+
+    def save(self, directory: str) -> None:
+        """copy the frames and their metadata to an existing directory, see load"""
+        for array, path in zip((self.data, self.mask, self.uncertainty), _paths(self.directory)):
+            array.flush()
+            shutil.copyfile(path, os.path.join(directory, os.path.basename(path)))
+        with open(os.path.join(directory, 'metas.pickle'), 'wb') as f:
+            pickle.dump(self.metas, f)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def handles(self) -> List[FrameHandle]:
+        return [FrameHandle(self.directory, index) for index in range(len(self))]
+
+    def put(self, name: str, array: np.ndarray) -> ArrayHandle:
+        """store an array that is shared by all frames so it does not need to be pickled for every task"""
+        path = os.path.join(self.directory, name + '.npy')
+        np.save(path, array)
+        return ArrayHandle(path)
+
+    def put_ccd(self, name: str, ccd: CCDData) -> CCDHandle:
+        return CCDHandle(self.put(name, ccd.data).path, ccd.header, ccd.unit)
+
+    def to_ccd(self, index: int) -> CCDData:
+        """view of a frame as CCDData. Only valid as long as the store is not closed"""
+        return frame_ccd(FrameHandle(self.directory, index), self.metas[index])
+
+    def to_ccds(self) -> List[CCDData]:
+        return [self.to_ccd(index) for index in range(len(self))]
+
+    def map(self, fun: Callable[..., CCDData], pool, *args) -> None:
+        """
+        Replace every frame with fun(frame, *args) in place. Runs in the worker processes, arguments that are
+        ArrayHandle/CCDHandle get resolved there
+
+        :param fun: picklable function CCDData -> CCDData, output needs to have the same shape
+        :param pool: multiprocessing pool or PoolDummy
+        :param args: extra arguments for fun, same for all frames
+        """
+        self.starmap(fun, pool, itertools.repeat(args))
+
+    def starmap(self, fun: Callable[..., CCDData], pool, args: Iterable[Sequence]) -> None:
+        """like map, but with a separate tuple of extra arguments for every frame"""
+        self.metas = list(pool.starmap(_apply, zip(itertools.repeat(fun), self.handles(), self.metas, args)))
+
+    def map_reduce(self, fun: Callable, pool, *args) -> list:
+        """like map, but don't change the frames and return whatever fun returns instead"""
+        return list(pool.starmap(_apply_reduce, zip(itertools.repeat(fun), self.handles(), self.metas,
+                                                    itertools.repeat(args))))
+
+    def close(self) -> None:
+        self.data = self.mask = self.uncertainty = None
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,46 @@
+"""
+FITS_LDAC catalogs as SExtractor writes and scamp reads them: an empty primary HDU, the header of the image the
+catalog belongs to as one string in LDAC_IMHEAD and the sources in LDAC_OBJECTS
+"""
+from typing import Sequence, Tuple
+
+import numpy as np
+from astropy.io import fits
+
+
+def imhead_hdu(header: fits.Header) -> fits.BinTableHDU:
+    cards = header.tostring(endcard=True, padding=False)
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name='Field Header Card', format=f'{len(cards)}A',
+                                                     array=np.array([cards]))])
+    hdu.header['TDIM1'] = f'(80, {len(cards) // 80})'
+    hdu.header['EXTNAME'] = 'LDAC_IMHEAD'
+    return hdu
+
+
+def ldac_hdus(header: fits.Header, columns: Sequence[fits.Column]) -> fits.HDUList:
+    objects = fits.BinTableHDU.from_columns(columns)
+    objects.header['EXTNAME'] = 'LDAC_OBJECTS'
+    return fits.HDUList([fits.PrimaryHDU(), imhead_hdu(header), objects])
+
+
+def write_ldac(path: str, header: fits.Header, columns: Sequence[fits.Column]) -> None:
+    ldac_hdus(header, columns).writeto(path, overwrite=True)
+
+
+def read_ldac(path: str) -> Tuple[fits.Header, fits.FITS_rec]:
+    """
+    image header and sources of a FITS_LDAC catalog. Plain FITS tables work too, their header is empty then
+    :raises ValueError: if there is no table in the file
+    """
+    with fits.open(path) as hdus:
+        tables = [hdu for hdu in hdus if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU))]
+        objects = [hdu for hdu in tables if hdu.name == 'LDAC_OBJECTS'] or \
+                  [hdu for hdu in tables if hdu.name != 'LDAC_IMHEAD']
+        if not objects:
+            raise ValueError(f'no table in {path}')
+        header = fits.Header()
+        if 'LDAC_IMHEAD' in hdus:
+            # one string or split into cards by TDIM, with the trailing blanks of every card stripped
+            cards = np.atleast_1d(hdus['LDAC_IMHEAD'].data[0][0])
+            header = fits.Header.fromstring(''.join(str(card).ljust(80) for card in cards))
+        return header, objects[0].data.copy()
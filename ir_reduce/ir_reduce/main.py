@@ -2,11 +2,13 @@
 Module for reducing infrared Data, currently for NOTCam but intended for a future instrument
 """
 import itertools
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 from multiprocessing import Pool, \
     cpu_count
-from typing import List, Tuple, Iterable, Union, Dict, Sequence
+from typing import List, Tuple, Iterable, Union, Dict, Sequence, Optional
 
 import astropy
 import astropy.wcs
@@ -15,13 +17,23 @@ import numpy as np
 from astropy import units as u
 from astropy.io import fits
 from astropy.nddata import CCDData
-from astropy.stats import SigmaClip
 from numpy import s_  # numpy helper to create slices by indexing this
 
+from .bad_pixels import apply_plan, cached_plan, fix_pix_data
+from .calibration import gain_readnoise, batch_process, batch_process_store, normalized_flat, quadrant_reduction
+from .calibration_cache import CalibrationCache, cached_quadrant_maps
+from .checkpoint import Checkpoints, Stage, run_stages, stage_keys
+from .combine import tile_combine
+from .distortion import notcam_distortion
+from .frame_store import FrameStore, resolve
+from .registration import register
+from .resample import ReprojectionContext, default_tolerance, log_paths, reproject_frame
+from .sky import clipped_sky, running_sky, running_sky_rows
 from .image_discovery import ImageGroup
 # noinspection PyUnresolvedReferences
 from .image_type_classifier import Category, image_category, Band, band, determine_instrument  # noqa
-from .run_sextractor_scamp import run_astroref, Config
+from .astroref_async import run_astroref_pipelined
+from .run_sextractor_scamp import map_isolated, run_astroref, run_astroref_batch, Config
 
 n_cpu = cpu_count()  # creating a global pool here does not work as the workers import this exact file,
 
@@ -68,66 +80,132 @@ class PoolDummy:
 # object_ID = 'OBJECT'
 
 
-def read_and_sort(bads: Iterable[str], flats: Iterable[str], exposures: Iterable[str],
-                  pool: Union[PoolDummy, Pool] = PoolDummy()) -> Dict[Band, ImageGroup]:
+def sort_paths(bads: Iterable[str], flats: Iterable[str], exposures: Iterable[str],
+               pool: Union[PoolDummy, Pool] = PoolDummy(),
+               band_id: Optional[Band] = None,
+               exposure_headers: Optional[Sequence[fits.Header]] = None) -> Dict[Band, ImageGroup]:
     """
-    read in images and sort them by filter, return the CCDDatas
+    Sort files by filter by only reading their primary headers. Logs how much data belongs to other bands
 
     :param bads: list of paths to bad pixel frames
     :param flats: list of paths to flat frames
     :param exposures: list of paths to images
-    :param pool: funnily enough this benefits from multiprocessing
-    :return: A dictionary which maps filter-id -> [bads, flats, images]
+    :param pool: optional process pool
+    :param band_id: only keep the flats and images for this band. If None, keep everything
+    :param exposure_headers: primary headers of the exposures if the caller already read them, in the same order
+    :return: A dictionary which maps filter-id -> [bads, flats, images] (paths)
     """
+    bads, flats, exposures = list(bads), list(flats), list(exposures)
     # TODO move asserts into unit-test or introduce a validation flag/wrapper
     for path in itertools.chain(bads, flats, exposures):
         if not os.path.isfile(path):
             assert False, 'path ' + path + ' does not seem to exist'
 
-    image_promise = pool.map_async(astropy.nddata.CCDData.read, exposures)
-    flat_promise = pool.map_async(astropy.nddata.CCDData.read, flats)
-    bad_promise = pool.map_async(astropy.nddata.CCDData.read, bads)
-    image_datas = list(image_promise.get())
-    flat_datas = list(flat_promise.get())
-    bad_datas = list(bad_promise.get())
+    image_header_promise = pool.map_async(fits.getheader, exposures if exposure_headers is None else [])
+    flat_header_promise = pool.map_async(fits.getheader, flats)
+    bad_header_promise = pool.map_async(fits.getheader, bads)
+    image_headers = list(image_header_promise.get() if exposure_headers is None else exposure_headers)
+    flat_headers = list(flat_header_promise.get())
+    bad_headers = list(bad_header_promise.get())
 
-    ret = dict()
     # make sure all images are from the same instrument with set comprehension
-    assert len({determine_instrument(image) for image in itertools.chain(image_datas, flat_datas, bad_datas)}) == 1, \
+    assert len({determine_instrument(header) for header in
+                itertools.chain(image_headers, flat_headers, bad_headers)}) == 1, \
         'Cannot mix images from different instruments'  # TODO allow this in some cases?
 
-    # for all filter present in science data we need at least a flatImage and a bad pixel image
-    for band_id in Band:
-        images_with_filter = [image for image in image_datas if band(image) == band_id]
+    bands = [band_id] if band_id else list(Band)
+    image_bands = [band(header) for header in image_headers]
+    flat_bands = [band(header) for header in flat_headers]
+
+    skipped = [path for path, path_band in zip(itertools.chain(exposures, flats), image_bands + flat_bands)
+               if path_band not in bands]
+    if skipped:
+        logging.info(f'skipped reading {len(skipped)} frames ({sum(map(os.path.getsize, skipped))} bytes) '
+                     f'not in band {band_id}')
 
+    ret = dict()
+    # for all filter present in science data we need at least a flatImage and a bad pixel image
+    for band_key in bands:
         # only science images allowed. TODO this assumes that classification works but can screw over manual mode
         # Maybe adding a check for manual would solve it, but it's not that critical
         # assert all((image_category(image) == Category.IMAGING for image in images_with_filter))
-
-        flats_with_filter = [image for image in flat_datas if band(image) == band_id]
+        images_with_filter = [path for path, image_band in zip(exposures, image_bands) if image_band == band_key]
 
         # see comment on the other assertion
         # assert all((image_category(img) == Category.FLAT for img in flats_with_filter))
 
         # assert (len(flats_with_filter) == 1)  # TODO only one flat?
         # TODO this assumes that you pass all possible flats. But CLI only wants one flat right now
+        flats_with_filter = [path for path, flat_band in zip(flats, flat_bands) if flat_band == band_key]
 
         # bad pixel maps are valid, no matter the filter
-        ret[band_id] = ImageGroup(bad_datas, flats_with_filter, images_with_filter)
+        ret[band_key] = ImageGroup(bads, flats_with_filter, images_with_filter)
 
     return ret
 
 
+def read_and_sort(bads: Iterable[str], flats: Iterable[str], exposures: Iterable[str],
+                  pool: Union[PoolDummy, Pool] = PoolDummy(),
+                  band_id: Optional[Band] = None) -> Dict[Band, ImageGroup]:
+    """
+    read in images and sort them by filter, return the CCDDatas
+
+    Only the primary headers are read at first to classify the frames (see sort_paths). The pixel data is then only
+    loaded for the frames that belong to the requested band.
+
+    :param bads: list of paths to bad pixel frames
+    :param flats: list of paths to flat frames
+    :param exposures: list of paths to images
+    :param pool: funnily enough this benefits from multiprocessing
+    :param band_id: only load the flats and images for this band. If None, load everything
+    :return: A dictionary which maps filter-id -> [bads, flats, images]
+    """
+    sorted_paths = sort_paths(bads, flats, exposures, pool, band_id)
+
+    image_paths = list(itertools.chain.from_iterable(group.images for group in sorted_paths.values()))
+    flat_paths = list(itertools.chain.from_iterable(group.flat for group in sorted_paths.values()))
+    bad_paths = list(bads)
+
+    image_promise = pool.map_async(astropy.nddata.CCDData.read, image_paths)
+    flat_promise = pool.map_async(astropy.nddata.CCDData.read, flat_paths)
+    bad_promise = pool.map_async(astropy.nddata.CCDData.read, bad_paths)
+    read = dict(zip(image_paths, image_promise.get()))
+    read.update(zip(flat_paths, flat_promise.get()))
+    bad_datas = list(bad_promise.get())
+
+    return {band_key: ImageGroup(bad_datas, [read[path] for path in group.flat], [read[path] for path in group.images])
+            for band_key, group in sorted_paths.items()}
+
+
+def read_calibrations(bad_paths: Sequence[str], flat_path: str, pool: Union[PoolDummy, Pool] = PoolDummy(),
+                      cache: Optional[CalibrationCache] = None) -> Tuple[List[CCDData], CCDData]:
+    """
+    read the bad pixel frames and the flat. If a cache is passed, the combined bad pixel mask and the normalized
+    flat are taken from it and the files are only read if they are not in there yet.
+
+    :param bad_paths: bad pixel frames
+    :param flat_path: master flat
+    :param pool: optional process pool
+    :param cache: optional calibration cache
+    :return: (bads, flat)
+    """
+    if cache is None:
+        bad_promise = pool.map_async(astropy.nddata.CCDData.read, bad_paths)
+        flat = astropy.nddata.CCDData.read(flat_path)
+        return list(bad_promise.get()), flat
+
+    bads = []
+    if bad_paths:
+        bad = cache.load('bad_mask', lambda: combine_bads(pool.map(astropy.nddata.CCDData.read, bad_paths)),
+                         bad_paths)
+        bads = [CCDData(bad, unit=u.dimensionless_unscaled)]
+    flat = cache.load('flat_normed', lambda: normalized_flat(astropy.nddata.CCDData.read(flat_path)), [flat_path])
+    return bads, CCDData(flat, unit=u.dimensionless_unscaled)
+
+
 def single_reduction(image, bad, flat):
     image.mask = bad
-    if "GAIN" in image.header:  # ALF
-        gain = image.header['GAIN']
-        readnoise = image.header['RDNOISE']
-    else:  # NOTCAM
-        # TODO that's from the quicklook-package, probably would want to do this individually for every sensor area
-        gain = (image.header['GAIN1'] + image.header['GAIN2'] + image.header['GAIN3'] + image.header['GAIN4']) / 4
-        readnoise = (image.header['RDNOISE1'] + image.header['RDNOISE2'] + image.header['RDNOISE3'] + image.header[
-            'RDNOISE4']) / 4
+    gain, readnoise = gain_readnoise(image.header)
 
     reduced = ccdproc.ccd_process(image,
                                   oscan=None,
@@ -142,177 +220,204 @@ def single_reduction(image, bad, flat):
     return reduced
 
 
-def standard_process(bads: List[CCDData], flat: CCDData, images: List[CCDData],
-                     pool: Union[PoolDummy, Pool] = PoolDummy()) -> List[CCDData]:
+def combine_bads(bads: List[CCDData]) -> Optional[np.ndarray]:
+    """combine bad pixel masks, None if there are none"""
+    if bads:
+        return reduce(lambda x, y: x.astype(bool) | y.astype(bool), (i.data for i in bads))
+    else:
+        return None
+
+
+def standard_process(bads: List[CCDData], flat: CCDData, images: Union[List[CCDData], FrameStore],
+                     pool: Union[PoolDummy, Pool] = PoolDummy(),
+                     method: str = 'ccdproc',
+                     cache: Optional[CalibrationCache] = None) -> Union[List[CCDData], FrameStore]:
     """
     Do the ccdproc operation on a list of images. includes some extra logic for NOTCAM images to get the
     gain and readnoise out of the headers
     :param bads:
     :param flat:
-    :param images:
+    :param images: list of images or a FrameStore, which gets processed in place
     :param pool: optional process pool
+    :param method: 'ccdproc' to call ccdproc.ccd_process for every image, 'batch' to calibrate the whole stack
+    with numpy at once or 'quadrant' to use the gain/readnoise per amplifier (see tiled_process)
+    :param cache: calibration cache for the 'quadrant' gain maps
     :return:
     """
-    if bads:
-        bad = reduce(lambda x, y: x.astype(bool) | y.astype(bool), (i.data for i in bads))  # combine bad pixel masks
-    else:
-        bad = None
+    if method == 'quadrant':
+        return tiled_process(bads, flat, images, pool, cache)
+
+    bad = combine_bads(bads)
+    if method == 'batch':
+        if isinstance(images, FrameStore):
+            return batch_process_store(bad, flat, images, pool)
+        return batch_process(bad, flat, list(images))
+    elif not method == 'ccdproc':
+        raise ValueError('method needs to be either ccdproc, batch or quadrant')
+
+    if isinstance(images, FrameStore):
+        images.map(single_reduction, pool, images.put('bad', bad) if bad is not None else None,
+                   images.put_ccd('flat', flat))
+        return images
     return list(pool.starmap(single_reduction, zip(images, itertools.repeat(bad), itertools.repeat(flat))))
 
 
-def tiled_process(bads: List[CCDData], flat: CCDData, images: List[CCDData]) -> List[CCDData]:
+def tiled_process(bads: List[CCDData], flat: CCDData, images: Union[List[CCDData], FrameStore],
+                  pool: Union[PoolDummy, Pool] = PoolDummy(),
+                  cache: Optional[CalibrationCache] = None) -> Union[List[CCDData], FrameStore]:
     """
-    Do the ccdproc operation on a list of images. includes some extra logic for NOTCAM images to get the
-    gain and readnoise out of the headers
+    Like standard_process, but use the gain and readnoise of each of the four NOTCAM amplifiers for its quadrant
+    instead of the average.
     :param bads:
     :param flat:
-    :param images:
+    :param images: list of images or a FrameStore, which gets processed in place
+    :param pool: optional process pool
+    :param cache: take the gain/readnoise maps from here
     :return:
     """
-    if bads:
-        bad = reduce(lambda x, y: x.astype(bool) | y.astype(bool), (i.data for i in bads))  # combine bad pixel masks
+    bad = combine_bads(bads)
+    flat_normed = normalized_flat(flat)
+
+    if isinstance(images, FrameStore):
+        metas, shape = images.metas, images.shape[1:]
+        bad_flat = (images.put('bad', bad) if bad is not None else None, images.put('flat_normed', flat_normed))
+    else:
+        images = list(images)
+        metas, shape = images, images[0].shape if images else None
+        bad_flat = (bad, flat_normed)
+
+    if cache is not None:
+        maps = [cached_quadrant_maps(cache, meta.header, shape) for meta in metas]
+        if not isinstance(images, FrameStore):
+            maps = [tuple(map(resolve, handles)) for handles in maps]
+        args = [bad_flat + frame_maps for frame_maps in maps]
     else:
-        bad = None
-
-    reduceds = []
-    for image in images:
-        image.mask = bad
-        # TODO this is really sketchy as it does 4x the work
-        # Tiling: http://www.not.iac.es/instruments/notcam/guide/observe.html#reductions
-        # 0-> LL, 1->LR, 2->UR, 3->UL
-        tile_table = [None, s_[512:, 0:512], s_[512:, 512:], s_[0:512, 512:], s_[0:512, 0:512]]
-        reduced = image.copy()
-
-        for idx in range(1, 5):
-            gain = image.header['GAIN' + str(idx)]
-            readnoise = image.header['RDNOISE' + str(idx)]
-            tile = ccdproc.ccd_process(image,
-                                       oscan=None,
-                                       error=True,
-                                       gain=gain * u.electron / u.count,
-                                       # TODO check if this is right or counts->adu required
-                                       readnoise=readnoise * u.electron,
-                                       dark_frame=None,
-                                       master_flat=flat,
-                                       bad_pixel_mask=bad)
-            image.data[tile_table[idx]] = tile.data[tile_table[idx]]
-            reduced.header = tile.header
-            reduced.wcs = tile.wcs
-            reduced.unit = tile.unit
-        reduceds.append(reduced)
-    return reduceds
+        args = itertools.repeat(bad_flat)
+
+    if isinstance(images, FrameStore):
+        images.starmap(quadrant_reduction, pool, args)
+        return images
+    return list(pool.starmap(quadrant_reduction, ((image,) + frame_args for image, frame_args in zip(images, args))))
 
 
 def subtract(a, b):
-    return a.subtract(b)
+    return a.subtract(b, handle_meta='first_found')
+
+
+def divide(a, b):
+    return a.divide(b, handle_meta='first_found')
 
 
-def skyscale(image_list: Iterable[CCDData], method: str = 'subtract',
+def sky_region(image_list: Union[Sequence[CCDData], FrameStore], cut: Tuple[Union[slice, int]]) -> np.ndarray:
+    """the cut region of all images as a (frames, ...) array, for a FrameStore only the region is read"""
+    if isinstance(image_list, FrameStore):
+        return np.array(image_list.data[(slice(None),) + tuple(np.index_exp[cut])])
+    return np.stack([image.data[cut] for image in image_list])
+
+
+def skyscale(image_list: Union[Iterable[CCDData], FrameStore], method: str = 'subtract',
              pool: Union[PoolDummy, Pool] = PoolDummy(),
-             cut: Tuple[Union[slice, int]] = s_[200:800, 200:800]) -> List[CCDData]:
+             cut: Tuple[Union[slice, int]] = s_[200:800, 200:800],
+             window: int = 5) -> Union[List[CCDData], FrameStore]:
     """
-    Subtract/divide out the median sky value of some images
-    :param image_list: The images to process
-    :param method: either 'subtract' or 'divide'
+    Subtract/divide out the median sky value of some images. The sky level is the sigma clipped median of the cut
+    region, see sky.clipped_sky. It's stored with the clipped sigma and the rejected fraction in the
+    SKYLEVEL/SKYSIGMA/SKYREJ header keywords
+    :param image_list: The images to process in the order they were taken, a FrameStore gets processed in place
+    :param method: either 'subtract', 'divide' or 'running'. 'running' subtracts a sky image made of the masked
+                   median of the window temporally closest images, see sky.running_sky
     :param cut: what region of the images to consider to create the median sky value
     :param pool: optional multiprocessing pool
+    :param window: number of neighbouring images for the running sky
     :return: images, with sky removed
     """
-    sigma_clip = SigmaClip(sigma=3., maxiters=3)
-    filtered_data = pool.map(sigma_clip, (image.data for image in image_list))
-
-    medians = np.array(list(pool.map(np.median, (data[cut] for data in filtered_data))))
+    if method not in ('subtract', 'divide', 'running'):
+        raise ValueError('method needs to be either subtract, divide or running')
+    if not isinstance(image_list, FrameStore):
+        image_list = list(image_list)
+
+    sky_stats = clipped_sky(sky_region(image_list, cut))
+    headers = [meta.header for meta in image_list.metas] if isinstance(image_list, FrameStore) else \
+        [image.header for image in image_list]
+    for header, stats in zip(headers, sky_stats):
+        logging.info(f'sky level {stats.level:.2f} sigma {stats.sigma:.2f} rejected {stats.rejected:.3f}')
+        header['SKYLEVEL'] = stats.level
+        header['SKYSIGMA'] = stats.sigma
+        header['SKYREJ'] = stats.rejected
+    levels = np.array([stats.level for stats in sky_stats])
+
+    if method == 'running':
+        if isinstance(image_list, FrameStore):
+            return running_sky(image_list, window, pool)
+        data = np.stack([image.data for image in image_list]).astype(np.float64)
+        mask = np.stack([image.mask if image.mask is not None else np.zeros(image.shape, dtype=bool)
+                         for image in image_list])
+        running_sky_rows(data, mask, window)
+        return [CCDData(frame_data, mask=frame_mask, uncertainty=image.uncertainty, unit=image.unit,
+                        header=image.header, wcs=image.wcs)
+                for frame_data, frame_mask, image in zip(data, mask, image_list)]
     # airmass = sum((image.header['AIRMASS'] for image in image_list))  # TODO needed?
 
     # TODO from original code:
     # Calculate scaling relatively to last image median
     # Why not average or median-median?
     if method == 'subtract':
-        medians = (medians - medians[-1]) * u.electron
-        # ret = [CCDData.subtract(image, median * u.electron) for image, median in zip(image_list, medians)]
-        ret = pool.starmap(subtract, zip(image_list, medians))
-    elif method == 'divide':
-        medians = (medians / medians[-1]) * u.electron
-        # ret = [CCDData.subtract(image, median * u.electron) for image, median in zip(image_list, medians)]
-        ret = pool.starmap(subtract, zip(image_list, medians))
+        operation, operands = subtract, (levels - levels[-1]) * u.electron
     else:
-        raise ValueError('method needs to be either subtract or divide')
+        operation, operands = divide, (levels / levels[-1]) * u.dimensionless_unscaled
+
+    if isinstance(image_list, FrameStore):
+        image_list.starmap(operation, pool, ((operand,) for operand in operands))
+        return image_list
+    ret = pool.starmap(operation, zip(image_list, operands))
 
     # TODO: write/return sky file?
     return ret
 
 
 def fix_pix(img: CCDData) -> CCDData:
-    im = img.data
-    mask = img.mask
-    import scipy.ndimage as ndimage
     """
     taken from https://www.iaa.csic.es/~jmiguel/PANIC/PAPI/html/_modules/reduce/calBPM.html#fixPix
     (GPLv3)
 
     Applies a bad-pixel mask to the input image (im), creating an image with
-    masked values replaced with a bi-linear interpolation from nearby pixels.
+    masked values replaced with the average of the good pixels in the bounding box
+    of the (dilated) bad pixel domain.
     Probably only good for isolated badpixels.
 
-    Usage:
-      fixed = fixpix(im, mask, [iraf=])
-
-    Inputs:
-      im = the image array
-      mask = an array that is True (or >0) where im contains bad pixels
-      iraf = True use IRAF.fixpix; False use numpy and a loop over
-             all pixels (extremelly low)
-
-    Outputs:
-      fixed = the corrected image
+    The original looped over all pixels for every domain, this works on the bounding boxes
+    of all domains at once, see bad_pixels.fix_pix_data
 
     v1.0.0 Michael S. Kelley, UCF, Jan 2008
 
     v1.1.0 Added the option to use IRAF's fixpix.  MSK, UMD, 25 Apr
            2011
-
-    Notes
-    -----
-    - Non-IRAF algorithm is extremelly slow.
     """
-
-    # create domains around masked pixels
-    dilated = ndimage.binary_dilation(mask)
-    domains, n = ndimage.label(dilated)
-
-    # loop through each domain, replace bad pixels with the average
-    # from nearest neigboors
-    y, x = np.indices(im.shape, dtype=np.int)[-2:]
-    # x = xarray(im.shape)
-    # y = yarray(im.shape)
-    cleaned = im.copy()
-    for d in (np.arange(n) + 1):
-        # find the current domain
-        i = (domains == d)
-
-        # extract the sub-image
-        x0, x1 = x[i].min(), x[i].max() + 1
-        y0, y1 = y[i].min(), y[i].max() + 1
-        subim = im[y0: y1, x0: x1]
-        submask = mask[y0: y1, x0: x1]
-        # noinspection PyPep8
-        subgood = (submask == False)  # noqa
-
-        cleaned[i * mask] = subim[subgood].mean()
-
-    img.data = cleaned
+    if img.mask is None:
+        return img
+    img.data = fix_pix_data(img.data, img.mask.astype(bool))
     return img
 
 
-def interpolate(img: CCDData):
+def interpolate(img: CCDData, method: str = 'convolve') -> CCDData:
     """
     Takes a image with a mask for bad pixels and interpolates over the bad pixels
 
-    :param img: the image you want to interpolate bad pixels in
+    :param img: the image you want to interpolate bad pixels in. Pixels where the mask is False get interpolated
+    :param method: 'convolve': replace with the convolution of the surrounding pixels over the whole image,
+                   'bilinear'/'nearest': only look at the neighbourhood of bad pixels, see
+                   bad_pixels.interpolation_plan. The plan is cached per mask, so it's only built once for a stack
+                   sharing a bad pixel mask
     :return: interpolated image
 
     """
     # TODO combiner does not care about this and marks it invalid still
+    if method in ('bilinear', 'nearest'):
+        img.data = apply_plan(img.data, cached_plan(np.logical_not(img.mask), method))
+        return img
+    if method != 'convolve':
+        raise ValueError('method needs to be one of convolve, bilinear or nearest')
+
     from astropy.convolution import CustomKernel
     from astropy.convolution import interpolate_replace_nans
 
@@ -322,7 +427,7 @@ def interpolate(img: CCDData):
     kernel = CustomKernel(
         kernel_array)  # TODO the original pipeline used fixpix, which says it uses linear interpolation
 
-    img.data[np.logical_not(img.mask)] = np.NaN
+    img.data[np.logical_not(img.mask)] = np.nan
     img.data = interpolate_replace_nans(img.data, kernel)
 
     return img
@@ -346,16 +451,13 @@ def write_output(output: str, reffed_image: CCDData, scamp_data, sextractor_data
             print(err, "writing output failed")
 
 
-def do_everything(bads: Iterable[str],
-                  flats: Iterable[str],
-                  images: Iterable[str],
-                  output: str,
-                  band_id: Band = Band.J,  # TODO: allow 'all'
-                  combine: str = 'median',
-                  skyscale_method: str = 'subtract',
-                  astromatic_cfg: Config = Config.default(),
-                  single_thread: bool = False):
-    reduced_image = reduce_image(bads, flats, images, band_id, combine, skyscale_method, single_thread)
+def band_output(output: str, band_id: Band) -> str:
+    """name of the output of one band when reducing all of them, e.g. reduced_J.fits"""
+    name, ext = os.path.splitext(output)
+    return f'{name}_{band_id.name}{ext}'
+
+
+def _astroref_and_write(reduced_image: CCDData, output: str, astromatic_cfg: Config):
     reffed_image, scamp_data, sextractor_data, reference_catalog_data = astroref(reduced_image, config=astromatic_cfg)
 
     if output:
@@ -364,94 +466,249 @@ def do_everything(bads: Iterable[str],
     return reffed_image, scamp_data, sextractor_data
 
 
-def do_only_astroref(images: Sequence[str], output: Sequence[str], astromatic_cfg: Config):
-    for image, outname in zip(images, output):
+def do_everything(bads: Iterable[str],
+                  flats: Iterable[str],
+                  images: Iterable[str],
+                  output: str,
+                  band_id: Union[Band, str] = Band.J,
+                  combine: str = 'median',
+                  skyscale_method: str = 'subtract',
+                  astromatic_cfg: Config = Config.default(),
+                  single_thread: bool = False,
+                  calibration: str = 'ccdproc',
+                  cache_dir: Optional[str] = None,
+                  sky_window: int = 5,
+                  register_images: bool = False,
+                  distortion_correct: bool = False,
+                  checkpoint_dir: Optional[str] = None,
+                  pool: Union[PoolDummy, Pool, None] = None):
+    reduced_image = reduce_image(bads, flats, images, band_id, combine, skyscale_method, single_thread, calibration,
+                                 cache_dir, sky_window, register_images, distortion_correct, checkpoint_dir, pool)
+    if band_id != 'all':
+        return _astroref_and_write(reduced_image, output, astromatic_cfg)
+    # one output per band
+    return {band_key: _astroref_and_write(image, band_output(output, band_key) if output else output, astromatic_cfg)
+            for band_key, image in reduced_image.items()}
+
+
+def do_only_astroref(images: Sequence[str], output: Sequence[str], astromatic_cfg: Config,
+                     concurrent_jobs: Optional[int] = None, single_scamp: bool = False, pipelined: bool = False):
+    """
+    astroreference already reduced images, concurrent_jobs of them at the same time (default: one per CPU), each in
+    its own working directory
+    :param single_scamp: solve all images in one scamp run instead, see run_astroref_batch
+    :param pipelined: run SExtractor on the next image while scamp solves the previous one instead, concurrent_jobs
+                      SExtractor and scamp runs at a time (default: one), see astroref_pipeline
+    """
+    if single_scamp or pipelined:
+        read_images = [astropy.nddata.CCDData.read(image) for image in images]
+        reffed_images = astroref_batch(read_images, astromatic_cfg, concurrent_jobs) if single_scamp else \
+            astroref_pipelined(read_images, astromatic_cfg, concurrent_jobs or 1)
+        for outname, reffed in zip(output, reffed_images):
+            write_output(outname, *reffed)
+        return
+
+    def astroref_and_write(paths: Tuple[str, str], config: Config):
+        image, outname = paths
         read_image = astropy.nddata.CCDData.read(image)
-        reffed_image, scamp_data, sextractor_data, reference_catalog_data = astroref(read_image, astromatic_cfg)
+        reffed_image, scamp_data, sextractor_data, reference_catalog_data = astroref(read_image, config)
         write_output(outname, reffed_image, scamp_data, sextractor_data, reference_catalog_data)
 
+    map_isolated(astroref_and_write, zip(images, output), astromatic_cfg, concurrent_jobs)
+
 
 def do_only_reduce(bads: Iterable[str],
                    flats: Iterable[str],
                    images: Iterable[str],
                    output: str,
-                   band_id: Band = Band.J,  # TODO: allow 'all'
+                   band_id: Union[Band, str] = Band.J,
                    combine: str = 'median',
                    skyscale_method: str = 'subtract',
-                   single_thread: bool = False):
-    reduced_image = reduce_image(bads, flats, images, band_id, combine, skyscale_method, single_thread)
-    write_output(output, reduced_image, None, None, None)
+                   single_thread: bool = False,
+                   calibration: str = 'ccdproc',
+                   cache_dir: Optional[str] = None,
+                   sky_window: int = 5,
+                   register_images: bool = False,
+                   distortion_correct: bool = False,
+                   checkpoint_dir: Optional[str] = None,
+                   pool: Union[PoolDummy, Pool, None] = None):
+    reduced_image = reduce_image(bads, flats, images, band_id, combine, skyscale_method, single_thread, calibration,
+                                 cache_dir, sky_window, register_images, distortion_correct, checkpoint_dir, pool)
+    if band_id != 'all':
+        write_output(output, reduced_image, None, None, None)
+        return
+    for band_key, image in reduced_image.items():
+        write_output(band_output(output, band_key), image, None, None, None)
 
 
 def reduce_image(bads: Iterable[str],
                  flats: Iterable[str],
                  images: Iterable[str],
-                 band_id: Band = Band.J,  # TODO: allow 'all'
+                 band_id: Union[Band, str] = Band.J,
                  combine: str = 'median',
                  skyscale_method: str = 'subtract',
-                 single_thread: bool = False) -> CCDData:
+                 single_thread: bool = False,
+                 calibration: str = 'ccdproc',
+                 cache_dir: Optional[str] = None,
+                 sky_window: int = 5,
+                 register_images: bool = False,
+                 distortion_correct: bool = False,
+                 checkpoint_dir: Optional[str] = None,
+                 pool: Union[PoolDummy, Pool, None] = None) -> Union[CCDData, Dict[Band, CCDData]]:
     """
     Take a list of files for badPixel, flatfield and exposures + a bunch of processing parameters and reduce them
     to write an output filec
     :param bads: list of paths to bad pixel frames
     :param flats: list of paths to flat frames
     :param images: list of paths to images
-    :param band_id: which spectral band to look at, enum
+    :param band_id: which spectral band to look at, enum. 'all' to reduce every band that has a flat and images,
+                    the bands are processed concurrently on the same pool
     :param combine: either 'median' or 'average'
-    :param skyscale_method: either 'subtract' or 'divide'
+    :param skyscale_method: either 'subtract', 'divide' or 'running'
     :param single_thread: if false, don't use multiprocessing pool
-    :return: (combined_output, scamp_output, sextractor_output)
+    :param calibration: 'ccdproc', 'batch' or 'quadrant', see standard_process
+    :param cache_dir: reuse combined bad pixel mask, normalized flat and gain maps from earlier runs in this directory
+    :param sky_window: number of neighbouring images for the running sky, images need to be in the order they were
+                       taken
+    :param register_images: align the images with FFT cross-correlation against the first one instead of
+                            reprojecting them based on their WCS
+    :param distortion_correct: correct the distortion of NOTCam images with the geomap model in notcam.db, done in
+                               the same resampling step as the reprojection
+    :param checkpoint_dir: keep the frames after every stage (calibration, sky, fix_pix, alignment) in this
+                           directory and resume from the last stage whose inputs and parameters did not change
+    :param pool: run on this pool instead of creating one, e.g. to keep the workers alive between reductions
+    :return: combined image, for 'all' a dictionary band -> combined image
     """
     assert band_id
-
-    # you can't just reasign the outer scope variable without weirdness...
-    _Pool = PoolDummy if single_thread else Pool
-
-    # use pool as a context manager so that terminate() gets called automatically
-    with _Pool(n_cpu) as pool:
-        read_files = read_and_sort(bads, flats, images, pool)[band_id]
-
-        if not (len(read_files.flat) > 0 and len(read_files.images) > 0):
-            raise ValueError('cannot continue, not enough data left after filtering data by available spectral band')
-        dimensions = read_files.flat[0].shape
-        for image in itertools.chain(read_files.bad, read_files.flat, read_files.images):
+    if isinstance(band_id, str) and band_id != 'all':
+        raise ValueError("band_id needs to be a Band or 'all'")
+
+    if pool is None:
+        # you can't just reasign the outer scope variable without weirdness...
+        _Pool = PoolDummy if single_thread else Pool
+
+        # use pool as a context manager so that terminate() gets called automatically
+        with _Pool(n_cpu) as pool:
+            return reduce_image(bads, flats, images, band_id, combine, skyscale_method, single_thread, calibration,
+                                cache_dir, sky_window, register_images, distortion_correct, checkpoint_dir, pool)
+
+    # the headers are only read once, also for all bands
+    sorted_paths = sort_paths(bads, flats, images, pool, None if band_id == 'all' else band_id)
+    bands = [band_key for band_key, group in sorted_paths.items() if group.flat and group.images] \
+        if band_id == 'all' else [band_id]
+    if not bands:
+        raise ValueError('cannot continue, there is no band with both flats and images')
+
+    def reduce_band(band_key: Band) -> CCDData:
+        return reduce_group(sorted_paths[band_key], band_key, pool, combine, skyscale_method, calibration,
+                            cache_dir, sky_window, register_images, distortion_correct, checkpoint_dir)
+
+    if band_id != 'all':
+        return reduce_band(band_id)
+    logging.info('reducing bands ' + ', '.join(band_key.name for band_key in bands))
+    # the pipelines of the bands mostly wait for the pool, so threads are enough to keep it busy with all of them
+    with ThreadPoolExecutor(len(bands)) as executor:
+        return dict(zip(bands, executor.map(reduce_band, bands)))
+
+
+def reduce_group(sorted_paths: ImageGroup,
+                 band_id: Band,
+                 pool: Union[PoolDummy, Pool],
+                 combine: str = 'median',
+                 skyscale_method: str = 'subtract',
+                 calibration: str = 'ccdproc',
+                 cache_dir: Optional[str] = None,
+                 sky_window: int = 5,
+                 register_images: bool = False,
+                 distortion_correct: bool = False,
+                 checkpoint_dir: Optional[str] = None) -> CCDData:
+    """
+    reduce the paths of a single band on an existing pool, see reduce_image for the parameters
+    :param sorted_paths: bad pixel frames, flats and images of the band, see sort_paths
+    :param band_id: the band of sorted_paths
+    :param pool: multiprocessing pool or PoolDummy, can be shared between concurrent calls
+    :return: combined image
+    """
+    if not (len(sorted_paths.flat) > 0 and len(sorted_paths.images) > 0):
+        raise ValueError('cannot continue, not enough data left after filtering data by available spectral band')
+    cache = CalibrationCache(cache_dir) if cache_dir else None
+
+    def calibrate(store: FrameStore):
+        bad_datas, flat = read_calibrations(sorted_paths.bad, sorted_paths.flat[0], pool, cache)
+        dimensions = flat.shape
+        for image in itertools.chain(bad_datas, [flat]):
             if not image.shape == dimensions:
                 raise ValueError('image dimension mismatch', image)
-
-        # TODO distortion correct here
+        if not store.shape[1:] == dimensions:
+            raise ValueError('image dimension mismatch', sorted_paths.images)
 
         # Perform basic reduction operations
-        processed = standard_process(read_files.bad, read_files.flat[0], read_files.images, pool)
-        skyscaled = skyscale(processed, skyscale_method, pool)
+        standard_process(bad_datas, flat, store, pool, calibration, cache)
 
+    def fix(store: FrameStore):
         # does only make sense when we have bad pixels
-        fixed = pool.map(fix_pix, skyscaled) if bads else skyscaled
+        if sorted_paths.bad:
+            store.map(fix_pix, pool)
 
+    def align(store: FrameStore):
         # Reproject everything to the world-coordinate system of the first image
-        wcs = fixed[0].wcs
+        wcs = store.metas[0].wcs
+        # the displacement map of the distortion model is only evaluated once per band and binning
+        distortion = notcam_distortion(store.metas[0].header, store.shape[1:], directory=store.directory,
+                                       cache=cache) if distortion_correct else None
+
+        if register_images:
+            register(store, pool, distortion=distortion)
+        else:
+            # the world coordinates of the reference grid are calculated once for all frames (and kept in the
+            # cache). Frames that only need a shift/rotation don't even need those
+            context = ReprojectionContext.create(wcs, store.shape[1:], store.directory, cache)
+            store.map(reproject_frame, pool, context, default_tolerance, distortion)
+        log_paths([meta.header for meta in store.metas])
+
+    stages = [Stage('calibrate', calibrate, dict(calibration=calibration)),
+              Stage('sky', lambda store: skyscale(store, skyscale_method, pool, window=sky_window),
+                    dict(method=skyscale_method, window=sky_window if skyscale_method == 'running' else None)),
+              Stage('fix_pix', fix, dict()),
+              Stage('align', align, dict(register_images=register_images, distortion_correct=distortion_correct))]
+    checkpoints, keys = None, ()
+    if checkpoint_dir:
+        checkpoints = Checkpoints(checkpoint_dir)
+        keys = stage_keys(stages, list(sorted_paths.bad) + list(sorted_paths.flat[:1]), sorted_paths.images,
+                          band=band_id.name)
+
+    # the exposures only live in the scratch store from here on, the workers get handles to it
+    with run_stages(stages, lambda: FrameStore.read(sorted_paths.images, pool), checkpoints, keys) as store:
+        wcs = store.metas[0].wcs
+        # overlay images, block by block instead of the whole stack in memory like ccdproc.Combiner
+        output_image = tile_combine(store, 'median' if combine == 'median' else 'average', pool)
+    output_image.wcs = wcs
+    output_image.header = astropy.io.fits.header.Header(output_image.header)
+
+    return output_image
 
-        reprojected = pool.starmap(ccdproc.wcs_project, zip(fixed, itertools.repeat(wcs)))
 
-        # TODO option to align with cross correlation (see image_registration)
+def astroref(combined_image: CCDData, config: Config):
+    # only the image goes to SExtractor, without the error/mask hdus that would confuse scamp (write_sextractor_input)
+    scamp_data, sextractor_data, reference_catalog_data = run_astroref(combined_image, config=config)
+    return apply_scamp_header(combined_image, scamp_data), scamp_data, sextractor_data, reference_catalog_data
 
-        # overlay images
-        combiner = ccdproc.Combiner(reprojected)
-        output_image = combiner.median_combine() if combine == 'median' else combiner.average_combine()
-        # WTF. ccdproc.Combiner is not giving back good metadata.
-        # need to set WCS manually again and convert header to astropy.fits.io.Header object from an ordered dict
-        # not replacing this can cause weird errors during file writing/wcs conversion
-        output_image.wcs = wcs
-        output_image.header = astropy.io.fits.header.Header(output_image.header)
 
-        return output_image
+def astroref_batch(combined_images: Sequence[CCDData], config: Config, max_jobs: Optional[int] = None):
+    """astroref for many images with a single scamp run, see run_astroref_batch"""
+    results = run_astroref_batch(combined_images, config, max_jobs)
+    return [(apply_scamp_header(image, scamp_data), scamp_data, sextractor_data, reference_catalog_data)
+            for image, (scamp_data, sextractor_data, reference_catalog_data) in zip(combined_images, results)]
 
 
-def astroref(combined_image: CCDData, config: Config):
-    # The output has 3 hdus: image and error/mask. This confuses scamp, so only take the image to feed it to scamp
-    first_hdu = combined_image.to_hdu()[0]
-    scamp_input = CCDData(first_hdu.data, header=first_hdu.header, unit=first_hdu.header['bunit'])
-    scamp_data, sextractor_data, reference_catalog_data = run_astroref(scamp_input, config=config)
+def astroref_pipelined(combined_images: Sequence[CCDData], config: Config, stage_jobs: int = 1):
+    """astroref for many images with SExtractor and scamp pipelined, see astroref_pipeline"""
+    results = run_astroref_pipelined(combined_images, config, stage_jobs)
+    return [(apply_scamp_header(image, scamp_data), scamp_data, sextractor_data, reference_catalog_data)
+            for image, (scamp_data, sextractor_data, reference_catalog_data) in zip(combined_images, results)]
+
 
+def apply_scamp_header(combined_image: CCDData, scamp_data: str) -> CCDData:
     # PV?_? (distortion) entries are not handled well by wcslib and by extension astropy.
     # just Remove them as a workaround
     scamp_header = fits.Header.fromstring(scamp_data, sep='\n')
@@ -462,4 +719,4 @@ def astroref(combined_image: CCDData, config: Config):
     combined_image.header.update(scamp_header)
     combined_image.wcs = astropy.wcs.WCS(scamp_header)
 
-    return combined_image, scamp_data, sextractor_data, reference_catalog_data
+    return combined_image
@@ -0,0 +1,251 @@
+"""
+Local store of an astrometric reference catalog for scamp runs without network access. Catalogs (FITS_LDAC, e.g. the
+ones scamp saved earlier, or plain FITS tables) are ingested into tiles of the sky, the tiling is the spatial
+index: a cone only needs the tiles that overlap it. For every image footprint a cutout is written in the format of
+scamp's own reference catalogs and passed as ASTREF_CATALOG FILE. Cutouts are cached by sky region, so repeated
+pointings reuse them.
+"""
+import glob
+import json
+import logging
+import math
+import os
+import tempfile
+import warnings
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS, FITSFixedWarning
+
+from .calibration_cache import content_key, file_hash
+from .ldac import read_ldac, write_ldac
+
+# degrees, height of the declination bands and about the width of the tiles
+default_tile_size = 1.
+# degrees, cutout centers are rounded to this and radii padded by it, so nearby pointings share a cutout
+cutout_grid = 0.05
+
+# columns of the stored sources: name, dtype, unit, names the column can have in ingested catalogs
+columns = [('X_WORLD', 'f8', 'deg', ('X_WORLD', 'RA', 'RAJ2000', 'ALPHA_J2000', 'ra')),
+           ('Y_WORLD', 'f8', 'deg', ('Y_WORLD', 'DEC', 'DEJ2000', 'DELTA_J2000', 'dec')),
+           ('ERRA_WORLD', 'f4', 'deg', ('ERRA_WORLD', 'e_RAJ2000', 'ra_error')),
+           ('ERRB_WORLD', 'f4', 'deg', ('ERRB_WORLD', 'e_DEJ2000', 'dec_error')),
+           ('MAG', 'f4', 'mag', ('MAG', 'mag')),
+           ('MAGERR', 'f4', 'mag', ('MAGERR', 'e_mag', 'mag_error')),
+           ('OBSDATE', 'f8', 'yr', ('OBSDATE', 'epoch'))]
+source_dtype = np.dtype([(name, dtype) for name, dtype, _, _ in columns])
+# values of columns an ingested catalog doesn't have: 0.1" position error, epoch J2000
+missing_values = {'ERRA_WORLD': 0.1 / 3600, 'ERRB_WORLD': 0.1 / 3600, 'MAG': 0., 'MAGERR': 0., 'OBSDATE': 2000.}
+
+
+def unit_vectors(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def separation(ra: np.ndarray, dec: np.ndarray, ra0: float, dec0: float) -> np.ndarray:
+    """angular distance in degrees"""
+    return np.degrees(np.arccos(np.clip(unit_vectors(ra, dec) @ unit_vectors(ra0, dec0), -1, 1)))
+
+
+def footprint(header: fits.Header) -> Optional[Tuple[float, float, float]]:
+    """ra, dec of the center and radius of the circle around an image in degrees, None if it has no celestial WCS"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FITSFixedWarning)
+        wcs = WCS(header)
+    if not wcs.has_celestial:
+        return None
+    height, width = header.get('NAXIS2', 1), header.get('NAXIS1', 1)
+    ra, dec = wcs.celestial.pixel_to_world_values([(width - 1) / 2, -0.5, width - 0.5, -0.5, width - 0.5],
+                                                  [(height - 1) / 2, -0.5, -0.5, height - 0.5, height - 0.5])
+    return float(ra[0]), float(dec[0]), float(separation(ra[1:], dec[1:], ra[0], dec[0]).max())
+
+
+def enclosing(footprints: Sequence[Tuple[float, float, float]]) -> Tuple[float, float, float]:
+    """a circle around all footprints, centered on their mean direction"""
+    vectors = unit_vectors(*np.array([(ra, dec) for ra, dec, _ in footprints]).T)
+    x, y, z = vectors.sum(axis=0)
+    ra, dec = math.degrees(math.atan2(y, x)) % 360, math.degrees(math.atan2(z, math.hypot(x, y)))
+    radius = max(float(separation(ra0, dec0, ra, dec)) + radius0 for ra0, dec0, radius0 in footprints)
+    return ra, dec, radius
+
+
+class RefcatStore:
+    """
+    Directory with the tiles (tile_<dec band>_<ra index>.npy, sources as source_dtype) and index.json, which lists
+    the tiles, the ingested files and a revision that changes with every ingest. Cutouts are kept in cutouts/
+    """
+
+    def __init__(self, directory: str, tile_size: float = default_tile_size):
+        """
+        :param directory: created if it doesn't exist
+        :param tile_size: only used for a new store, an existing one keeps its tiling
+        """
+        self.directory = os.path.abspath(directory)
+        os.makedirs(os.path.join(self.directory, 'cutouts'), exist_ok=True)
+        index_path = os.path.join(self.directory, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = dict(tile_size=tile_size, revision=0, tiles=dict(), ingested=dict())
+
+    @property
+    def tile_size(self) -> float:
+        return self.index['tile_size']
+
+    def _ra_bins(self, band: int) -> int:
+        dec = -90 + (band + 0.5) * self.tile_size
+        return max(1, int(360 * math.cos(math.radians(dec)) / self.tile_size))
+
+    def tile_of(self, ra: np.ndarray, dec: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """declination band and ra index of every source"""
+        n_bands = int(math.ceil(180 / self.tile_size))
+        bands = np.clip(((np.asarray(dec) + 90) // self.tile_size).astype(int), 0, n_bands - 1)
+        n_bins = np.array([self._ra_bins(band) for band in range(n_bands)])[bands]
+        indices = np.minimum((np.asarray(ra) % 360 / 360 * n_bins).astype(int), n_bins - 1)
+        return bands, indices
+
+    def tiles_in_cone(self, ra: float, dec: float, radius: float) -> List[str]:
+        """names of the tiles that overlap a cone, only the ones that exist"""
+        n_bands = int(math.ceil(180 / self.tile_size))
+        names = []
+        for band in range(max(0, int((dec - radius + 90) // self.tile_size)),
+                          min(n_bands - 1, int((dec + radius + 90) // self.tile_size)) + 1):
+            n_bins = self._ra_bins(band)
+            low, high = -90 + band * self.tile_size, -90 + (band + 1) * self.tile_size
+            max_dec = min(90., max(abs(max(low, dec - radius)), abs(min(high, dec + radius))))
+            if max_dec + radius >= 90 or math.cos(math.radians(max_dec)) * 180 <= radius:
+                indices = range(n_bins)
+            else:
+                half_width = radius / math.cos(math.radians(max_dec))
+                first = int(math.floor((ra - half_width) % 360 / 360 * n_bins))
+                count = int(math.ceil(2 * half_width / 360 * n_bins)) + 1
+                indices = sorted({(first + step) % n_bins for step in range(min(count, n_bins))})
+            names += [f'tile_{band}_{index}' for index in indices if f'tile_{band}_{index}' in self.index['tiles']]
+        return names
+
+    def _tile_path(self, name: str) -> str:
+        return os.path.join(self.directory, name + '.npy')
+
+    def _load_tile(self, name: str) -> np.ndarray:
+        return np.load(self._tile_path(name)) if name in self.index['tiles'] else np.empty(0, source_dtype)
+
+    def ingest(self, paths: Iterable[str]) -> int:
+        """
+        add catalogs to the store, files that were ingested before are skipped
+        :param paths: FITS_LDAC catalogs or FITS tables with at least ra/dec columns, see columns
+        :return: number of new sources
+        """
+        added, revision = 0, self.index['revision']
+        for path in paths:
+            digest = file_hash(path)
+            if digest in self.index['ingested']:
+                logging.info(f'{path} is already in the reference catalog store')
+                continue
+            sources = read_sources(path)
+            bands, indices = self.tile_of(sources['X_WORLD'], sources['Y_WORLD'])
+            for band, index in sorted(set(zip(bands.tolist(), indices.tolist()))):
+                name = f'tile_{band}_{index}'
+                tile = np.concatenate([self._load_tile(name), sources[(bands == band) & (indices == index)]])
+                _atomic_save(self._tile_path(name), tile)
+                self.index['tiles'][name] = len(tile)
+            self.index['ingested'][digest] = os.path.abspath(path)
+            self.index['revision'] += 1
+            self._save_index()
+            added += len(sources)
+            logging.info(f'ingested {len(sources)} sources from {path}')
+        if self.index['revision'] != revision:
+            self._remove_cutouts()
+        return added
+
+    def _remove_cutouts(self) -> None:
+        """cutouts are keyed by the revision, after an ingest none of them is used again"""
+        cutouts = glob.glob(os.path.join(self.directory, 'cutouts', 'refcat_*.cat'))
+        for path in cutouts:
+            os.remove(path)
+        if cutouts:
+            logging.info(f'removed {len(cutouts)} outdated cutouts')
+
+    def _save_index(self) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, os.path.join(self.directory, 'index.json'))
+
+    def query(self, ra: float, dec: float, radius: float) -> np.ndarray:
+        """all sources within radius (degrees) of ra, dec"""
+        tiles = [self._load_tile(name) for name in self.tiles_in_cone(ra, dec, radius)]
+        sources = np.concatenate(tiles) if tiles else np.empty(0, source_dtype)
+        return sources[separation(sources['X_WORLD'], sources['Y_WORLD'], ra, dec) <= radius]
+
+    def cutout(self, ra: float, dec: float, radius: float) -> str:
+        """
+        path of a reference catalog for scamp (ASTREF_CATALOG FILE) with all sources in the cone. The cone is
+        widened to the cutout_grid, cutouts are reused by all cones that end up on the same grid cone
+        """
+        dec_grid = round(dec / cutout_grid) * cutout_grid
+        ra_grid = round(ra / cutout_grid) * cutout_grid % 360
+        radius_grid = math.ceil(radius / cutout_grid + 1) * cutout_grid
+        key = content_key('refcat', revision=self.index['revision'], ra=round(ra_grid, 6), dec=round(dec_grid, 6),
+                          radius=round(radius_grid, 6))
+        path = os.path.join(self.directory, 'cutouts', f'refcat_{key[:16]}.cat')
+        if not os.path.exists(path):
+            sources = self.query(ra_grid, dec_grid, radius_grid)
+            if not len(sources):
+                logging.warning(f'no reference sources within {radius_grid:.2f} deg of {ra_grid:.3f} {dec_grid:+.3f}')
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.cat')
+            os.close(fd)
+            write_ldac(tmp_path, cutout_header(ra_grid, dec_grid, radius_grid), [
+                fits.Column(name=name, format={'f8': 'D', 'f4': 'E'}[dtype], unit=unit, array=sources[name])
+                for name, dtype, unit, _ in columns])
+            os.replace(tmp_path, path)
+        return path
+
+
+def cutout_header(ra: float, dec: float, radius: float) -> fits.Header:
+    """field header like scamp writes into its reference catalogs, 1 arcsec pixels"""
+    size = int(2 * radius * 3600) + 1
+    return fits.Header([('SIMPLE', True), ('BITPIX', 0), ('NAXIS', 2), ('NAXIS1', size), ('NAXIS2', size),
+                        ('EQUINOX', 2000.), ('RADESYS', 'ICRS'), ('CTYPE1', 'RA---STG'), ('CTYPE2', 'DEC--STG'),
+                        ('CRVAL1', ra), ('CRVAL2', dec), ('CRPIX1', (size + 1) / 2), ('CRPIX2', (size + 1) / 2),
+                        ('CDELT1', -1 / 3600), ('CDELT2', 1 / 3600)])
+
+
+def read_sources(path: str) -> np.ndarray:
+    """
+    sources of a catalog as source_dtype
+    :raises ValueError: if the catalog has no position columns
+    """
+    _, table = read_ldac(path)
+    sources = np.empty(len(table), source_dtype)
+    for name, _, _, aliases in columns:
+        alias = next((alias for alias in aliases if alias in table.names), None)
+        if alias is not None:
+            sources[name] = table[alias]
+        elif name in missing_values:
+            sources[name] = missing_values[name]
+        else:
+            raise ValueError(f'{path} has no {" or ".join(aliases)} column')
+    return sources[np.isfinite(sources['X_WORLD']) & np.isfinite(sources['Y_WORLD'])]
+
+
+def _atomic_save(path: str, array: np.ndarray) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npy')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def refcat_overrides(store_dir: str, headers: Sequence[fits.Header]) -> Dict[str, str]:
+    """
+    scamp parameters to use a cutout of the store at store_dir for images with these headers instead of the
+    catalog server. Empty if none of the images has a celestial WCS
+    """
+    footprints = [area for area in map(footprint, headers) if area is not None]
+    if not footprints:
+        logging.warning('no celestial WCS in the image header(s), using the reference catalog from scamp.config')
+        return dict()
+    path = RefcatStore(store_dir).cutout(*enclosing(footprints))
+    return dict(ASTREF_CATALOG='FILE', ASTREFCAT_NAME=path)
@@ -0,0 +1,150 @@
+"""
+Registration of the frames against the first one with FFT cross-correlation, an alternative to aligning them based
+on their WCS. Bad and hot pixels dominate a naive cross-correlation (they don't move between frames, so the peak ends
+up at zero shift, see scratch/registrationPlayground.py), so the frames are turned into feature images first:
+masked pixels get the sky level, single hot pixels are removed with a small median filter and only what's
+significantly above the sky is kept.
+"""
+import itertools
+import logging
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.fft
+import scipy.ndimage as ndimage
+
+from .frame_store import ArrayHandle, FrameStore, open_stack, resolve
+from .distortion import DistortionMap
+from .resample import shift_frame
+
+# only pixels this many (robust) sigmas above the sky take part in the correlation
+detection_sigma = 3.
+# shifts closer than this to whole pixels are rounded, the sub pixel refinement isn't more accurate than that anyway
+snap_tolerance = 0.05
+
+
+def feature_image(data: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    sky subtracted frame without bad pixels, hot pixels and noise, what remains are the sources
+    :param data: frame
+    :param mask: True where the frame is bad
+    :return: image that is 0 apart from sources
+    """
+    invalid = ~np.isfinite(data)
+    if mask is not None:
+        invalid |= mask
+    sample = data[~invalid][::max(1, data.size // 100000)]  # a subsample is plenty for the sky statistics
+    if not len(sample):
+        return np.zeros(data.shape)
+    sky = np.median(sample)
+    sigma = 1.4826 * np.median(np.abs(sample - sky))
+
+    features = ndimage.median_filter(np.where(invalid, sky, data) - sky, size=3)
+    features[features < detection_sigma * sigma] = 0
+    return features
+
+
+def padded_shape(shape: Sequence[int], max_shift: Sequence[int]) -> Tuple[int, int]:
+    """FFT size so that shifts up to max_shift don't wrap around"""
+    return tuple(scipy.fft.next_fast_len(length + shift, real=True) for length, shift in zip(shape, max_shift))
+
+
+def reference_spectrum(features: np.ndarray, fft_shape: Sequence[int]) -> np.ndarray:
+    """complex conjugate of the spectrum of the reference, so every correlation is a single multiplication"""
+    return np.conj(scipy.fft.rfft2(features, s=fft_shape))
+
+
+def _parabola_peak(minus: float, center: float, plus: float) -> float:
+    """
+    sub pixel offset of the vertex of the parabola through three neighbouring values. Through their logarithm if
+    possible, which is exact for the gaussian-like peaks of star fields
+    """
+    if min(minus, center, plus) > 0:
+        minus, center, plus = np.log([minus, center, plus])
+    denominator = minus - 2 * center + plus
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(denominator < 0, (minus - plus) / (2 * denominator), 0.)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def correlation_shifts(features: np.ndarray, reference: np.ndarray, fft_shape: Sequence[int],
+                       max_shift: Sequence[int]) -> np.ndarray:
+    """
+    shifts of a batch of feature images relative to the reference
+    :param features: (frames, rows, columns) feature images
+    :param reference: see reference_spectrum
+    :param fft_shape: padded shape used for reference
+    :param max_shift: maximum shift (rows, columns) to look for
+    :return: (frames, 2) shift of every frame, a source at (r, c) in the reference is at (r, c) + shift in the frame
+    """
+    correlation = scipy.fft.irfft2(scipy.fft.rfft2(features, s=fft_shape, axes=(-2, -1)) * reference,
+                                   s=fft_shape, axes=(-2, -1))
+    # only look at the allowed shifts, index i of the window is shift i - max_shift
+    windows = np.concatenate([correlation[:, -max_shift[0]:], correlation[:, :max_shift[0] + 1]], axis=1)
+    windows = np.concatenate([windows[:, :, -max_shift[1]:], windows[:, :, :max_shift[1] + 1]], axis=2)
+
+    shifts = np.zeros((len(windows), 2))
+    for index, window in enumerate(windows):
+        row, column = np.unravel_index(np.argmax(window), window.shape)
+        # refine with a parabola through the neighbours along each axis, wrapping is fine at the window border
+        row_refinement = _parabola_peak(window[row - 1, column], window[row, column],
+                                        window[(row + 1) % window.shape[0], column])
+        column_refinement = _parabola_peak(window[row, column - 1], window[row, column],
+                                           window[row, (column + 1) % window.shape[1]])
+        shifts[index] = (row - max_shift[0] + row_refinement, column - max_shift[1] + column_refinement)
+    return shifts
+
+
+def _register_frames(directory: str, frames: slice, reference: ArrayHandle, fft_shape: Tuple[int, int],
+                     max_shift: Tuple[int, int]) -> np.ndarray:
+    data, mask, _ = open_stack(directory, 'r')
+    features = np.stack([feature_image(frame_data, frame_mask)
+                         for frame_data, frame_mask in zip(data[frames], mask[frames])])
+    return correlation_shifts(features, resolve(reference), fft_shape, max_shift)
+
+
+def register_shifts(store: FrameStore, pool, max_shift: Optional[Sequence[int]] = None,
+                    n_chunks: int = 0) -> np.ndarray:
+    """
+    shifts of all frames relative to the first one. The spectrum of the reference is computed once, the other
+    frames are correlated against it in chunks in the pool workers, every chunk with one batched FFT
+
+    :param store: the frames to register
+    :param pool: multiprocessing pool or PoolDummy
+    :param max_shift: maximum shift (rows, columns), a quarter of the frame size by default
+    :param n_chunks: how many chunks to split the frames into, defaults to one per cpu
+    :return: (frames, 2) shifts, see correlation_shifts
+    """
+    shape = store.shape[1:]
+    max_shift = tuple(max_shift) if max_shift is not None else tuple(max(1, length // 4) for length in shape)
+    fft_shape = padded_shape(shape, max_shift)
+    reference = store.put('reference_spectrum',
+                          reference_spectrum(feature_image(store.data[0], store.mask[0]), fft_shape))
+
+    n_chunks = min(len(store), n_chunks or os.cpu_count() or 1)
+    bounds = np.linspace(0, len(store), n_chunks + 1).astype(int)
+    chunks = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    shifts = pool.starmap(_register_frames, zip(itertools.repeat(store.directory), chunks, itertools.repeat(reference),
+                                                itertools.repeat(fft_shape), itertools.repeat(max_shift)))
+    return np.concatenate(list(shifts))
+
+
+def register(store: FrameStore, pool, max_shift: Optional[Sequence[int]] = None,
+             distortion: Optional[DistortionMap] = None) -> List[Tuple[float, float]]:
+    """
+    align all frames with the first one based on cross-correlation instead of their WCS, in place. All frames get
+    the WCS of the first one
+
+    :param store: frames to align
+    :param pool: multiprocessing pool or PoolDummy
+    :param max_shift: see register_shifts
+    :param distortion: correct the distortion while shifting, see shift_frame
+    :return: the shift of every frame
+    """
+    shifts = [tuple(shift) for shift in register_shifts(store, pool, max_shift)]
+    for index, shift in enumerate(shifts):
+        logging.info(f'frame {index} shifted by {shift[0]:.2f}, {shift[1]:.2f} pixels against the first one')
+    store.starmap(shift_frame, pool, ((shift, store.metas[0].wcs, snap_tolerance, distortion)
+                                         for shift in shifts))
+    return shifts
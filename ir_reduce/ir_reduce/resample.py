@@ -0,0 +1,323 @@
+"""
+Reprojection of frames onto a reference WCS. Dithered frames usually differ from the reference only by a shift and
+maybe a tiny rotation, for those the pixel mapping is affine and the frame can be resampled with a shift or an affine
+transform instead of going through the WCS for every pixel. Gives the same result as ccdproc.wcs_project.
+The world coordinates of the output grid are shared by all frames, see ReprojectionContext. The distortion
+correction (see distortion.py) is folded into the same resampling step
+"""
+import logging
+import os
+import re
+from collections import Counter
+from typing import Optional, Sequence, Tuple, Union
+
+import ccdproc
+import numpy as np
+import scipy.ndimage as ndimage
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_area
+
+from .calibration_cache import CalibrationCache
+from .distortion import DistortionMap
+from .frame_store import ArrayHandle, resolve
+
+# maximum deviation in pixels between the affine approximation and the real mapping
+default_tolerance = 0.01
+# how many points per axis of the output grid are used to check if the mapping is affine
+grid_points = 16
+# header keyword that records which path the reprojection of a frame took
+path_keyword = 'REPROJ'
+paths = ('integer', 'shift', 'affine', 'full')
+# header keyword with the geomap record a frame was distortion corrected with
+distortion_keyword = 'DISTCORR'
+# WCS keywords that describe the observation rather than the projection, they stay in the header
+observation_keywords = ('DATE-OBS', 'MJD-OBS', 'JD-OBS')
+# CD matrix and SIP keywords, the WCS writes PC and may not write all SIP coefficients of the header
+matrix_and_sip_keywords = re.compile(r'^(CD\d+_\d+|(A|B|AP|BP)_(ORDER|\d+_\d+))$')
+
+
+class ReprojectionContext:
+    """
+    World coordinates of every pixel of the output grid, computed once and shared with the workers through a
+    memory mapped file instead of every reprojection evaluating the output WCS again. With a CalibrationCache the
+    coordinates are kept between runs, so reducing the same pointing again skips them completely.
+
+    Pass it instead of the target WCS to reproject_frame. Only the WCS and a handle get pickled
+    """
+
+    def __init__(self, wcs: WCS, shape: Sequence[int], handle: ArrayHandle):
+        self.wcs = wcs
+        self.shape = tuple(shape)
+        self.handle = handle
+
+    @classmethod
+    def create(cls, wcs: WCS, shape: Sequence[int], directory: Optional[str] = None,
+               cache: Optional[CalibrationCache] = None) -> 'ReprojectionContext':
+        """
+        :param wcs: output WCS
+        :param shape: output shape
+        :param directory: where to put the coordinates, e.g. FrameStore.directory. Ignored if cache is passed
+        :param cache: keep the coordinates in this cache, keyed by WCS and shape
+        """
+        if cache is not None:
+            handle = cache.get('target_world', lambda: output_world(wcs, shape),
+                               wcs=wcs.to_header_string(relax=True), shape=tuple(shape))
+        else:
+            path = os.path.join(directory, 'target_world.npy')
+            np.save(path, output_world(wcs, shape))
+            handle = ArrayHandle(path)
+        return cls(wcs, shape, handle)
+
+    @property
+    def world(self) -> np.ndarray:
+        """(2, rows, columns) world coordinates of the output pixels in the order of the WCS axes"""
+        return resolve(self.handle)
+
+
+def output_world(wcs: WCS, shape: Sequence[int]) -> np.ndarray:
+    """world coordinates of all pixels of the output grid, see ReprojectionContext"""
+    rows, columns = np.indices(shape)
+    return np.array(wcs.pixel_to_world_values(columns, rows))
+
+
+def _grid(shape: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """grid_points x grid_points pixels spanning the whole image, always on integer pixels"""
+    rows = np.round(np.linspace(0, shape[0] - 1, grid_points)).astype(int)
+    columns = np.round(np.linspace(0, shape[1] - 1, grid_points)).astype(int)
+    rows, columns = np.meshgrid(rows, columns, indexing='ij')
+    return rows.ravel(), columns.ravel()
+
+
+def affine_mapping(wcs_in: WCS, target: Union[WCS, ReprojectionContext], shape_out: Sequence[int],
+                   tolerance: float = default_tolerance) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Check if the mapping from output to input pixels is affine by evaluating it on a grid of output pixels.
+    This includes the distortion terms of both WCS, so anything but a shift/rotation/scale ends up as None
+
+    :param wcs_in: WCS of the frame
+    :param target: WCS to project onto, or its context with the world coordinates of the output grid
+    :param shape_out: shape of the output
+    :param tolerance: allowed deviation of the affine fit in input pixels
+    :return: (matrix, offset) in numpy (row, column) order, input = matrix @ output + offset, None if not affine
+    """
+    rows, columns = _grid(shape_out)
+    if isinstance(target, ReprojectionContext):
+        world = target.world[:, rows, columns]
+    else:
+        world = target.pixel_to_world_values(columns, rows)
+    x_in, y_in = wcs_in.world_to_pixel_values(*world)
+    pixel_in = np.stack([y_in, x_in], axis=1)
+    if not np.all(np.isfinite(pixel_in)):
+        return None
+
+    design = np.stack([rows, columns, np.ones(len(rows))], axis=1)
+    solution, *_ = np.linalg.lstsq(design, pixel_in, rcond=None)
+    if np.max(np.abs(design @ solution - pixel_in)) > tolerance:
+        return None
+    return solution[:2].T, solution[2]
+
+
+def classify_mapping(matrix: np.ndarray, offset: np.ndarray, shape_out: Sequence[int],
+                     tolerance: float = default_tolerance) -> str:
+    """
+    :return: 'integer' if the mapping is a shift by whole pixels, 'shift' for any other shift, 'affine' otherwise.
+             The linear part counts as identity if it moves no pixel of the output by more than tolerance
+    """
+    if np.max(np.abs(matrix - np.eye(2))) * max(shape_out) > tolerance:
+        return 'affine'
+    if np.max(np.abs(offset - np.round(offset))) > tolerance:
+        return 'shift'
+    return 'integer'
+
+
+def _integer_shift(data: np.ndarray, offset: np.ndarray, fill) -> np.ndarray:
+    """output[r, c] = data[r + offset[0], c + offset[1]], fill where that's outside of data"""
+    output = np.full(data.shape, fill, dtype=np.result_type(data.dtype, type(fill)))
+    (row, column), (rows, columns) = np.round(offset).astype(int), data.shape
+    output[max(0, -row):min(rows, rows - row), max(0, -column):min(columns, columns - column)] = \
+        data[max(0, row):min(rows, rows + row), max(0, column):min(columns, columns + column)]
+    return output
+
+
+def _inside(matrix: np.ndarray, offset: np.ndarray, shape_in: Sequence[int], shape_out: Sequence[int]) -> np.ndarray:
+    """output pixels that map into the input image, including the outer half of the border pixels like reproject"""
+    rows, columns = np.arange(shape_out[0]).reshape(-1, 1), np.arange(shape_out[1]).reshape(1, -1)
+    inside = np.ones(shape_out, dtype=bool)
+    for axis in range(2):
+        coordinate = matrix[axis, 0] * rows + matrix[axis, 1] * columns + offset[axis]
+        inside &= (coordinate >= -0.5) & (coordinate <= shape_in[axis] - 0.5)
+    return inside
+
+
+def resample_affine(data: np.ndarray, matrix: np.ndarray, offset: np.ndarray, path: str,
+                    order: int = 1) -> np.ndarray:
+    """
+    bilinear resampling of data with input = matrix @ output + offset, nan outside of the input
+
+    :param data: 2D image
+    :param matrix: linear part of the mapping
+    :param offset: shift part of the mapping
+    :param path: 'integer', 'shift' or 'affine', see classify_mapping
+    :param order: spline order, 1 is bilinear like in ccdproc.wcs_project
+    :return: resampled image
+    """
+    if path == 'integer':
+        return _integer_shift(data.astype(np.float64), offset, np.nan)
+    # 'nearest' so that the outer half of the border pixels gets the border value like reproject does, everything
+    # that's really outside is set to nan afterwards
+    if path == 'shift':
+        resampled = ndimage.shift(data.astype(np.float64), -offset, order=order, mode='nearest')
+    else:
+        resampled = ndimage.affine_transform(data.astype(np.float64), matrix, offset, order=order, mode='nearest')
+    resampled[~_inside(matrix, offset, data.shape, data.shape)] = np.nan
+    return resampled
+
+
+def map_coordinates(data: np.ndarray, coordinates: np.ndarray, order: int = 1) -> np.ndarray:
+    """
+    ndimage.map_coordinates with the edge handling of reproject: the outer half of the border pixels gets the border
+    value, everything further out is nan
+    """
+    coordinates = coordinates.copy()
+    outside = np.zeros(coordinates.shape[1:], dtype=bool)
+    for axis, length in enumerate(data.shape):
+        invalid = np.isnan(coordinates[axis])
+        outside |= (coordinates[axis] < -0.5) | (coordinates[axis] > length - 0.5) | invalid
+        coordinates[axis][invalid] = 0
+        np.clip(coordinates[axis], 0, length - 1, out=coordinates[axis])
+    resampled = ndimage.map_coordinates(data.astype(np.float64), coordinates, order=order, mode='nearest')
+    resampled[outside] = np.nan
+    return resampled
+
+
+def resample_full(data: np.ndarray, wcs_in: WCS, context: ReprojectionContext) -> np.ndarray:
+    """bilinear resampling of data onto the output grid of context, only the world->pixel step is needed per frame"""
+    world = context.world
+    x_in, y_in = wcs_in.world_to_pixel_values(world[0], world[1])
+    return map_coordinates(data, np.stack([y_in, x_in]))
+
+
+def _pixel_coordinates(wcs_in: WCS, target: Union[WCS, ReprojectionContext], shape_out: Sequence[int],
+                       mapping: Optional[Tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+    """(2, rows, columns) input pixel of every output pixel, from the affine mapping if there is one"""
+    indices = np.indices(shape_out, dtype=np.float64)
+    if mapping is not None:
+        matrix, offset = mapping
+        return np.einsum('ij,j...->i...', matrix, indices) + offset.reshape(2, 1, 1)
+    world = target.world if isinstance(target, ReprojectionContext) else \
+        target.pixel_to_world_values(indices[1], indices[0])
+    x_in, y_in = wcs_in.world_to_pixel_values(world[0], world[1])
+    return np.stack([y_in, x_in])
+
+
+def _distorted(ccd: CCDData, coordinates: np.ndarray, distortion: DistortionMap, target_wcs: Optional[WCS],
+               path: str) -> CCDData:
+    """resample ccd at the raw positions of the corrected pixel coordinates in one go"""
+    raw = distortion.raw_coordinates(coordinates)
+    resampled = _resampled_ccd(ccd, lambda values: map_coordinates(values, raw), target_wcs, path)
+    resampled.header[distortion_keyword] = distortion.name
+    return resampled
+
+
+def reproject_frame(ccd: CCDData, target: Union[WCS, ReprojectionContext],
+                    tolerance: float = default_tolerance, distortion: Optional[DistortionMap] = None) -> CCDData:
+    """
+    Replacement for ccdproc.wcs_project. Frames whose pixel mapping to target_wcs is affine within tolerance get
+    resampled directly (whole pixel shifts are just copied), everything else goes through the full reprojection.
+    The path that was taken is stored in the REPROJ header keyword
+
+    :param ccd: frame with a celestial WCS
+    :param target: WCS to project onto, the output has the same shape as ccd. With a ReprojectionContext the
+                   full reprojection reuses its world coordinates instead of calling ccdproc.wcs_project
+    :param tolerance: maximum deviation in pixels for the affine approximation
+    :param distortion: correct the distortion of ccd in the same resampling step, the WCS of ccd is taken to
+                       describe the corrected frame. The record is stored in the DISTCORR header keyword
+    :return: reprojected frame with mask like ccdproc.wcs_project, no uncertainty
+    """
+    target_wcs = target.wcs if isinstance(target, ReprojectionContext) else target
+    if not (ccd.wcs.is_celestial and target_wcs.is_celestial):
+        raise ValueError("one or both WCS is not celestial.")
+
+    mapping = affine_mapping(ccd.wcs, target, ccd.shape, tolerance)
+    if distortion is not None:
+        path = 'full' if mapping is None else classify_mapping(*mapping, ccd.shape, tolerance)
+        return _distorted(ccd, _pixel_coordinates(ccd.wcs, target, ccd.shape, mapping), distortion, target_wcs, path)
+
+    if mapping is None and not isinstance(target, ReprojectionContext):
+        projected = ccdproc.wcs_project(ccd, target_wcs)
+        projected.header[path_keyword] = 'full'
+        return projected
+
+    if mapping is None:
+        path = 'full'
+
+        def resample(values):
+            return resample_full(values, ccd.wcs, target)
+    else:
+        matrix, offset = mapping
+        path = classify_mapping(matrix, offset, ccd.shape, tolerance)
+
+        def resample(values):
+            return resample_affine(values, matrix, offset, path)
+
+    return _resampled_ccd(ccd, resample, target_wcs, path)
+
+
+def shift_frame(ccd: CCDData, offset: Sequence[float], target_wcs: Optional[WCS] = None,
+                tolerance: float = default_tolerance, distortion: Optional[DistortionMap] = None) -> CCDData:
+    """
+    shift a frame so output[r, c] = ccd[r + offset[0], c + offset[1]], e.g. with offsets from image registration.
+    Whole pixel shifts are just copied, the path is stored in the REPROJ header keyword like in reproject_frame
+
+    :param ccd: frame to shift
+    :param offset: (rows, columns) shift
+    :param target_wcs: WCS of the output, the one of ccd if None
+    :param tolerance: offsets closer than this to whole pixels are rounded
+    :param distortion: see reproject_frame, the offset is between corrected frames
+    :return: shifted frame with mask like reproject_frame, no uncertainty
+    """
+    matrix, offset = np.eye(2), np.asarray(offset, dtype=np.float64)
+    path = classify_mapping(matrix, offset, ccd.shape, tolerance)
+    target_wcs = target_wcs if target_wcs is not None else ccd.wcs
+    if distortion is not None:
+        coordinates = np.indices(ccd.shape, dtype=np.float64) + offset.reshape(2, 1, 1)
+        return _distorted(ccd, coordinates, distortion, target_wcs, path)
+    return _resampled_ccd(ccd, lambda values: resample_affine(values, matrix, offset, path), target_wcs, path)
+
+
+def _resampled_ccd(ccd: CCDData, resample, target_wcs: Optional[WCS], path: str) -> CCDData:
+    """resample data and mask of ccd like ccdproc.wcs_project does"""
+    data = resample(ccd.data)
+    mask = np.isnan(data)
+    if ccd.mask is not None:
+        mask |= np.nan_to_num(resample(ccd.mask.astype(np.float64))) > 1e-8
+
+    area_ratio = 1. if target_wcs is None or ccd.wcs is None else \
+        proj_plane_pixel_area(target_wcs) / proj_plane_pixel_area(ccd.wcs)
+    header = strip_wcs(ccd.header)
+    header[path_keyword] = path
+    return CCDData(area_ratio * data, wcs=target_wcs, mask=mask if mask.any() else None, header=header,
+                   unit=ccd.unit)
+
+
+def strip_wcs(header: fits.Header) -> fits.Header:
+    """copy of header without the WCS keywords, the output gets the WCS it was projected onto instead"""
+    stripped = header.copy()
+    wcs = WCS(header, relax=True)
+    if not wcs.wcs.ctype[0]:
+        return stripped
+    for keyword in wcs.to_header(relax=True):
+        if keyword not in observation_keywords:
+            stripped.remove(keyword, ignore_missing=True)
+    for keyword in [keyword for keyword in stripped if matrix_and_sip_keywords.match(keyword)]:
+        stripped.remove(keyword, ignore_missing=True)
+    return stripped
+
+
+def log_paths(headers: Sequence) -> Counter:
+    """log and count which reprojection path the frames took"""
+    counts = Counter(header.get(path_keyword, 'full') for header in headers)
+    logging.info('reprojection paths: ' + ', '.join(f'{path} {counts[path]}' for path in paths if counts[path]))
+    return counts
@@ -1,45 +1,37 @@
+import copy
 import glob
+import logging
 import os
+import re
 import shutil
 import subprocess as sp
-import sys
 import tempfile
-from typing import Union, Tuple, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional, Sequence, TypeVar, Union, Tuple, List, Dict
 
 import astropy.io.fits as fits
+import numpy as np
 from astropy.nddata.ccddata import CCDData
 
+from .astromatic_config import Config
+from .refcat_store import refcat_overrides
+
 """
 Throughout this file: sex->SourceExtractor
 """
-this_dir, this_file = os.path.split(__file__)
-
-
-class Config:
-    """
-    a helper class to bundle parameters for scamp/sextractor
-
-    TODO: maybe allow to override parameters from the config files here with an "additional params"-entry
-    and pass them like "sex -MYPARAM MYVAL"
-    """
-
-    def __init__(self):
-        self.sextractor_param = os.path.join(this_dir, 'default.param')
-        self.sextractor_config = os.path.join(this_dir, 'sex.config')
-        self.sextractor_neural = os.path.join(this_dir, 'default.nnw')
-        self.scamp_config = os.path.join(this_dir, 'scamp.config')
-        self.working_dir = ''
-        self.sextractor_outfile = 'sexout.fits'
-        self.sex_cmd = 'sex'
-        self.scamp_cmd = 'scamp'
-        self.sextractor_conv = 'default.conv'
 
-        self.sextractor_overrides = ['']
-        self.scamp_overrides = ['']
+# header cards write_sextractor_input sets itself
+structural_keywords = {'SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND', 'BSCALE', 'BZERO', 'END'}
+# bytes, FITS headers and data are padded to multiples of it
+fits_block = 2880
+# seconds a tool run may take per image it works on, and in addition per million pixels of them
+base_timeout = 30.
+timeout_per_megapixel = 30.
+# terminal control sequences SExtractor uses to redraw its progress line
+escape_sequence = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
 
-    @staticmethod
-    def default():
-        return Config()
+T = TypeVar('T')
+R = TypeVar('R')
 
 
 def astroreff_files(input_files: List[str], config: Config = Config.default()) -> None:
@@ -137,41 +129,134 @@ def split_overriders(overriders: List[str]) -> List[str]:
     return ret
 
 
-def run_astroref(input_data: Union[str, CCDData], config: Config = Config.default(),
-                 verbose: int = 1) -> Tuple[str, bytes, bytes]:
+def prepare_working_dir(config: Config, working_dir: str) -> None:
     """
-    TODO maybe wrapper that writes out strings and CCDData to files so that this function can only work with FS data
-
-    :param input_data:
-    :param config:
-    :param verbose:
-    :return: tuple(scamp_data, sextractor_data,reference_catalog_data)
+    files SExtractor needs in its working directory. The parameter and filter files are passed by absolute path
+    (setup_args), only a missing filter file is replaced by an empty one, once per working directory
     """
+    empty_conv = os.path.join(working_dir, os.path.basename(config.sextractor_conv))
+    if not os.path.exists(config.sextractor_conv) and not os.path.exists(empty_conv):
+        open(empty_conv, 'a').close()
 
-    if not is_config_valid(config):
-        raise ValueError("Errors found in scamp/source extractor configuration")
 
-    tmpdir_pin = tempfile.TemporaryDirectory()
-    working_dir = config.working_dir if config.working_dir else tmpdir_pin.name  # gets deleted automatically
+def setup_args(config: Config) -> List[str]:
+    """SExtractor arguments for the files of config, so nothing needs to be copied to the working directory"""
+    args = ['-PARAMETERS_NAME', os.path.abspath(config.sextractor_param), '-STARNNW_NAME', config.sextractor_neural]
+    if os.path.exists(config.sextractor_conv):
+        args += ['-FILTER_NAME', os.path.abspath(config.sextractor_conv)]
+    return args
 
-    shutil.copy(config.sextractor_param, working_dir)
 
-    if not os.path.exists(config.sextractor_conv):
-        open(os.path.join(working_dir, config.sextractor_conv), 'a').close()
+def write_sextractor_input(image: CCDData, path: str) -> None:
+    """
+    only what SExtractor reads, written directly: a primary HDU with the header cards, the WCS and the data as 32 bit
+    floats (its internal pixel type). No uncertainty and mask extensions and no CCDData or HDUList round trip.
+    The WCS keeps its SIP distortion, CD and SIP cards left in the header are dropped like in resample.strip_wcs
+    """
+    from .resample import matrix_and_sip_keywords
+    wcs_cards = list(image.wcs.to_header(relax=True).cards) if image.wcs is not None else []
+    skip = structural_keywords | {card.keyword for card in wcs_cards} - {'COMMENT', 'HISTORY', ''}
+    data = np.asarray(image.data, dtype='>f4')
+    meta = image.header if isinstance(image.header, fits.Header) else fits.Header(image.header)
+    cards = [fits.Card('SIMPLE', True), fits.Card('BITPIX', -32), fits.Card('NAXIS', 2),
+             fits.Card('NAXIS1', data.shape[1]), fits.Card('NAXIS2', data.shape[0])] + \
+        [card for card in meta.cards
+         if card.keyword not in skip and not (wcs_cards and matrix_and_sip_keywords.match(card.keyword))] + wcs_cards
+    header = ''.join(card.image for card in cards) + 'END'.ljust(80)
+    with open(path, 'wb') as f:
+        f.write(header.ljust(-(-len(header) // fits_block) * fits_block).encode('ascii'))
+        data.tofile(f)
+        f.write(bytes(-data.nbytes % fits_block))
+
+
+def native_extraction(input_data: Union[str, CCDData], config: Config, working_dir: str, catalog: str) -> int:
+    """source_extraction in place of SExtractor (config.native_extractor), :return: number of sources"""
+    from .source_extraction import extract_catalog
+    if isinstance(input_data, CCDData):
+        data, mask = input_data.data, input_data.mask
     else:
-        shutil.copy(config.sextractor_conv, working_dir)
+        data, mask = fits.getdata(input_data), None
+    return extract_catalog(os.path.join(working_dir, catalog), data, image_header(input_data), config, mask)
 
-    if isinstance(input_data, CCDData):
-        fname = os.path.join(working_dir, 'sextractorInput.fits')
-        input_data.write(fname, overwrite=True)
+
+def sextractor_input(input_data: Union[str, CCDData], config: Config, working_dir: str,
+                     input_name: str) -> Tuple[str, bool]:
+    """
+    the file SExtractor reads, see run_sextractor
+    :return: its path and whether it is temporary, i.e. has to be removed after the run
+    """
+    if not isinstance(input_data, CCDData):
+        return os.path.abspath(input_data), False
+    if config.input_dir:
+        name, ext = os.path.splitext(input_name)
+        handle, fname = tempfile.mkstemp(prefix=name + '_', suffix=ext, dir=config.input_dir)
+        os.close(handle)
     else:
-        fname = os.path.abspath(input_data)
+        fname = os.path.join(working_dir, input_name)
+    write_sextractor_input(input_data, fname)
+    return fname, bool(config.input_dir)
 
-    sex_process = sp.run([config.sex_cmd, fname, '-c', config.sextractor_config,
-                          '-STARNNW_NAME', config.sextractor_neural] + split_overriders(config.sextractor_overrides),
-                         cwd=working_dir, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, timeout=30)
-    if verbose:
-        print('running', sex_process.args, 'in', working_dir)
+
+def sextractor_args(fname: str, config: Config, catalog: str) -> List[str]:
+    # CATALOG_NAME goes last so the overrides can't change it
+    return [config.sex_cmd, fname, '-c', config.sextractor_config] + setup_args(config) \
+        + split_overriders(config.sextractor_overrides) + ['-CATALOG_NAME', catalog]
+
+
+def image_pixels(input_data: Union[str, CCDData]) -> int:
+    """number of pixels of an image, 0 if the file can't be read (the base timeout applies then)"""
+    if isinstance(input_data, CCDData):
+        return input_data.data.size
+    try:
+        header = fits.getheader(input_data)
+    except OSError:
+        return 0
+    return int(np.prod([header.get(f'NAXIS{axis}', 0) for axis in range(1, header.get('NAXIS', 0) + 1)]))
+
+
+def tool_timeout(pixels: int, images: int = 1) -> float:
+    return base_timeout * images + timeout_per_megapixel * pixels / 1e6
+
+
+def output_lines(output: str) -> List[str]:
+    """non-empty lines of tool output, without the control sequences of progress lines"""
+    return [part.rstrip() for part in escape_sequence.sub('', output).replace('\r', '\n').split('\n')
+            if part.strip()]
+
+
+def log_output(args: Sequence[str], working_dir: str, *outputs: str) -> None:
+    name = os.path.basename(args[0])
+    logging.info(f'ran {list(args)} in {working_dir}')
+    for output in outputs:
+        for line in output_lines(output):
+            logging.info(f'{name}: {line}')
+
+
+def run_sextractor(input_data: Union[str, CCDData], config: Config, working_dir: str, catalog: str = '',
+                   input_name: str = 'sextractorInput.fits', verbose: int = 1) -> str:
+    """
+    run SExtractor on one image in a prepared working directory (see prepare_working_dir)
+    :param catalog: name of the output catalog, default: config.sextractor_outfile
+    :param input_name: CCDData inputs are written to a file named like this in config.input_dir, which is removed
+                       after the run, or to this file in the working directory
+    :return: the name of the catalog
+    """
+    catalog = catalog or config.sextractor_outfile
+    if config.native_extractor:
+        n_sources = native_extraction(input_data, config, working_dir, catalog)
+        if verbose:
+            logging.info(f'extracted {n_sources} sources in process to {os.path.join(working_dir, catalog)}')
+        return catalog
+
+    pixels = image_pixels(input_data)
+    fname, temporary_input = sextractor_input(input_data, config, working_dir, input_name)
+    args = sextractor_args(fname, config, catalog)
+    try:
+        sex_process = sp.run(args, cwd=working_dir, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True,
+                             timeout=tool_timeout(pixels))
+    finally:
+        if temporary_input:
+            os.remove(fname)
     if sex_process.returncode != 0:
         raise RuntimeError(
             f'''Sextractor failed to run
@@ -182,36 +267,173 @@ def run_astroref(input_data: Union[str, CCDData], config: Config = Config.defaul
             stdout:
             {sex_process.stdout}''')
     if verbose:
-        print(sex_process.stdout)
-        print(sex_process.stderr, file=sys.stdout)
+        log_output(args, working_dir, sex_process.stdout, sex_process.stderr)
+    return catalog
 
-    # flake8: noqa W504
-    scamp_process = sp.run([config.scamp_cmd, config.sextractor_outfile, '-c', config.scamp_config]
-                           + split_overriders(config.scamp_overrides),
-                           cwd=working_dir, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, timeout=30)
-    if verbose:
-        print('running', scamp_process.args, 'in', working_dir)
+
+def image_header(input_data: Union[str, CCDData]) -> fits.Header:
+    """header of an image including its WCS and size"""
+    if not isinstance(input_data, CCDData):
+        return fits.getheader(input_data)
+    header = fits.Header(input_data.header)
+    if input_data.wcs is not None:
+        header.update(input_data.wcs.to_header())
+    header['NAXIS2'], header['NAXIS1'] = input_data.shape
+    return header
+
+
+def local_refcat(config: Config, inputs: List[Union[str, CCDData]], working_dir: str) -> List[str]:
+    """
+    scamp arguments to use a cutout of config.refcat_store around the inputs as reference catalog. The cutout is
+    copied to the working directory, where scamp would save a downloaded one. No arguments without refcat_store
+    """
+    if not config.refcat_store:
+        return []
+    overrides = refcat_overrides(config.refcat_store, [image_header(input_data) for input_data in inputs])
+    if 'ASTREFCAT_NAME' in overrides:
+        shutil.copy(overrides['ASTREFCAT_NAME'], working_dir)
+        overrides['ASTREFCAT_NAME'] = os.path.basename(overrides['ASTREFCAT_NAME'])
+    return split_overriders([f'{key}={value}' for key, value in overrides.items()])
+
+
+def scamp_args(catalogs: List[str], config: Config, extra_args: Sequence[str] = ()) -> List[str]:
+    return [config.scamp_cmd] + catalogs + ['-c', config.scamp_config] + list(extra_args) \
+        + split_overriders(config.scamp_overrides)
+
+
+def run_scamp(catalogs: List[str], config: Config, working_dir: str, verbose: int = 1,
+              extra_args: Sequence[str] = (), pixels: int = 0) -> None:
+    """
+    solve the astrometry of all catalogs in one scamp run, scamp writes a header for every catalog next to it
+    (HEADER_SUFFIX). The reference catalog is fetched once for all of them
+    :param extra_args: go before config.scamp_overrides, e.g. local_refcat
+    :param pixels: of the images of all catalogs together, for the timeout
+    """
+    args = scamp_args(catalogs, config, extra_args)
+    scamp_process = sp.run(args, cwd=working_dir, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True,
+                           timeout=tool_timeout(pixels, len(catalogs)))
     if scamp_process.returncode != 0:
         raise RuntimeError(
             f'''Scamp failed to run
             args:
-            {sex_process.args}
+            {scamp_process.args}
             stderr:
             {scamp_process.stderr}
             stdout:
             {scamp_process.stdout}''')
     if verbose:
-        print(scamp_process.stdout)
-        print(scamp_process.stderr, file=sys.stdout)
+        log_output(args, working_dir, scamp_process.stdout, scamp_process.stderr)
+
+
+def read_reference_catalog(working_dir: str) -> bytes:
+    """the reference catalog scamp saved in the working directory, the newest one if it was used before"""
+    with open(max(glob.glob(os.path.join(working_dir, '*.cat')), key=os.path.getmtime), 'rb') as f:
+        return f.read()
+
 
-    # scamp_data, sextractor_data = None, None
+def read_astroref_results(catalog: str, working_dir: str) -> Tuple[str, bytes]:
+    """scamp header and SExtractor catalog of one image"""
     # SExtractor will write to CATALOG_NAME (sextractor config)
     # by HEADER_SUFFIX in its config scamp will write its output to sextractor_outfile but fits->head
-    with open(os.path.join(working_dir, config.sextractor_outfile.replace('.fits', '.head'))) as scamp_outfile:
+    with open(os.path.join(working_dir, catalog.replace('.fits', '.head'))) as scamp_outfile:
         scamp_data = scamp_outfile.read()
-    with open(os.path.join(working_dir, config.sextractor_outfile), 'rb') as f:
+    with open(os.path.join(working_dir, catalog), 'rb') as f:
         sextractor_data = f.read()
-    with open(glob.glob(os.path.join(working_dir, '*.cat'))[0], 'rb') as f:
-        reference_catalog_data = f.read()
+    return scamp_data, sextractor_data
+
+
+def run_astroref(input_data: Union[str, CCDData], config: Config = Config.default(),
+                 verbose: int = 1) -> Tuple[str, bytes, bytes]:
+    """
+    TODO maybe wrapper that writes out strings and CCDData to files so that this function can only work with FS data
+
+    :param input_data:
+    :param config:
+    :param verbose:
+    :return: tuple(scamp_data, sextractor_data,reference_catalog_data)
+    """
+
+    if not is_config_valid(config):
+        raise ValueError("Errors found in scamp/source extractor configuration")
+
+    tmpdir_pin = tempfile.TemporaryDirectory()
+    working_dir = config.working_dir if config.working_dir else tmpdir_pin.name  # gets deleted automatically
 
-    return scamp_data, sextractor_data, reference_catalog_data
+    prepare_working_dir(config, working_dir)
+    catalog = run_sextractor(input_data, config, working_dir, verbose=verbose)
+    run_scamp([catalog], config, working_dir, verbose, local_refcat(config, [input_data], working_dir),
+              image_pixels(input_data))
+
+    scamp_data, sextractor_data = read_astroref_results(catalog, working_dir)
+    return scamp_data, sextractor_data, read_reference_catalog(working_dir)
+
+
+def run_astroref_batch(inputs: Iterable[Union[str, CCDData]], config: Config = Config.default(),
+                       max_jobs: Optional[int] = None, verbose: int = 1) -> List[Tuple[str, bytes, bytes]]:
+    """
+    astroreference many images with a single scamp run: SExtractor runs for max_jobs images at a time (default: one
+    per CPU), then scamp solves all catalogs together. That costs one scamp start-up and reference catalog download
+    instead of one per image and matches the images against each other as well.
+
+    :param inputs: images or paths to them
+    :param config: as for run_astroref, the catalogs are named like sextractor_outfile with the index of the image
+    :return: tuple(scamp_data, sextractor_data, reference_catalog_data) for every input, in the same order. All of
+             them share the reference catalog
+    """
+    if not is_config_valid(config):
+        raise ValueError("Errors found in scamp/source extractor configuration")
+
+    inputs = list(inputs)
+    tmpdir_pin = tempfile.TemporaryDirectory()
+    working_dir = config.working_dir if config.working_dir else tmpdir_pin.name  # gets deleted automatically
+
+    prepare_working_dir(config, working_dir)
+    name, ext = os.path.splitext(config.sextractor_outfile)
+    with ThreadPoolExecutor(max_jobs or os.cpu_count() or 1) as executor:
+        catalogs = list(executor.map(lambda index: run_sextractor(inputs[index], config, working_dir,
+                                                                  f'{name}_{index}{ext}',
+                                                                  f'sextractorInput_{index}.fits', verbose),
+                                     range(len(inputs))))
+    run_scamp(catalogs, config, working_dir, verbose, local_refcat(config, inputs, working_dir),
+              sum(map(image_pixels, inputs)))
+
+    reference_catalog_data = read_reference_catalog(working_dir)
+    return [read_astroref_results(catalog, working_dir) + (reference_catalog_data,) for catalog in catalogs]
+
+
+def isolated_config(config: Config, name: str) -> Config:
+    """
+    copy of config for one of several jobs running at the same time. Without working_dir every run_astroref gets its
+    own temporary directory anyway, otherwise the job works in a new subdirectory of it named like name_<random>, so
+    the outputs and the reference catalog collide neither with the other jobs nor with other runs using the same
+    working_dir. The subdirectory is kept with the outputs
+    """
+    isolated = copy.copy(config)
+    if config.working_dir:
+        os.makedirs(config.working_dir, exist_ok=True)
+        isolated.working_dir = tempfile.mkdtemp(prefix=f'{name}_', dir=config.working_dir)
+    return isolated
+
+
+def map_isolated(function: Callable[[T, Config], R], items: Iterable[T], config: Config = Config.default(),
+                 max_jobs: Optional[int] = None) -> List[R]:
+    """
+    call function(item, config) for all items at the same time, every call with its own isolated_config. The work
+    happens in the SExtractor/scamp subprocesses, so threads are enough
+    :param max_jobs: how many calls run at the same time, default: one per CPU
+    :return: the results in the order of items
+    """
+    items = list(items)
+    configs = [isolated_config(config, f'job{index}') for index in range(len(items))]
+    with ThreadPoolExecutor(max_jobs or os.cpu_count() or 1) as executor:
+        return list(executor.map(function, items, configs))
+
+
+def run_astroref_concurrent(inputs: Iterable[Union[str, CCDData]], config: Config = Config.default(),
+                            max_jobs: Optional[int] = None, verbose: int = 1) -> List[Tuple[str, bytes, bytes]]:
+    """
+    run_astroref for many images at once, see map_isolated
+    :return: tuple(scamp_data, sextractor_data, reference_catalog_data) for every input, in the same order
+    """
+    return map_isolated(lambda input_data, job_config: run_astroref(input_data, job_config, verbose),
+                        inputs, config, max_jobs)
@@ -0,0 +1,205 @@
+"""
+Long running reduction server on a local Unix socket. The imports, the worker processes and the calibration cache
+stay warm between jobs, so a quick-look reduction of a handful of frames doesn't pay the startup cost every time.
+
+The protocol is one JSON object per line in each direction: the client sends {"command": ..., "kwargs": ...} and
+gets back {"ok": true/false, ...}. Commands are the job functions in jobs (called with the kwargs and the shared
+pool), 'status' and 'shutdown'.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import statistics
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from typing import Optional
+
+# only light imports here, clients shouldn't pay for importing the reduction (main is imported by the server)
+from .astromatic_config import Config
+from .classifier_common import Band
+
+default_socket = os.path.join(tempfile.gettempdir(), f'ir_reduce_{os.getuid()}.sock')
+# how many of the latest jobs the latency statistics are made of
+latency_history = 100
+
+# jobs the server accepts (functions of main), the reductions get the warm pool passed in
+jobs = {'do_everything': lambda main, pool, kwargs: main.do_everything(**kwargs, pool=pool),
+        'do_only_reduce': lambda main, pool, kwargs: main.do_only_reduce(**kwargs, pool=pool),
+        'do_only_astroref': lambda main, pool, kwargs: main.do_only_astroref(**kwargs)}
+
+
+def _encode(value):
+    """json default hook for the arguments of the job functions"""
+    if isinstance(value, Band):
+        return {'__band__': value.value}
+    if isinstance(value, Config):
+        return {'__config__': vars(value)}
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    raise TypeError(f'cannot send {value!r} to the server')
+
+
+def _decode(obj: dict):
+    """json object hook, reverse of _encode"""
+    if '__band__' in obj:
+        return Band.lookup(obj['__band__'])
+    if '__config__' in obj:
+        config = Config()
+        config.__dict__.update(obj['__config__'])
+        return config
+    return obj
+
+
+def dumps(message: dict) -> bytes:
+    return json.dumps(message, default=_encode).encode() + b'\n'
+
+
+def loads(line: bytes) -> dict:
+    return json.loads(line, object_hook=_decode)
+
+
+class ReductionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Accepts connections in threads, the jobs themselves are queued on an executor that limits how many of them
+    share the pool at the same time
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, pool, cache_dir: Optional[str] = None, concurrent_jobs: int = 1):
+        """
+        :param socket_path: where to listen, an old socket file there gets replaced
+        :param pool: multiprocessing pool or PoolDummy for all jobs
+        :param cache_dir: calibration cache for jobs that don't bring their own
+        :param concurrent_jobs: how many jobs run at the same time
+        """
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.socket_path = socket_path
+        self.pool = pool
+        self.cache_dir = cache_dir
+        self.executor = ThreadPoolExecutor(max(1, concurrent_jobs))
+        self.lock = threading.Lock()
+        self.queued = self.running = self.done = self.failed = 0
+        self.latencies = deque(maxlen=latency_history)
+
+    def run_job(self, command: str, kwargs: dict) -> dict:
+        """queue a job and wait for it, returns how long it waited and ran"""
+        from . import main
+        if command != 'do_only_astroref' and self.cache_dir and not kwargs.get('cache_dir'):
+            kwargs = dict(kwargs, cache_dir=self.cache_dir)
+        submitted = time.perf_counter()
+        with self.lock:
+            self.queued += 1
+
+        def run():
+            started = time.perf_counter()
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                jobs[command](main, self.pool, kwargs)
+            finally:
+                finished = time.perf_counter()
+                with self.lock:
+                    self.running -= 1
+                    self.latencies.append(finished - submitted)
+            return started - submitted, finished - started
+
+        try:
+            waited, seconds = self.executor.submit(run).result()
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        with self.lock:
+            self.done += 1
+        logging.info(f'{command} done after {waited:.2f}s in the queue and {seconds:.2f}s running')
+        return dict(waited=waited, seconds=seconds)
+
+    def status(self) -> dict:
+        with self.lock:
+            latencies = list(self.latencies)
+            return dict(queued=self.queued, running=self.running, done=self.done, failed=self.failed,
+                        median_latency=statistics.median(latencies) if latencies else None,
+                        max_latency=max(latencies) if latencies else None)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline())
+            command = request.get('command')
+            if command == 'status':
+                reply = dict(ok=True, **self.server.status())
+            elif command == 'shutdown':
+                reply = dict(ok=True)
+                # shutdown() waits for serve_forever to return, which can't happen while this handler blocks it
+                threading.Thread(target=self.server.shutdown).start()
+            elif command in jobs:
+                reply = dict(ok=True, **self.server.run_job(command, request.get('kwargs', {})))
+            else:
+                reply = dict(ok=False, error=f'unknown command {command}')
+        except Exception as err:
+            logging.exception('job failed')
+            reply = dict(ok=False, error=repr(err))
+        self.wfile.write(dumps(reply))
+
+
+def _warm_up(_) -> int:
+    return os.getpid()
+
+
+def serve(socket_path: str = default_socket, cache_dir: Optional[str] = None, single_thread: bool = False,
+          concurrent_jobs: int = 1) -> None:
+    """
+    run the server until it gets a shutdown command
+    :param socket_path: Unix socket to listen on
+    :param cache_dir: calibration cache shared by all jobs, see CalibrationCache
+    :param single_thread: don't use multiprocessing
+    :param concurrent_jobs: how many jobs share the pool at the same time
+    """
+    from .main import PoolDummy, n_cpu
+    _Pool = PoolDummy if single_thread else Pool
+    with _Pool(n_cpu) as pool:
+        # start all workers now instead of on the first job
+        pool.map(_warm_up, range(n_cpu))
+        with ReductionServer(socket_path, pool, cache_dir, concurrent_jobs) as server:
+            logging.info(f'listening on {socket_path} with {n_cpu} workers')
+            server.serve_forever()
+
+
+def request(message: dict, socket_path: str = default_socket) -> dict:
+    """
+    send a message to the server and wait for the reply
+    :raises RuntimeError: if the server reports an error
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(dumps(message))
+        with connection.makefile('rb') as reply_file:
+            reply = loads(reply_file.readline())
+    if not reply.pop('ok', False):
+        raise RuntimeError(f'server: {reply.get("error")}')
+    return reply
+
+
+def submit(command: str, socket_path: str = default_socket, **kwargs) -> dict:
+    """
+    run one of the jobs (e.g. 'do_only_reduce' with the arguments of main.do_only_reduce) on the server. Paths need
+    to be absolute, the server has its own working directory
+    :return: how long the job waited in the queue and ran
+    """
+    return request(dict(command=command, kwargs=kwargs), socket_path)
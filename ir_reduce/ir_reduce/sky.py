@@ -0,0 +1,177 @@
+"""
+Sky level estimation for a whole stack of frames at once and running sky subtraction for dither sequences
+"""
+import itertools
+import os
+from collections import namedtuple
+from typing import List
+
+import numpy as np
+
+from .combine import row_blocks
+from .frame_store import FrameStore, open_stack
+
+# the sorted window of a block of rows gets touched several times per frame, blocks that fit into the cpu cache are
+# a lot faster than big ones
+running_block_bytes = 2 * 1024 ** 2
+
+SkyStats = namedtuple('SkyStats', ['level', 'sigma', 'rejected'])
+SkyStats.__doc__ = """
+sky statistics of one frame: level is the sigma clipped median, sigma the standard deviation of the values that
+survived the clipping and rejected the fraction of values that got clipped (or were nan)
+"""
+
+
+def _window_median(values: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """median of values[i, lo[i]:hi[i]] for rows of sorted values"""
+    rows = np.arange(len(values))
+    n = hi - lo
+    lower = values[rows, np.clip(lo + (n - 1) // 2, 0, values.shape[1] - 1)]
+    upper = values[rows, np.clip(lo + n // 2, 0, values.shape[1] - 1)]
+    return np.where(n > 0, (lower + upper) / 2, np.nan)
+
+
+def clipped_sky(stack: np.ndarray, sigma: float = 3., maxiters: int = 3) -> List[SkyStats]:
+    """
+    Same as np.ma.median(SigmaClip(sigma, maxiters)(frame)) for every frame of the stack, but every frame gets
+    sorted only once. The values that survive the clipping are always a contiguous window of the sorted values, so
+    every iteration is just a search for the new window and its mean/std come from prefix sums.
+
+    :param stack: (frames, ...) values to estimate the sky from, e.g. the sky region of every frame
+    :param sigma: clip at median +/- sigma * std
+    :param maxiters: maximum number of clipping iterations
+    :return: statistics for every frame
+    """
+    values = np.sort(stack.reshape(len(stack), -1), axis=1)  # nan end up at the end
+    n_frames, n_values = values.shape
+    if not n_values:
+        return [SkyStats(np.nan, np.nan, 1.)] * n_frames
+    rows = np.arange(n_frames)
+    lo, hi = np.zeros(n_frames, dtype=np.intp), np.count_nonzero(~np.isnan(values), axis=1)
+
+    # prefix sums relative to a rough center of every frame to avoid cancellation in the variance
+    centered = values - _window_median(values, lo, hi).reshape(-1, 1)
+    centered[np.isnan(centered)] = 0
+    sums = np.zeros((n_frames, n_values + 1))
+    squares = np.zeros((n_frames, n_values + 1))
+    np.cumsum(centered, axis=1, out=sums[:, 1:])
+    np.cumsum(np.square(centered), axis=1, out=squares[:, 1:])
+
+    def window_std():
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n = hi - lo
+            mean = (sums[rows, hi] - sums[rows, lo]) / n
+            return np.sqrt(np.maximum(0, (squares[rows, hi] - squares[rows, lo]) / n - np.square(mean)))
+
+    for _ in range(maxiters):
+        median, std = _window_median(values, lo, hi), window_std()
+        new_lo, new_hi = lo.copy(), hi.copy()
+        for row in rows:
+            if hi[row] > lo[row]:
+                window = values[row, :hi[row]]
+                new_lo[row] = max(lo[row], np.searchsorted(window, median[row] - sigma * std[row], 'left'))
+                new_hi[row] = min(hi[row], np.searchsorted(window, median[row] + sigma * std[row], 'right'))
+        if np.all(new_lo == lo) and np.all(new_hi == hi):
+            break
+        lo, hi = new_lo, new_hi
+
+    rejected = 1 - (hi - lo) / n_values
+    return [SkyStats(*stats) for stats in zip(_window_median(values, lo, hi), window_std(), rejected)]
+
+
+def window_start(index: int, n_frames: int, window: int) -> int:
+    """
+    first frame of the window of window + 1 frames around index, shifted at the ends of the sequence so there are
+    always window neighbours
+    """
+    return int(np.clip(index - window // 2, 0, max(0, n_frames - window - 1)))
+
+
+def _replace_sorted(window: np.ndarray, old: np.ndarray, new: np.ndarray) -> np.ndarray:
+    """
+    remove old from and insert new into every column of the sorted window, O(window) instead of sorting again
+    :param window: (frames, pixels) sorted along the first axis, masked values are inf
+    :param old: (pixels,) values that are in window
+    :param new: (pixels,) values to insert instead
+    """
+    # without old: everything from its position on moves up by one
+    removed = np.where(window[:-1] < old, window[:-1], window[1:])
+    # with new: the value at every position is either the previous one, new or the same one
+    below = np.concatenate([np.full((1, window.shape[1]), -np.inf), removed])
+    above = np.concatenate([removed, np.full((1, window.shape[1]), np.inf)])
+    return np.maximum(below, np.minimum(new, above))
+
+
+def _pick(window: np.ndarray, ranks: np.ndarray) -> np.ndarray:
+    """window[ranks[i], i] for every column i"""
+    return window.reshape(-1)[ranks * window.shape[1] + np.arange(window.shape[1])]
+
+
+def running_sky_rows(data: np.ndarray, mask: np.ndarray, window: int, rows: slice = slice(None)) -> None:
+    """
+    Subtract the running sky in place: for every frame the median of the window nearest frames in time, ignoring
+    masked and nan pixels. The frames are visited in order while a per pixel sorted window of the frames is updated
+    incrementally, so only window + 1 frames of the rows are held in memory.
+
+    :param data: (frames, rows, columns) array, e.g. memory mapped from a FrameStore
+    :param mask: same shape as data, True where bad. Pixels without any good neighbour become masked
+    :param window: number of neighbours the sky is made of
+    :param rows: which rows to process
+    """
+    n_frames = len(data)
+    window = min(window, n_frames - 1)
+    if window < 1:
+        raise ValueError('running sky needs at least two frames')
+
+    def read(index):
+        values = np.array(data[index, rows], dtype=np.float64)
+        values[np.asarray(mask[index, rows]) | np.isnan(values)] = np.inf
+        return values.reshape(-1)
+
+    start = 0
+    values = {index: read(index) for index in range(window + 1)}
+    sorted_window = np.sort(np.stack(list(values.values())), axis=0)
+    n_finite = np.count_nonzero(np.isfinite(sorted_window), axis=0)
+    for index in range(n_frames):
+        new_start = window_start(index, n_frames, window)
+        if new_start != start:  # slides by one frame at most
+            old, new = values.pop(start), read(new_start + window)
+            values[new_start + window] = new
+            sorted_window = _replace_sorted(sorted_window, old, new)
+            n_finite += np.isfinite(new).astype(np.intp) - np.isfinite(old)
+            start = new_start
+
+        # median of the window without the frame itself, its value is skipped by moving the index past it
+        own = values[index]
+        own_rank = np.count_nonzero(sorted_window < own, axis=0)
+        n_valid = n_finite - np.isfinite(own)
+        lower, upper = (n_valid - 1) // 2, n_valid // 2
+        lower, upper = (np.clip(position + (position >= own_rank), 0, window) for position in (lower, upper))
+        sky = (_pick(sorted_window, lower) + _pick(sorted_window, upper)) / 2
+        sky[n_valid == 0] = np.nan
+
+        shape = data[index, rows].shape
+        data[index, rows] -= sky.reshape(shape)
+        mask[index, rows] |= np.isnan(sky).reshape(shape)
+
+
+def _running_sky_block(directory: str, rows: slice, window: int) -> None:
+    data, mask, _ = open_stack(directory, 'r+')
+    running_sky_rows(data, mask, window, rows)
+
+
+def running_sky(store: FrameStore, window: int, pool, block_bytes: int = running_block_bytes) -> FrameStore:
+    """
+    subtract the running sky (see running_sky_rows) from all frames in place. The rows are split into blocks that
+    are processed in the pool workers, block_bytes limits the size of the window of one block
+
+    :param store: frames in the order they were taken
+    :param window: number of neighbouring frames the sky of a frame is made of
+    :param pool: multiprocessing pool or PoolDummy
+    :param block_bytes: upper limit for window + 1 frames of one block of rows
+    :return: store
+    """
+    window = min(window, len(store) - 1)
+    blocks = row_blocks((window + 1,) + store.shape[1:], block_bytes, min_blocks=os.cpu_count() or 1)
+    pool.starmap(_running_sky_block, zip(itertools.repeat(store.directory), blocks, itertools.repeat(window)))
+    return store
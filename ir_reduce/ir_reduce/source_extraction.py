@@ -0,0 +1,314 @@
+"""
+In-process source extraction with numpy/scipy as a fast alternative to the SExtractor subprocess for quick-look and
+transient runs (Config.native_extractor). It follows SExtractor where that is cheap: mesh background with a median
+filtered grid, detection above DETECT_THRESH times the background rms, 8-connected labeling, windowed centroids with
+their errors, Kron (FLUX_AUTO) photometry and a star/galaxy score. There is no deblending and no filtering. The
+result is written as FITS_LDAC with the columns of the parameter file, so scamp and transient_detection read it like
+SExtractor output.
+"""
+import logging
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from astropy.io import fits
+from scipy import ndimage
+
+from .astromatic_config import Config
+from .ldac import write_ldac
+
+# supported output parameters: FITS format and unit, the same as SExtractor writes
+parameter_formats = {'NUMBER': ('J', ''),
+                     'X_IMAGE': ('D', 'pixel'), 'Y_IMAGE': ('D', 'pixel'),
+                     'XWIN_IMAGE': ('D', 'pixel'), 'YWIN_IMAGE': ('D', 'pixel'),
+                     'ERRAWIN_IMAGE': ('E', 'pixel'), 'ERRBWIN_IMAGE': ('E', 'pixel'),
+                     'ERRTHETAWIN_IMAGE': ('E', 'deg'),
+                     'ERRX2WIN_IMAGE': ('D', 'pixel**2'), 'ERRY2WIN_IMAGE': ('D', 'pixel**2'),
+                     'ERRXYWIN_IMAGE': ('D', 'pixel**2'),
+                     'A_IMAGE': ('E', 'pixel'), 'B_IMAGE': ('E', 'pixel'), 'THETA_IMAGE': ('E', 'deg'),
+                     'ISOAREA_IMAGE': ('J', 'pixel**2'), 'FLUX_ISO': ('E', 'count'),
+                     'FLUX_AUTO': ('E', 'count'), 'FLUXERR_AUTO': ('E', 'count'),
+                     'MAG_AUTO': ('E', 'mag'), 'MAGERR_AUTO': ('E', 'mag'),
+                     'MAG_BEST': ('E', 'mag'), 'MAGERR_BEST': ('E', 'mag'),
+                     'FLUX_RADIUS': ('E', 'pixel'), 'BACKGROUND': ('E', 'count'),
+                     'FLAGS': ('I', ''), 'FLAGS_WEIGHT': ('I', ''), 'IMAGEFLAGS_ISO': ('J', ''),
+                     'CLASS_STAR': ('E', '')}
+# the sextractor config values that are used and their defaults if the config file doesn't set them
+default_settings = {'DETECT_MINAREA': 5., 'DETECT_THRESH': 1.5, 'BACK_SIZE': 64., 'BACK_FILTERSIZE': 3.,
+                    'PHOT_AUTOPARAMS': (2.5, 3.5), 'SATUR_LEVEL': 50000., 'SATUR_KEY': 'SATURATE',
+                    'GAIN': 0., 'GAIN_KEY': 'GAIN', 'MAG_ZEROPOINT': 0.}
+# SExtractor flag bits
+flag_neighbours, flag_saturated, flag_truncated = 1, 4, 8
+# magnitude of sources with a non-positive flux
+bad_magnitude = 99.
+
+
+def extraction_settings(config: Config, header: fits.Header) -> dict:
+    """values from the SExtractor config file and config.sextractor_overrides, gain and saturation from the header"""
+    from .run_sextractor_scamp import parse_key_val_config
+    with open(config.sextractor_config) as f:
+        values = parse_key_val_config(f.read())
+    values.update(entry.split('=', 1) for entry in config.sextractor_overrides if entry)
+
+    settings = dict(default_settings)
+    for key, default in default_settings.items():
+        if key in values:
+            settings[key] = tuple(float(value) for value in values[key].split(',')) \
+                if isinstance(default, tuple) else type(default)(values[key])
+    settings['GAIN'] = float(header.get(settings['GAIN_KEY'], settings['GAIN']))
+    settings['SATUR_LEVEL'] = float(header.get(settings['SATUR_KEY'], settings['SATUR_LEVEL']))
+    return settings
+
+
+def read_parameters(path: str) -> List[str]:
+    """
+    output parameters of a SExtractor parameter file
+    :raises ValueError: if one of them is not supported
+    """
+    with open(path) as f:
+        parameters = [line.split('#')[0].strip() for line in f]
+    parameters = [parameter for parameter in parameters if parameter]
+    unsupported = [parameter for parameter in parameters if parameter not in parameter_formats]
+    if unsupported:
+        raise ValueError(f'the native source extractor does not support {", ".join(unsupported)}')
+    return parameters
+
+
+def background(data: np.ndarray, mask: np.ndarray, mesh: int = 64, filter_size: int = 3):
+    """
+    background and its rms like SExtractor: sigma clipped mode of every mesh, median filtered and interpolated
+    :return: background, rms, both in the shape of data
+    """
+    rows, columns = -(-data.shape[0] // mesh), -(-data.shape[1] // mesh)
+    padded = np.full((rows * mesh, columns * mesh), np.nan)
+    padded[:data.shape[0], :data.shape[1]] = np.where(mask, np.nan, data)
+    meshes = padded.reshape(rows, mesh, columns, mesh).transpose(0, 2, 1, 3).reshape(rows, columns, -1)
+
+    # sigma clipping on the sorted meshes: the clipped values are a contiguous range [low, high) of every mesh, its
+    # median is an index lookup and its mean and variance come from cumulative sums
+    values = np.sort(meshes, axis=-1)  # masked (nan) values go last
+    offset = np.nanmedian(values[..., values.shape[-1] // 4])  # against cancellation in the sum of squares
+    finite = np.where(np.isfinite(values), values - offset, 0)
+    sums = np.concatenate([np.zeros(values.shape[:-1] + (1,)), np.cumsum(finite, axis=-1)], axis=-1)
+    squares = np.concatenate([np.zeros(values.shape[:-1] + (1,)), np.cumsum(finite ** 2, axis=-1)], axis=-1)
+    low, high = np.zeros(values.shape[:-1], int), np.isfinite(values).sum(axis=-1)
+
+    def statistics(low, high):
+        count = np.maximum(high - low, 1)
+        middle = np.stack([low + (count - 1) // 2, low + count // 2], axis=-1)
+        median = np.take_along_axis(values, np.minimum(middle, values.shape[-1] - 1), axis=-1).mean(axis=-1)
+        mean = (np.take_along_axis(sums, high[..., None], -1) - np.take_along_axis(sums, low[..., None], -1))[..., 0]
+        mean_square = (np.take_along_axis(squares, high[..., None], -1)
+                       - np.take_along_axis(squares, low[..., None], -1))[..., 0]
+        mean, mean_square = mean / count, mean_square / count
+        return median, mean + offset, np.sqrt(np.maximum(mean_square - mean ** 2, 0))
+
+    for _ in range(3):
+        median, mean, rms = statistics(low, high)
+        low = (values < (median - 3 * rms)[..., None]).sum(axis=-1)
+        high = (values <= (median + 3 * rms)[..., None]).sum(axis=-1)
+    median, mean, rms = statistics(low, high)
+    empty = high == 0
+    median[empty], mean[empty], rms[empty] = np.nan, np.nan, np.nan
+    # mode estimate, the median if the mesh is crowded
+    mode = np.where(np.abs(mean - median) < 0.3 * rms, 2.5 * median - 1.5 * mean, median)
+
+    grids = []
+    for grid in mode, rms:
+        invalid = ~np.isfinite(grid)
+        if np.all(invalid):
+            grid = np.zeros(grid.shape)
+        elif np.any(invalid):  # fully masked meshes get the value of the nearest valid one
+            grid = grid[tuple(ndimage.distance_transform_edt(invalid, return_distances=False, return_indices=True))]
+        # extrapolated linearly beyond the border, so gradients don't flatten at the edges of the image
+        pad = filter_size // 2 + 1
+        grid = np.pad(grid, pad, mode='reflect', reflect_type='odd') if min(grid.shape) > pad \
+            else np.pad(grid, pad, mode='edge')
+        grid = ndimage.median_filter(grid, size=filter_size, mode='nearest')
+        # mesh centers are at (index + 0.5) * mesh - 0.5 in pixels
+        coordinates = [(np.arange(length) + 0.5) / mesh - 0.5 + pad for length in data.shape]
+        grids.append(ndimage.map_coordinates(grid, np.meshgrid(*coordinates, indexing='ij'), order=3,
+                                             mode='nearest'))
+    return grids[0], np.maximum(grids[1], np.finfo(np.float32).tiny)
+
+
+def _ellipse(x2: np.ndarray, y2: np.ndarray, xy: np.ndarray):
+    """semi axes and position angle (degrees, counterclockwise from x) of second moments"""
+    mean, difference = (x2 + y2) / 2, np.sqrt(((x2 - y2) / 2) ** 2 + xy ** 2)
+    return np.sqrt(mean + difference), np.sqrt(np.maximum(mean - difference, 0)), \
+        np.degrees(0.5 * np.arctan2(2 * xy, x2 - y2))
+
+
+def extract_sources(data: np.ndarray, mask: Optional[np.ndarray] = None,
+                    settings: Optional[dict] = None) -> Dict[str, np.ndarray]:
+    """
+    detect and measure sources
+    :param data: image, not background subtracted
+    :param mask: True for pixels to ignore
+    :param settings: see default_settings and extraction_settings
+    :return: every entry of parameter_formats for every source, ordered by position
+    """
+    settings = dict(default_settings, **(settings or dict()))
+    data = np.asarray(data, dtype=np.float64)
+    mask = ~np.isfinite(data) if mask is None else np.asarray(mask, bool) | ~np.isfinite(data)
+    gain = settings['GAIN']
+    kron_factor, min_kron_radius = settings['PHOT_AUTOPARAMS']
+
+    back, rms = background(data, mask, int(settings['BACK_SIZE']), int(settings['BACK_FILTERSIZE']))
+    signal = np.where(mask, 0, data - back)
+
+    labels, n_labels = ndimage.label((signal > settings['DETECT_THRESH'] * rms) & ~mask, structure=np.ones((3, 3)))
+    areas = np.bincount(labels.ravel(), minlength=n_labels + 1)
+    keep = areas >= settings['DETECT_MINAREA']
+    keep[0] = False
+    labels = np.where(keep[labels], np.cumsum(keep)[labels], 0)
+    n = int(keep.sum())
+    index = np.arange(1, n + 1)
+
+    # isophotal moments, intensities clipped to positive values like SExtractor
+    positive = np.maximum(signal, 0)
+    rows, columns = np.indices(data.shape)
+    flux_iso = ndimage.sum(signal, labels, index)
+    weight = np.maximum(ndimage.sum(positive, labels, index), np.finfo(float).tiny)
+    x = ndimage.sum(positive * columns, labels, index) / weight
+    y = ndimage.sum(positive * rows, labels, index) / weight
+    x2 = ndimage.sum(positive * columns ** 2, labels, index) / weight - x ** 2
+    y2 = ndimage.sum(positive * rows ** 2, labels, index) / weight - y ** 2
+    xy = ndimage.sum(positive * columns * rows, labels, index) / weight - x * y
+    # point-like sources: at least the moments of a pixel
+    x2, y2 = np.maximum(x2, 1 / 12), np.maximum(y2, 1 / 12)
+    a, b, theta = _ellipse(x2, y2, xy)
+    b = np.maximum(b, 0.5 * a / 10)
+    saturated = ndimage.maximum(np.where(mask, -np.inf, data), labels, index) >= settings['SATUR_LEVEL'] \
+        if n else np.zeros(0, bool)
+
+    result = {name: np.zeros(n) for name in parameter_formats}
+    flags = np.where(saturated, flag_saturated, 0)
+    for i in range(n):
+        # elliptical coordinate, 1 on the isophotal ellipse
+        cos, sin = np.cos(np.radians(theta[i])), np.sin(np.radians(theta[i]))
+        cxx, cyy = cos ** 2 / a[i] ** 2 + sin ** 2 / b[i] ** 2, sin ** 2 / a[i] ** 2 + cos ** 2 / b[i] ** 2
+        cxy = 2 * cos * sin * (1 / a[i] ** 2 - 1 / b[i] ** 2)
+        # large enough for the biggest Kron aperture
+        radius = int(np.ceil(max(6 * a[i] * kron_factor, min_kron_radius))) + 2
+        top, left = max(0, int(y[i]) - radius), max(0, int(x[i]) - radius)
+        window = (slice(top, min(data.shape[0], int(y[i]) + radius + 1)),
+                  slice(left, min(data.shape[1], int(x[i]) + radius + 1)))
+        grid_y = np.arange(window[0].start, window[0].stop)[:, None]
+        grid_x = np.arange(window[1].start, window[1].stop)[None, :]
+        dx, dy = grid_x - x[i], grid_y - y[i]
+        elliptical = np.sqrt(np.maximum(cxx * dx ** 2 + cyy * dy ** 2 + cxy * dx * dy, 0))
+        distance = np.sqrt(dx ** 2 + dy ** 2)
+        valid = ~mask[window]
+        cut_signal, cut_positive, cut_rms = signal[window], positive[window], rms[window]
+
+        # Kron radius (first moment within 6 isophotal radii) and the aperture
+        within = valid & (elliptical <= 6)
+        kron = np.sum(elliptical * cut_positive * within) / max(np.sum(cut_positive * within), 1e-30)
+        if kron_factor * kron * np.sqrt(a[i] * b[i]) < min_kron_radius:
+            aperture, extent = distance <= min_kron_radius, min_kron_radius
+        else:
+            aperture, extent = elliptical <= kron_factor * kron, kron_factor * kron * a[i]
+        if x[i] - extent < -0.5 or y[i] - extent < -0.5 or x[i] + extent > data.shape[1] - 0.5 \
+                or y[i] + extent > data.shape[0] - 0.5:
+            flags[i] |= flag_truncated
+        if np.any((labels[window] != 0) & (labels[window] != i + 1) & aperture):
+            flags[i] |= flag_neighbours
+        aperture &= valid
+        flux = np.sum(cut_signal[aperture])
+        variance = np.sum(cut_rms[aperture] ** 2) + (max(flux, 0) / gain if gain > 0 else 0)
+        result['FLUX_AUTO'][i], result['FLUXERR_AUTO'][i] = flux, np.sqrt(variance)
+
+        # half light radius within the aperture
+        order = np.argsort(distance[aperture])
+        growth = np.cumsum(cut_signal[aperture][order])
+        half = int(np.searchsorted(growth, 0.5 * flux)) if flux > 0 else 0
+        result['FLUX_RADIUS'][i] = distance[aperture][order][min(half, len(order) - 1)] if len(order) else 0.
+
+        # windowed centroid, gaussian window with the FWHM of the half light diameter
+        sigma = max(2 * result['FLUX_RADIUS'][i] / 2.35, 0.5)
+        pixel_variance = cut_rms ** 2 + (cut_positive / gain if gain > 0 else 0)
+        xwin, ywin = x[i], y[i]
+        for _ in range(16):
+            wx, wy = grid_x - xwin, grid_y - ywin
+            squared = wx ** 2 + wy ** 2
+            w = np.exp(-squared / (2 * sigma ** 2)) * (valid & (squared < (4 * sigma) ** 2))
+            norm = np.sum(w * cut_signal)
+            if norm <= 0:
+                xwin, ywin = x[i], y[i]
+                break
+            shift_x, shift_y = 2 * np.sum(w * cut_signal * wx) / norm, 2 * np.sum(w * cut_signal * wy) / norm
+            xwin, ywin = xwin + shift_x, ywin + shift_y
+            if abs(xwin - x[i]) > radius or abs(ywin - y[i]) > radius:  # diverged, keep the isophotal one
+                xwin, ywin = x[i], y[i]
+                break
+            if shift_x ** 2 + shift_y ** 2 < 4e-8:
+                break
+        wx, wy = grid_x - xwin, grid_y - ywin
+        w = np.exp(-(wx ** 2 + wy ** 2) / (2 * sigma ** 2)) * (valid & (wx ** 2 + wy ** 2 < (4 * sigma) ** 2))
+        norm = max(np.sum(w * cut_signal), 1e-30)
+        result['XWIN_IMAGE'][i], result['YWIN_IMAGE'][i] = xwin, ywin
+        result['ERRX2WIN_IMAGE'][i] = 4 * np.sum(w ** 2 * pixel_variance * wx ** 2) / norm ** 2
+        result['ERRY2WIN_IMAGE'][i] = 4 * np.sum(w ** 2 * pixel_variance * wy ** 2) / norm ** 2
+        result['ERRXYWIN_IMAGE'][i] = 4 * np.sum(w ** 2 * pixel_variance * wx * wy) / norm ** 2
+
+    result['ERRAWIN_IMAGE'], result['ERRBWIN_IMAGE'], result['ERRTHETAWIN_IMAGE'] = _ellipse(
+        result['ERRX2WIN_IMAGE'], result['ERRY2WIN_IMAGE'], result['ERRXYWIN_IMAGE'])
+    # FITS pixel coordinates start at 1
+    result['XWIN_IMAGE'] += 1
+    result['YWIN_IMAGE'] += 1
+    result['X_IMAGE'], result['Y_IMAGE'] = x + 1, y + 1
+    result['A_IMAGE'], result['B_IMAGE'], result['THETA_IMAGE'] = a, b, theta
+    result['ISOAREA_IMAGE'] = areas[keep]
+    result['FLUX_ISO'] = flux_iso
+    result['BACKGROUND'] = back[np.clip(np.round(y).astype(int), 0, data.shape[0] - 1),
+                                np.clip(np.round(x).astype(int), 0, data.shape[1] - 1)]
+    positive_flux = result['FLUX_AUTO'] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result['MAG_AUTO'] = np.where(positive_flux, settings['MAG_ZEROPOINT'] - 2.5 * np.log10(result['FLUX_AUTO']),
+                                      bad_magnitude)
+        result['MAGERR_AUTO'] = np.where(positive_flux, 1.0857 * result['FLUXERR_AUTO'] / result['FLUX_AUTO'],
+                                         bad_magnitude)
+    result['MAG_BEST'], result['MAGERR_BEST'] = result['MAG_AUTO'], result['MAGERR_AUTO']
+    result['FLAGS'] = flags
+    result['CLASS_STAR'] = class_star(result['FLUX_RADIUS'], result['FLUX_AUTO'] / result['FLUXERR_AUTO'], flags)
+    result['NUMBER'] = index
+    return result
+
+
+def class_star(flux_radius: np.ndarray, snr: np.ndarray, flags: np.ndarray) -> np.ndarray:
+    """
+    star/galaxy score between 0 (extended) and 1 (point source) from the half light radius compared to the one of
+    the stars, estimated from the clean, high signal to noise sources. Faint sources get 0.5
+    """
+    score = np.full(len(flux_radius), 0.5)
+    reference = (flags == 0) & (snr > 20)
+    if not np.any(reference):
+        return score
+    # the stellar locus is the lower end of the radii of bright sources
+    stellar_radius = np.percentile(flux_radius[reference], 30)
+    ratio = flux_radius / max(stellar_radius, 1e-3)
+    measurable = snr > 5
+    score[measurable] = 1 / (1 + np.exp((ratio[measurable] - 1.25) / 0.07))
+    return score
+
+
+def write_catalog(path: str, sources: Dict[str, np.ndarray], parameters: Sequence[str], header: fits.Header) -> None:
+    """FITS_LDAC catalog like SExtractor writes it, header is the image header for LDAC_IMHEAD"""
+    write_ldac(path, header, [fits.Column(name=parameter, format=parameter_formats[parameter][0],
+                                          unit=parameter_formats[parameter][1] or None,
+                                          array=sources[parameter]) for parameter in parameters])
+
+
+def extract_catalog(path: str, data: np.ndarray, header: fits.Header, config: Config,
+                    mask: Optional[np.ndarray] = None) -> int:
+    """
+    the native replacement of running sex with config: extract the sources of an image and write them to path
+    :param header: image header including WCS, scamp needs it in the catalog
+    :return: number of sources
+    """
+    start = time.perf_counter()
+    sources = extract_sources(data, mask, extraction_settings(config, header))
+    write_catalog(path, sources, read_parameters(config.sextractor_param), header)
+    logging.info(f'native source extraction: {len(sources["NUMBER"])} sources in {time.perf_counter() - start:.2f}s')
+    return len(sources['NUMBER'])
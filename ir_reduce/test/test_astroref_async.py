@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from astropy.nddata import CCDData
+from ir_reduce import do_only_astroref, run_sextractor_scamp
+from ir_reduce.astroref_async import astroref_pipeline, run_astroref_pipelined, run_tool
+from ir_reduce.run_sextractor_scamp import image_pixels, tool_timeout
+from .test_sextractor import fake_binaries, fake_runtime  # noqa F401, fixture
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_run_tool_logs_output(caplog):
+    script = 'import sys, time\nprint("first")\nsys.stdout.flush()\ntime.sleep(0.2)\n' \
+             'print("\\x1b[1Mprogress\\rdone", file=sys.stderr)'
+    with caplog.at_level(logging.INFO), tempfile.TemporaryDirectory() as working_dir:
+        run(run_tool([sys.executable, '-c', script], working_dir, 10))
+    name = os.path.basename(sys.executable)
+    assert [f'{name}: first', f'{name}: progress', f'{name}: done'] == \
+        [record.getMessage() for record in caplog.records if record.getMessage().startswith(name + ':')]
+
+
+def test_run_tool_errors():
+    with tempfile.TemporaryDirectory() as working_dir:
+        with pytest.raises(RuntimeError, match='went wrong'):
+            run(run_tool([sys.executable, '-c', 'import sys; print("went wrong"); sys.exit(1)'], working_dir, 10))
+
+        start = time.perf_counter()
+        with pytest.raises(subprocess.TimeoutExpired):
+            run(run_tool([sys.executable, '-c', 'import time; time.sleep(10)'], working_dir, 0.5))
+        assert time.perf_counter() - start < 5
+
+
+def test_tool_timeout():
+    assert tool_timeout(0) == run_sextractor_scamp.base_timeout
+    assert tool_timeout(4 * 10 ** 6) > tool_timeout(10 ** 6) > tool_timeout(0)
+    assert tool_timeout(0, 3) == 3 * run_sextractor_scamp.base_timeout
+    assert image_pixels(CCDData(np.zeros((3, 4)), unit='adu')) == 12
+    assert image_pixels('does_not_exist.fits') == 0
+
+
+@pytest.mark.parametrize('working_dir', [False, True])
+def test_pipeline(fake_binaries, working_dir):
+    inputs = [f'image{index}.fits' for index in range(6)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fake_binaries.working_dir = tmpdir if working_dir else ''
+        start = time.perf_counter()
+        results = run_astroref_pipelined(inputs, fake_binaries)
+        seconds = time.perf_counter() - start
+        assert len(os.listdir(tmpdir)) == (len(inputs) if working_dir else 0)
+    assert [scamp_data for scamp_data, _, _ in results] == [f'COMMENT {path}\nEND' for path in inputs]
+    assert [sex_data for _, sex_data, _ in results] == [path.encode() for path in inputs]
+    assert all(reference == b'reference' for _, _, reference in results)
+    # one after the other the images take 2 * fake_runtime each, pipelined about one fake_runtime
+    assert seconds < len(inputs) * 2 * fake_runtime
+
+
+def test_pipeline_in_thread(fake_binaries):
+    """before python 3.8 asyncio subprocesses only work with a child watcher attached in the main thread"""
+    with ThreadPoolExecutor(1) as executor:
+        results = executor.submit(run_astroref_pipelined, ['image0.fits', 'image1.fits'], fake_binaries).result()
+    assert [sex_data for _, sex_data, _ in results] == [b'image0.fits', b'image1.fits']
+
+
+def test_pipeline_failure(fake_binaries):
+    fake_binaries.scamp_cmd = 'false'
+    with pytest.raises(RuntimeError, match='false failed'):
+        run(astroref_pipeline(['image0.fits', 'image1.fits'], fake_binaries))
+
+
+def test_do_only_astroref_pipelined(fake_binaries):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        images = [os.path.join(tmpdir, f'in{index}.fits') for index in range(3)]
+        outputs = [os.path.join(tmpdir, f'out{index}.fits') for index in range(3)]
+        for index, image in enumerate(images):
+            CCDData(np.full((8, 8), float(index)), unit='electron').write(image)
+
+        do_only_astroref(images, outputs, fake_binaries, pipelined=True)
+
+        for index, output in enumerate(outputs):
+            assert np.all(CCDData.read(output).data == index)
+            with open(output.replace('.fits', '_scamp.head')) as f:
+                assert f.read().startswith('COMMENT sextractorInput')
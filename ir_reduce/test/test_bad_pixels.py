@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+import scipy.ndimage as ndimage
+from astropy import units as u
+from astropy.nddata import CCDData
+from ir_reduce import fix_pix, interpolate
+from ir_reduce.bad_pixels import apply_plan, cached_plan, fix_pix_data, interpolation_plan
+from ir_reduce.frame_store import FrameStore
+
+
+def fix_pix_reference(im, mask):
+    """the original loop over all domains"""
+    domains, n = ndimage.label(ndimage.binary_dilation(mask))
+    y, x = np.indices(im.shape, dtype=int)[-2:]
+    cleaned = im.copy()
+    for d in (np.arange(n) + 1):
+        i = (domains == d)
+        x0, x1 = x[i].min(), x[i].max() + 1
+        y0, y1 = y[i].min(), y[i].max() + 1
+        cleaned[i * mask] = im[y0: y1, x0: x1][~mask[y0: y1, x0: x1]].mean()
+    return cleaned
+
+
+def make_image(seed=0, shape=(60, 50)):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(1000, 30, shape)
+    mask = rng.random(shape) > 0.97
+    # extended and border domains
+    mask[10:14, 20:23] = True
+    mask[0, :5] = True
+    mask[-3:, -1] = True
+    return data, mask
+
+
+def test_same_as_reference():
+    data, mask = make_image()
+    data[mask] = -1e6
+    assert np.allclose(fix_pix_data(data, mask), fix_pix_reference(data, mask))
+
+
+def test_nonfinite_good_pixels():
+    data, mask = make_image(1)
+    data[12, 23] = np.nan  # good pixel inside the box of the extended domain
+    with np.errstate(invalid='ignore'):
+        expected = fix_pix_reference(data, mask)
+    assert np.allclose(fix_pix_data(data, mask), expected, equal_nan=True)
+    assert np.isnan(fix_pix_data(data, mask)[11, 21])
+
+
+def test_no_bad_pixels():
+    data, _ = make_image()
+    assert np.all(fix_pix_data(data, np.zeros(data.shape, dtype=bool)) == data)
+
+
+def test_fix_pix_store(pool):
+    images = []
+    for seed in range(3):
+        data, mask = make_image(seed)
+        images.append(CCDData(data, mask=mask, unit=u.electron))
+    expected = [fix_pix_reference(image.data, image.mask) for image in images]
+
+    with FrameStore.from_ccds(images) as store:
+        store.map(fix_pix, pool)
+        for fixed, stored in zip(expected, store.to_ccds()):
+            assert np.allclose(stored.data, fixed)
+
+
+def test_bilinear_plan():
+    data = np.add.outer(np.arange(8.), 2 * np.arange(9.))  # linear in both directions
+    bad = np.zeros(data.shape, dtype=bool)
+    bad[3:5, 4] = True
+    bad[0, 0] = True
+    bad[:, 7] = True  # whole column, only the row direction is left
+    bad[6, :] = True  # whole row, only the column direction is left
+    corrupted = np.where(bad, np.nan, data)
+
+    interpolated = apply_plan(corrupted, interpolation_plan(bad))
+    inner = np.ones(data.shape, dtype=bool)
+    inner[0, :] = inner[:, 0] = inner[:, -1] = False  # borders get extrapolated with the nearest value
+    inner[6, 7] = False  # no good pixel in either direction, gets the nearest one
+    assert np.allclose(interpolated[bad & inner], data[bad & inner])
+    assert np.isclose(interpolated[0, 0], np.mean([data[0, 1], data[1, 0]]))
+    assert interpolated[6, 7] in (data[5, 6], data[5, 8], data[7, 6], data[7, 8])
+    assert not np.isnan(interpolated).any()
+
+
+def test_nearest_plan():
+    data = np.arange(30.).reshape(5, 6)
+    bad = np.zeros(data.shape, dtype=bool)
+    bad[2, 1:5] = True
+    interpolated = apply_plan(data, interpolation_plan(bad, 'nearest'))
+    for column in range(2, 4):
+        assert interpolated[2, column] in (data[1, column], data[3, column])
+    assert interpolated[2, 1] in (data[1, 1], data[3, 1], data[2, 0])
+    assert np.all(interpolated[~bad] == data[~bad])
+
+
+def test_cached_plan():
+    bad = np.zeros((5, 6), dtype=bool)
+    bad[1, 2] = True
+    assert cached_plan(bad) is cached_plan(bad.copy())
+    assert cached_plan(bad, 'nearest') is not cached_plan(bad)
+    assert np.isnan(apply_plan(np.ones((5, 6)), interpolation_plan(np.ones((5, 6), dtype=bool)))).all()
+
+
+def test_interpolate_store(pool):
+    images = []
+    good = np.ones((20, 30), dtype=bool)
+    good[5, 5:9] = False
+    for i in range(3):
+        images.append(CCDData(np.full((20, 30), float(i)), mask=good, unit=u.electron))
+        images[-1].data[~good] = -1e6
+
+    with FrameStore.from_ccds(images) as store:
+        store.map(interpolate, pool, 'bilinear')
+        for i, stored in enumerate(store.to_ccds()):
+            assert np.allclose(stored.data, i)
@@ -0,0 +1,92 @@
+import logging
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from ir_reduce import find_jobs, run_batch, reduce_image
+from ir_reduce.batch import group_pointings, job_name, pointing
+from ir_reduce.classifier_common import Band
+from .test_reduce import write_exposure
+
+
+def write_night(tmpdir):
+    flats = []
+    for band in ('J', 'H'):
+        header = fits.Header({'INSTRUME': 'NOTCAM', 'IMAGECAT': 'CALIB', 'IMAGETYP': 'FLAT', 'NCFLTNM2': band,
+                              'BUNIT': 'count'})
+        flats.append(os.path.join(tmpdir, f'flat{band}.fits'))
+        fits.PrimaryHDU(np.full((256, 256), 5000.), header=header).writeto(flats[-1])
+
+    images = []
+    # two pointings of a supernova in J, one in H, a standard star in J and something in Ks without flat
+    for target, band, crval, n in [('SN 2018xyz', 'J', 150, 3), ('SN 2018xyz', 'J', 151, 2),
+                                   ('SN 2018xyz', 'H', 150, 2), ('FS 23', 'J', 80, 2), ('FS 23', 'Ks', 80, 2)]:
+        for i in range(n):
+            path = write_exposure(os.path.join(tmpdir, f'im{len(images):02}.fits'), band, i)
+            fits.setval(path, 'OBJECT', value=target)
+            fits.setval(path, 'CRVAL1', value=crval)
+            images.append(path)
+    return flats, images
+
+
+def test_pointings():
+    header = fits.Header({'NAXIS1': 100, 'NAXIS2': 100, 'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CRPIX1': 50.5,
+                          'CRPIX2': 50.5, 'CRVAL1': 10., 'CRVAL2': 89.99, 'CDELT1': -1e-4, 'CDELT2': 1e-4})
+    vector = pointing(header)
+    assert np.allclose(np.linalg.norm(vector), 1)
+    assert pointing(fits.Header()) is None
+
+    other = header.copy()
+    other['CRVAL1'] = 190.  # across the pole, but close
+    far = header.copy()
+    far['CRVAL2'] = 80.
+    assert group_pointings([vector, pointing(far), None, pointing(other), None], radius=0.1) == [0, 1, 2, 0, 2]
+    assert group_pointings([None, vector]) == [0, 1]
+    # the nearest pointing wins, not the first one within radius
+    between = header.copy()
+    between['CRVAL2'] = 89.935
+    second = header.copy()
+    second['CRVAL2'] = 89.9
+    assert group_pointings([vector, pointing(second), pointing(between)], radius=0.08) == [0, 1, 1]
+    assert job_name(' SN 2018/xyz ', Band.Ks, 1) == 'SN_2018_xyz_Ks_1'
+
+
+def test_find_jobs(caplog):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        flats, images = write_night(tmpdir)
+        with caplog.at_level(logging.WARNING), mock.patch('astropy.io.fits.getheader',
+                                                          side_effect=fits.getheader) as getheader:
+            jobs = find_jobs([], flats, images)
+        # every header is only read once
+        assert sorted(call[0][0] for call in getheader.call_args_list) == sorted(flats + images)
+
+    assert [job.name for job in jobs] == ['FS_23_J_0', 'SN_2018xyz_H_0', 'SN_2018xyz_J_0', 'SN_2018xyz_J_1']
+    assert [len(job.paths.images) for job in jobs] == [2, 2, 3, 2]
+    assert all(job.paths.flat == [flats[0] if job.band == Band.J else flats[1]] for job in jobs)
+    assert jobs[2].paths.images == images[:3]
+    assert 'no flat for band Ks' in caplog.text
+
+
+@pytest.mark.parametrize('single_thread, concurrent_jobs', [(True, 1), (False, 2)])
+def test_run_batch(single_thread, concurrent_jobs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        flats, images = write_night(tmpdir)
+        jobs = find_jobs([], flats, images)
+        # a broken exposure only fails its own job
+        with open(jobs[0].paths.images[0], 'wb') as f:
+            f.write(b'not a fits file')
+
+        output_dir = os.path.join(tmpdir, 'out')
+        results = run_batch(jobs, output_dir, single_thread=single_thread, concurrent_jobs=concurrent_jobs,
+                            combine='average')
+        assert [result.job for result in results] == jobs
+        assert results[0].error is not None and results[0].output is None
+        for result in results[1:]:
+            assert result.error is None
+            assert result.output == os.path.join(output_dir, result.job.name + '.fits')
+
+        expected = reduce_image([], flats, jobs[1].paths.images, Band.H, 'average', single_thread=True)
+        assert np.allclose(fits.getdata(results[1].output), expected.data, equal_nan=True)
@@ -0,0 +1,125 @@
+import logging
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.io import fits
+from astropy.nddata import CCDData
+from ir_reduce import read_calibrations, tiled_process
+from ir_reduce.calibration_cache import CalibrationCache, content_key
+
+
+def test_content_key():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        a, b = os.path.join(tmpdir, 'a'), os.path.join(tmpdir, 'b')
+        for path, content in ((a, b'a'), (b, b'b')):
+            with open(path, 'wb') as f:
+                f.write(content)
+
+        key = content_key('product', [a, b], foo=1)
+        assert key == content_key('product', [b, a], foo=1)
+        assert key != content_key('product', [a, b], foo=2)
+        assert key != content_key('other', [a, b], foo=1)
+
+        with open(b, 'wb') as f:
+            f.write(b'changed content')
+        assert key != content_key('product', [a, b], foo=1)
+
+
+def test_get_creates_once():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = CalibrationCache(tmpdir)
+        factory = mock.Mock(return_value=np.arange(5))
+
+        first = cache.load('range', factory, n=5)
+        second = cache.load('range', factory, n=5)
+        assert factory.call_count == 1
+        assert np.all(first == second)
+
+        # a fresh instance (e.g. next run) finds the product as well
+        assert np.all(CalibrationCache(tmpdir).load('range', factory, n=5) == first)
+        assert factory.call_count == 1
+
+
+def test_eviction():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        size = np.zeros(100).nbytes
+        cache = CalibrationCache(tmpdir, max_bytes=int(2.5 * size))
+
+        oldest = cache.get('zeros', lambda: np.zeros(100), n=0)
+        os.utime(oldest.path, (0, 0))
+        newer = cache.get('zeros', lambda: np.zeros(100), n=1)
+        newest = cache.get('zeros', lambda: np.zeros(100), n=2)
+
+        assert not os.path.exists(oldest.path)
+        assert os.path.exists(newer.path)
+        assert os.path.exists(newest.path)
+        assert cache.size() <= cache.max_bytes
+
+
+def test_eviction_grace():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        size = np.zeros(100).nbytes
+        cache = CalibrationCache(tmpdir, max_bytes=size // 2, grace_seconds=60)
+        # another job may have just been handed this one
+        recent = cache.get('zeros', lambda: np.zeros(100), n=0)
+        cache.get('zeros', lambda: np.zeros(100), n=1)
+        assert os.path.exists(recent.path)
+
+        # temporary files of failed processes are removed once they are old, ones being written stay
+        abandoned, in_progress = os.path.join(tmpdir, 'abandoned.npy.tmp'), os.path.join(tmpdir, 'writing.npy.tmp')
+        for path in (abandoned, in_progress):
+            with open(path, 'wb') as f:
+                f.write(bytes(10))
+        os.utime(abandoned, (0, 0))
+        assert cache.size() == 2 * os.path.getsize(recent.path) + 20
+        cache.evict()
+        assert not os.path.exists(abandoned) and os.path.exists(in_progress)
+
+
+def test_get_failures():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = CalibrationCache(tmpdir)
+        # a product that can't be saved leaves no temporary file behind
+        with mock.patch('numpy.save', side_effect=OSError('disk full')):
+            with pytest.raises(OSError):
+                cache.get('range', lambda: np.arange(5), n=5)
+        assert os.listdir(tmpdir) == []
+
+        # evicted by another process between the check and the use: created again
+        handle = cache.get('range', lambda: np.arange(5), n=5)
+        os.remove(handle.path)
+        factory = mock.Mock(return_value=np.arange(5))
+        assert np.all(cache.load('range', factory, n=5) == np.arange(5))
+        assert factory.call_count == 1
+
+
+def test_read_calibrations_cached(caplog):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bad_data = np.zeros((4, 4), dtype=np.int16)
+        bad_data[1, 2] = 1
+        bad_path, flat_path = os.path.join(tmpdir, 'bad.fits'), os.path.join(tmpdir, 'flat.fits')
+        fits.PrimaryHDU(bad_data, header=fits.Header({'BUNIT': 'adu'})).writeto(bad_path)
+        fits.PrimaryHDU(np.arange(16.).reshape(4, 4) + 1, header=fits.Header({'BUNIT': 'adu'})).writeto(flat_path)
+        cache = CalibrationCache(os.path.join(tmpdir, 'cache'))
+
+        bads, flat = read_calibrations([bad_path], flat_path, cache=cache)
+        with caplog.at_level(logging.INFO):
+            cached_bads, cached_flat = read_calibrations([bad_path], flat_path, cache=cache)
+        assert 'using cached bad_mask' in caplog.text
+        assert 'using cached flat_normed' in caplog.text
+
+        assert np.all(cached_bads[0].data == bad_data.astype(bool))
+        assert np.allclose(cached_flat.data, flat.data)
+        assert np.isclose(flat.data.mean(), 1)
+
+        image = CCDData(np.ones((4, 4)), unit=u.count)
+        for idx in range(1, 5):
+            image.header['GAIN' + str(idx)] = idx
+            image.header['RDNOISE' + str(idx)] = idx
+        processed = tiled_process(bads, flat, [image.copy()], cache=cache)[0]
+        assert np.allclose(processed.data, tiled_process(bads, flat, [image.copy()])[0].data)
+        assert len([name for name in os.listdir(cache.directory) if name.startswith('gain_map')]) == 1
@@ -0,0 +1,119 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+from astropy.nddata import StdDevUncertainty
+from ir_reduce.checkpoint import Checkpoints, Stage, run_stages, stage_keys
+from ir_reduce.frame_store import FrameStore
+from .test_frame_store import make_images
+
+
+def add(value, store):
+    store.data[...] += value
+
+
+def make_stages(calls, offset=1):
+    def stage(name, value):
+        def run(store):
+            calls.append(name)
+            add(value, store)
+        return Stage(name, run, dict(value=value))
+    return [stage('first', offset), stage('second', 10), stage('third', 100)]
+
+
+@pytest.fixture
+def files():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for name in ['flat', 'image1', 'image2']:
+            paths.append(os.path.join(directory, name))
+            with open(paths[-1], 'w') as f:
+                f.write(name)
+        yield paths
+
+
+def test_save_load():
+    images = make_images()
+    images[1].uncertainty = StdDevUncertainty(np.ones(images[1].shape))
+    with tempfile.TemporaryDirectory() as directory:
+        with FrameStore.from_ccds(images) as store:
+            store.mask[2, 3, 4] = True
+            store.save(directory)
+        with FrameStore.load(directory) as loaded:
+            for image, stored in zip(images, loaded.to_ccds()):
+                assert np.all(stored.data == image.data)
+                assert stored.header['INDEX'] == image.header['INDEX']
+                assert (stored.uncertainty is None) == (image.uncertainty is None)
+            assert loaded.mask[2, 3, 4] and loaded.mask.sum() == 1
+
+
+def test_keys(files):
+    flat, *images = files
+    keys = stage_keys(make_stages([]), [flat], images)
+    assert len(set(keys)) == 3
+    # a changed stage changes its own key and all later ones
+    changed = stage_keys(make_stages([], offset=2), [flat], images)
+    assert not set(keys) & set(changed)
+    changed = stage_keys(make_stages([])[:2] + [Stage('third', None, dict(value=5))], [flat], images)
+    assert changed[:2] == keys[:2] and changed[2] != keys[2]
+    # the order of the images matters, input content too
+    assert stage_keys(make_stages([]), [flat], images[::-1])[0] != keys[0]
+    with open(flat, 'w') as f:
+        f.write('other flat')
+    assert stage_keys(make_stages([]), [flat], images)[0] != keys[0]
+
+
+def test_resume(files, pool):
+    flat, *images = files
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoints = Checkpoints(directory)
+
+        def run(calls, stages):
+            keys = stage_keys(stages, [flat], images)
+            with run_stages(stages, lambda: FrameStore.from_ccds(make_images()), checkpoints, keys) as store:
+                return store.data.copy()
+
+        calls = []
+        first = run(calls, make_stages(calls))
+        assert calls == ['first', 'second', 'third']
+        assert np.all(first == np.stack([image.data for image in make_images()]) + 111)
+
+        # everything is there already
+        calls = []
+        assert np.all(run(calls, make_stages(calls)) == first)
+        assert calls == []
+
+        # only the changed stage and the ones after it run again
+        calls = []
+        stages = make_stages(calls)
+        stages[1] = Stage('second', lambda store: (calls.append('second'), add(20, store)), dict(value=20))
+        assert np.all(run(calls, stages) == first + 10)
+        assert calls == ['second', 'third']
+
+
+def test_failing_stage(files):
+    flat, *images = files
+
+    def fail(store):
+        raise RuntimeError('scamp timed out')
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoints = Checkpoints(directory)
+        stages = make_stages([])[:2] + [Stage('third', fail, dict())]
+        keys = stage_keys(stages, [flat], images)
+        with pytest.raises(RuntimeError):
+            run_stages(stages, lambda: FrameStore.from_ccds(make_images()), checkpoints, keys)
+        assert checkpoints.latest(stages, keys) == 1
+
+
+def test_evict(files):
+    flat, *images = files
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoints = Checkpoints(directory, max_bytes=1)
+        stages = make_stages([])
+        keys = stage_keys(stages, [flat], images)
+        run_stages(stages, lambda: FrameStore.from_ccds(make_images()), checkpoints, keys).close()
+        # only the newest one is kept
+        assert checkpoints.latest(stages, keys) == 2
+        assert len(os.listdir(directory)) == 1
@@ -48,6 +48,30 @@ def test_roundtrip():
     mock_discover.assert_called()
     mock_reduce.assert_called()
 
+    # on a server, with absolute paths
+    args = parser.parse_args(['--no-ref', '--server', 'my.sock', 'm', '-o', 'out.fits', '-b', 'bad1', '-f', 'flat1',
+                              '-i', 'im1'])
+    mock_submit = mock.Mock(return_value=dict(waited=0, seconds=1))
+    with mock.patch('ir_reduce.server.submit', mock_submit):
+        args.func(args)
+    assert mock_submit.call_args[0] == ('do_only_reduce', 'my.sock')
+    assert mock_submit.call_args[1]['output'] == os.path.abspath('out.fits')
+    assert mock_submit.call_args[1]['images'] == [os.path.abspath('im1')]
+
+    # batch
+    args = parser.parse_args(['--no-ref', '-a', 'b', '-o', 'outdir', '-j', '2', 'mydir'])
+    assert args.func == cli.do_batch
+    mock_find, mock_run, mock_discover = mock.Mock(), mock.Mock(), mock.Mock()
+    with mock.patch('ir_reduce.batch.find_jobs', mock_find), mock.patch('ir_reduce.batch.run_batch', mock_run), \
+            mock.patch('ir_reduce.image_discovery.discover_filename', mock_discover):
+        mock_discover.return_value = ([1], [2], [3])
+        mock_find.return_value, mock_run.return_value = [mock.MagicMock()], []
+        args.func(args)
+
+    mock_find.assert_called()
+    assert mock_run.call_args[0][1] == 'outdir' and mock_run.call_args[0][2] is None
+    assert mock_run.call_args[1]['combine'] == 'average' and mock_run.call_args[1]['concurrent_jobs'] == 2
+
 
 def test_invalid_args(capsys):
     parser = cli.parser
@@ -96,7 +120,8 @@ def test_astroref_only():
     with mock.patch('ir_reduce.do_only_astroref', mock_aref):
         args.func(args)
 
-    mock_aref.assert_called_with([os.path.abspath('in.fits')], mock.ANY, mock.ANY)
+    mock_aref.assert_called_with([os.path.abspath('in.fits')], mock.ANY, mock.ANY, concurrent_jobs=None,
+                                 single_scamp=False, pipelined=False)
 
     args = parser.parse_args(['astroref', '-o', 'out.fits', '-i', 'a', 'b'])
     # check if mismatch between in/out arglength causes error
@@ -116,4 +141,11 @@ def test_astromatic_config_overrides():
 
     assert (cfg.scamp_overrides == ['A=B', 'B=B'])
     assert (cfg.sextractor_overrides == ['A=B'])
-    pass
+    # only an explicit --wdir keeps the intermediate files, in temporary directories otherwise
+    assert cfg.working_dir == ''
+    args = parser.parse_args(['astroref', '-i' 'infile', '--wdir', 'wdir'])
+    assert cli.parse_astromatic_config(args).working_dir == os.path.abspath('wdir')
+
+    # -rs is --running-sky, the store has its own short flag
+    args = parser.parse_args(['-rs', 'astroref', '-i', 'infile', '-rc', 'store'])
+    assert args.running_sky and cli.parse_astromatic_config(args).refcat_store == os.path.abspath('store')
@@ -0,0 +1,152 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.io.fits import Header
+from astropy.nddata import CCDData
+from ir_reduce.calibration_cache import CalibrationCache
+from ir_reduce.distortion import (DistortionMap, default_db, displacement_map, evaluate_surface, notcam_distortion,
+                                  parse_surface, read_geomap_db, transform)
+from ir_reduce.frame_store import FrameStore
+from ir_reduce.resample import map_coordinates, reproject_frame, shift_frame
+from .test_resample import make_frame, make_wcs, shape
+
+# x_raw = x + 2, y_raw = y - 1 + 0.01 * (x - 32.5) on a 64x64 detector, plus a quadratic term in x
+shifted_db = """# test model
+begin\tshifted
+\tfunction\tlegendre
+\tsurface1\t11
+\t\t2.\t2.
+\t\t2.\t2.
+\t\t2.\t2.
+\t\t0.\t0.
+\t\t1.\t1.
+\t\t64.\t64.
+\t\t1.\t1.
+\t\t64.\t64.
+\t\t34.5\t31.5
+\t\t31.5\t0.315
+\t\t0.\t31.5
+\tsurface2\t11
+\t\t2.\t2.
+\t\t3.\t2.
+\t\t1.\t2.
+\t\t0.\t0.
+\t\t1.\t1.
+\t\t64.\t64.
+\t\t1.\t1.
+\t\t64.\t64.
+\t\t0.\t0.
+\t\t0.\t0.
+\t\t0.5\t0.
+"""
+
+
+@pytest.fixture
+def db_path():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'test.db')
+        with open(path, 'w') as f:
+            f.write(shifted_db)
+        yield path
+
+
+def test_read_shipped_db():
+    records = read_geomap_db(default_db)
+    assert set(records) == {'dist-j.dat', 'dist-h.dat', 'dist-k.dat'}
+    for record in records.values():
+        assert record.parameters['function'] == 'legendre'
+        assert [len(surface.coefficients) for surface in record.x_surfaces] == [3, 16]
+        assert [len(surface.coefficients) for surface in record.y_surfaces] == [3, 16]
+        # close to the identity at the center of the detector
+        x, y = transform(record, 512., 512.)
+        assert abs(x - 512) < 2 and abs(y - 512) < 2
+
+
+@pytest.mark.parametrize('xterms, n_coefficients', [(0, 5), (1, 9), (2, 6)])
+def test_cross_terms(xterms, n_coefficients):
+    surface = parse_surface([3, 3, 3, xterms, -1, 1, -1, 1] + [1.] * n_coefficients)
+    x, y = np.array([0.3, -0.5]), np.array([0.7, 0.2])
+    terms = {0: [1, x, x * x, y, y * y],
+             1: [1, x, x * x, y, x * y, x * x * y, y * y, x * y * y, x * x * y * y],
+             2: [1, x, x * x, y, x * y, y * y]}[xterms]
+    assert np.allclose(evaluate_surface(surface, x, y), sum(terms))
+    with pytest.raises(ValueError):
+        evaluate_surface(parse_surface([3, 3, 3, xterms, -1, 1, -1, 1, 1.]), x, y)
+
+
+def test_displacement_map(db_path):
+    record = read_geomap_db(db_path)['shifted']
+    displacement = displacement_map(record, (64, 64))
+    rows, columns = np.indices((64, 64))
+    x_normalized = (2 * (columns + 1.) - 65) / 63
+    assert np.allclose(displacement[1], 2 + 0.5 * (1.5 * x_normalized ** 2 - 0.5))
+    assert np.allclose(displacement[0], -1 + 0.01 * (columns + 1 - 32.5))
+
+    # binned images have the same displacement in binned pixels
+    binned = displacement_map(record, (32, 32))
+    assert np.allclose(binned[0], (displacement[0, ::2, ::2] + displacement[0, 1::2, 1::2]) / 4, atol=0.01)
+
+
+def test_notcam_distortion():
+    header = Header({'INSTRUME': 'NOTCAM', 'NCFLTNM2': 'Ks'})
+    with tempfile.TemporaryDirectory() as directory:
+        distortion = notcam_distortion(header, (1024, 1024), directory=directory)
+        assert distortion.name == 'dist-k.dat'
+        assert distortion.displacement.shape == (2, 1024, 1024)
+        assert notcam_distortion(Header({'INSTRUME': 'ALFOSC_FASU'}), (1024, 1024), directory=directory) is None
+
+
+def test_cached(db_path):
+    with tempfile.TemporaryDirectory() as directory:
+        cache = CalibrationCache(directory)
+        first = DistortionMap.create('shifted', (64, 64), db_path, cache=cache)
+        second = DistortionMap.create('shifted', (64, 64), db_path, cache=cache)
+        assert first.handle == second.handle
+        assert DistortionMap.create('shifted', (32, 32), db_path, cache=cache).handle != first.handle
+
+
+def two_step(frame, distortion, target):
+    """correct the distortion first and reproject the corrected frame, resamples twice"""
+    coordinates = distortion.raw_coordinates(np.indices(frame.shape, dtype=np.float64))
+    corrected = CCDData(map_coordinates(frame.data, coordinates), wcs=frame.wcs, unit=frame.unit)
+    return reproject_frame(corrected, target)
+
+
+@pytest.mark.parametrize('wcs', [make_wcs(3, -5), make_wcs(3.3, -5.7)])
+def test_single_resampling(db_path, wcs):
+    # a smooth frame, so resampling twice gives nearly the same as resampling once
+    rows, columns = np.indices(shape)
+    frame = CCDData(np.sin(rows / 7) + np.cos(columns / 5), wcs=wcs, unit=u.electron)
+    with tempfile.TemporaryDirectory() as directory:
+        distortion = DistortionMap.create('shifted', shape, db_path, directory)
+        corrected = reproject_frame(frame, make_wcs(), distortion=distortion)
+        expected = two_step(frame, distortion, make_wcs())
+
+    assert corrected.header['DISTCORR'] == 'shifted'
+    valid = ~np.isnan(expected.data)
+    assert np.array_equal(np.isnan(corrected.data)[valid], np.zeros(valid.sum(), dtype=bool))
+    assert np.allclose(corrected.data[valid], expected.data[valid], atol=0.02)
+
+
+def test_shift_frame(db_path):
+    frame = make_frame(make_wcs())
+    with tempfile.TemporaryDirectory() as directory:
+        distortion = DistortionMap.create('shifted', shape, db_path, directory)
+        shifted = shift_frame(frame, (2, -3), distortion=distortion)
+        coordinates = distortion.raw_coordinates(np.indices(shape, dtype=np.float64) + np.reshape([2, -3], (2, 1, 1)))
+    assert np.allclose(shifted.data, map_coordinates(frame.data, coordinates), equal_nan=True)
+    assert shifted.header['DISTCORR'] == 'shifted'
+
+
+def test_in_store(db_path, pool):
+    frames = [make_frame(make_wcs(3 * index, 0.5 * index), index) for index in range(3)]
+    with FrameStore.from_ccds(frames) as store:
+        distortion = DistortionMap.create('shifted', shape, db_path, store.directory)
+        store.map(reproject_frame, pool, make_wcs(), 0.01, distortion)
+        for stored, frame in zip(store.to_ccds(), frames):
+            expected = reproject_frame(frame, make_wcs(), distortion=distortion)
+            assert np.allclose(stored.data, expected.data, equal_nan=True)
+            assert stored.header['DISTCORR'] == 'shifted'
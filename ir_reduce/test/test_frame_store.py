@@ -0,0 +1,84 @@
+import os
+
+import ccdproc
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.nddata import CCDData
+from ir_reduce import subtract, standard_process, skyscale
+from ir_reduce.calibration import normalized_flat
+from ir_reduce.combine import tile_combine
+from ir_reduce.frame_store import FrameStore
+from numpy import s_
+
+
+def make_images(n=3, shape=(10, 12)):
+    images = []
+    for i in range(n):
+        image = CCDData(np.arange(np.prod(shape), dtype=float).reshape(shape) + i, unit=u.count)
+        image.header['INDEX'] = i
+        for idx in range(1, 5):
+            image.header['GAIN' + str(idx)] = 1
+            image.header['RDNOISE' + str(idx)] = 1
+        images.append(image)
+    return images
+
+
+def test_roundtrip():
+    images = make_images()
+    with FrameStore.from_ccds(images) as store:
+        directory = store.directory
+        assert len(store) == 3
+        for image, stored in zip(images, store.to_ccds()):
+            assert np.all(stored.data == image.data)
+            assert stored.header['INDEX'] == image.header['INDEX']
+            assert stored.uncertainty is None
+            assert not stored.mask.any()
+    assert not os.path.exists(directory)
+
+
+def test_map_in_place(pool):
+    images = make_images()
+    with FrameStore.from_ccds(images) as store:
+        store.starmap(subtract, pool, ((i * u.count,) for i in range(3)))
+        assert np.all(store.data == images[0].data)
+        normed = store.map_reduce(normalized_flat, pool)
+        assert np.allclose(normed, normalized_flat(images[0]))
+
+
+@pytest.mark.filterwarnings('ignore:invalid value encountered in divide:RuntimeWarning')
+def test_same_as_list(pool):
+    bad = CCDData(np.zeros((10, 12), dtype=bool), unit=u.dimensionless_unscaled)
+    bad.data[3, 4] = True
+    flat = CCDData(np.ones((10, 12)) * 2, unit=u.dimensionless_unscaled)
+
+    expected = skyscale(standard_process([bad], flat, make_images(), pool), pool=pool, cut=s_[2:8, 2:8])
+    with FrameStore.from_ccds(make_images()) as store:
+        skyscale(standard_process([bad], flat, store, pool), pool=pool, cut=s_[2:8, 2:8])
+        for image, stored in zip(expected, store.to_ccds()):
+            assert np.allclose(stored.data, image.data)
+            assert np.all(stored.mask == image.mask)
+            assert np.allclose(stored.uncertainty.array, image.uncertainty.array)
+            assert stored.unit == image.unit
+
+
+@pytest.mark.parametrize('method', ['median', 'average'])
+def test_tile_combine_same_as_combiner(method, pool):
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(5):
+        image = CCDData(rng.normal(100, 10, (20, 15)), unit=u.electron, mask=rng.random((20, 15)) > 0.8)
+        image.data[0, i] = np.nan
+        image.mask[1, :] = True
+        images.append(image)
+
+    combiner = ccdproc.Combiner(images)
+    expected = combiner.median_combine() if method == 'median' else combiner.average_combine()
+    with FrameStore.from_ccds(images) as store:
+        # tiny blocks to make sure the blocks are stitched together properly
+        combined = tile_combine(store, method, pool, block_bytes=5 * 15 * 8 * 3)
+
+    assert np.allclose(combined.data, expected.data, equal_nan=True)
+    assert np.all(combined.mask == expected.mask)
+    assert np.allclose(combined.uncertainty.array, expected.uncertainty.array, equal_nan=True)
+    assert combined.unit == expected.unit
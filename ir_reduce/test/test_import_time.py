@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+from typing import Dict
+
+import ir_reduce
+
+# modules that take most of the startup time, the command line interface should only import them when it reduces
+heavy_modules = ('astropy.io.fits', 'astropy.nddata', 'astropy.wcs', 'ccdproc', 'scipy', 'matplotlib', 'reproject',
+                 'numpy', 'ir_reduce.main')
+# microseconds, the light imports take well under 0.1s, the heavy ones more than a second
+startup_budget = 500000
+
+
+def import_times(statement: str) -> Dict[str, int]:
+    """cumulative import time in microseconds of every module imported by statement, see python -X importtime"""
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(ir_reduce.__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([package_root, os.environ.get('PYTHONPATH', '')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], env=env, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = dict()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('| imported package'):
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_startup():
+    times = import_times('import ir_reduce.cli')
+    imported_heavy = [name for name in times if name.startswith(heavy_modules)]
+    assert not imported_heavy
+    slowest = sorted(times.items(), key=lambda item: -item[1])[:10]
+    assert times['ir_reduce.cli'] < startup_budget, f'slowest imports: {slowest}'
+
+
+def test_lazy_names():
+    times = import_times('import ir_reduce; ir_reduce.reduce_image; ir_reduce.Config')
+    assert 'ir_reduce.main' in times and 'ir_reduce.transient_detection' not in times
+    assert set(ir_reduce.__all__) >= {'reduce_image', 'do_everything', 'run_astroref', 'Config', 'cli_main',
+                                      'find_jobs', 'transient_detection', 'classifier_common'}
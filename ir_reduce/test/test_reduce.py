@@ -1,14 +1,21 @@
 # flake8: noqa F811
 import glob
+import logging
 import os
 import tempfile
 
+import ccdproc
 import numpy as np
 import pytest
 from astropy import units as u
+from astropy.io import fits
 from astropy.nddata.ccddata import CCDData
-from ir_reduce import standard_process, skyscale, interpolate, read_and_sort, do_everything, Pool, PoolDummy
+from astropy.wcs import WCS
+from ir_reduce import (tiled_process, standard_process, skyscale, interpolate, read_and_sort, do_everything,
+                       reduce_image, do_only_reduce)
+from ir_reduce.calibration import quadrant_slices
 from ir_reduce.classifier_common import Band
+from ir_reduce.frame_store import FrameStore
 from numpy import zeros, ones, float64, int64, s_
 
 # noinspection PyUnresolvedReferences
@@ -45,13 +52,66 @@ def test_standard_process_smoke(genImages, genBadPixel):
     standard_process([genImages], genBadPixel, [genImages])
 
 
+@pytest.mark.filterwarnings('ignore:invalid value encountered in divide:RuntimeWarning')
+def test_batch_process_same_as_ccdproc(pool):
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(3):
+        image = CCDData(rng.normal(100, 50, image_size).astype(np.float32), unit=u.count)
+        for idx in range(1, 5):
+            image.header["GAIN" + str(idx)] = 2 + i / 10
+            image.header["RDNOISE" + str(idx)] = 10 + idx
+        images.append(image)
+    bad = CCDData(rng.random(image_size) > 0.9, unit=u.dimensionless_unscaled)
+    flat = CCDData(rng.normal(1000, 30, image_size), unit=u.count)
+
+    expected = standard_process([bad], flat, [image.copy() for image in images], pool)
+    batched = standard_process([bad], flat, [image.copy() for image in images], pool, method='batch')
+    with FrameStore.from_ccds(images) as store:
+        standard_process([bad], flat, store, pool, method='batch')
+        stored = [image.copy() for image in store.to_ccds()]
+
+    for reference, batch, store_batch in zip(expected, batched, stored):
+        for result in (batch, store_batch):
+            assert result.unit == reference.unit
+            assert np.allclose(result.data, reference.data)
+            assert np.all(result.mask == reference.mask)
+            assert np.allclose(result.uncertainty.array, reference.uncertainty.array, rtol=1e-6, equal_nan=True)
+
+
+@pytest.mark.filterwarnings('ignore:invalid value encountered in divide:RuntimeWarning')
+def test_tiled_process_per_quadrant(pool):
+    rng = np.random.default_rng(1)
+    image = CCDData(rng.normal(100, 50, image_size), unit=u.count)
+    for idx in range(1, 5):
+        image.header["GAIN" + str(idx)] = idx
+        image.header["RDNOISE" + str(idx)] = 10 * idx
+    bad = CCDData(rng.random(image_size) > 0.9, unit=u.dimensionless_unscaled)
+    flat = CCDData(rng.normal(1000, 30, image_size), unit=u.count)
+
+    processed = tiled_process([bad], flat, [image.copy()], pool)[0]
+    with FrameStore.from_ccds([image]) as store:
+        standard_process([bad], flat, store, pool, method='quadrant')
+        stored = store.to_ccd(0).copy()
+
+    for idx, tile in enumerate(quadrant_slices(image_size), start=1):
+        reference = ccdproc.ccd_process(image, error=True, gain=idx * u.electron / u.count,
+                                        readnoise=10 * idx * u.electron, master_flat=flat, bad_pixel_mask=bad.data)
+        for result in (processed, stored):
+            assert np.allclose(result.data[tile], reference.data[tile])
+            assert np.allclose(result.uncertainty.array[tile], reference.uncertainty.array[tile], equal_nan=True)
+            assert np.all(result.mask == reference.mask)
+            assert result.unit == reference.unit
+
+
 def test_skyscale_smoke(genImages):
     genImages.unit = u.electron
     skyscale([genImages], cut=s_[1, 9])
     skyscale([genImages, genImages], cut=s_[1, 9])
 
 
-def test_interpolate():
+@pytest.mark.parametrize('method', ['convolve', 'bilinear', 'nearest'])
+def test_interpolate(method):
     """TODO Test if the kernel convolution is actually a bilinear interpolation"""
     ccd = CCDData(ones((11, 11), dtype=float64), unit=u.dimensionless_unscaled)
 
@@ -60,20 +120,87 @@ def test_interpolate():
     ccd.mask[5, 5] = False
     ccd.data[5, 5] = -12423.23
 
-    ccdCorr = interpolate(ccd.copy())
+    ccdCorr = interpolate(ccd.copy(), method)
     assert ccdCorr.data[5, 5] == 1.0
 
     # all pixels around the invalid pixel are 10 -> pixel should become 10 as well
     ccd.data[4:7, 4:7] = 10
-    ccdCorr = interpolate(ccd.copy())
+    ccdCorr = interpolate(ccd.copy(), method)
     assert np.isclose(ccdCorr.data[5, 5], 10)
 
 
+def write_notcam_frame(path, band, category='SCIENCE', image_type='OBJECT'):
+    header = fits.Header({'INSTRUME': 'NOTCAM', 'IMAGECAT': category, 'IMAGETYP': image_type, 'NCFLTNM2': band,
+                          'BUNIT': 'count'})
+    fits.PrimaryHDU(ones(image_size), header=header).writeto(path)
+    return path
+
+
+def test_read_and_sort_skips_other_bands(caplog):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bad = write_notcam_frame(os.path.join(tmpdir, 'bad.fits'), 'J', 'CALIB', 'BAD_PIXEL')
+        flats = [write_notcam_frame(os.path.join(tmpdir, f'flat{band}.fits'), band, 'CALIB', 'FLAT')
+                 for band in ('J', 'H')]
+        imgs = [write_notcam_frame(os.path.join(tmpdir, f'im{band}{i}.fits'), band)
+                for band in ('J', 'H', 'Ks') for i in range(2)]
+
+        with caplog.at_level(logging.INFO):
+            read = read_and_sort([bad], flats, imgs, band_id=Band.J)
+
+    assert list(read.keys()) == [Band.J]
+    assert len(read[Band.J].bad) == 1
+    assert len(read[Band.J].flat) == 1
+    assert len(read[Band.J].images) == 2
+    assert 'skipped reading 5 frames' in caplog.text
+
+
+def write_exposure(path, band, index, shape=(256, 256)):
+    rng = np.random.default_rng(index)
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [150., 20.]
+    wcs.wcs.crpix = [shape[1] / 2 + index, shape[0] / 2 - index]
+    wcs.wcs.cdelt = [-0.234 / 3600, 0.234 / 3600]
+    header = fits.Header({'INSTRUME': 'NOTCAM', 'IMAGECAT': 'SCIENCE', 'IMAGETYP': 'OBJECT', 'NCFLTNM2': band,
+                          'BUNIT': 'count'})
+    header.update(wcs.to_header())
+    for i in range(1, 5):
+        header['GAIN' + str(i)] = 2
+        header['RDNOISE' + str(i)] = 10
+    fits.PrimaryHDU(rng.poisson(1000 + 100 * index, shape).astype(np.float32), header=header).writeto(path)
+    return path
+
+
+@pytest.mark.parametrize('single_thread', [True, False])
+def test_reduce_all_bands(single_thread):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        flats = []
+        for band in ('J', 'H'):
+            header = fits.Header({'INSTRUME': 'NOTCAM', 'IMAGECAT': 'CALIB', 'IMAGETYP': 'FLAT', 'NCFLTNM2': band,
+                                  'BUNIT': 'count'})
+            flats.append(os.path.join(tmpdir, f'flat{band}.fits'))
+            fits.PrimaryHDU(np.full((256, 256), 5000.), header=header).writeto(flats[-1])
+        imgs = [write_exposure(os.path.join(tmpdir, f'im{band}{i}.fits'), band, i)
+                for band in ('J', 'H', 'Ks') for i in range(3)]
+
+        # Ks has no flat and gets skipped
+        reduced = reduce_image([], flats, imgs, 'all', single_thread=single_thread)
+        assert list(reduced) == [Band.H, Band.J]
+        for band, image in reduced.items():
+            expected = reduce_image([], flats, imgs, band, single_thread=True)
+            assert np.allclose(image.data, expected.data, equal_nan=True)
+
+        do_only_reduce([], flats, imgs, os.path.join(tmpdir, 'out.fits'), 'all', single_thread=single_thread)
+        assert os.path.exists(os.path.join(tmpdir, 'out_J.fits')) and os.path.exists(os.path.join(tmpdir, 'out_H.fits'))
+
+    with pytest.raises(ValueError):
+        reduce_image([], [], [], 'some')
+
+
 # test for copying behaviour of function chain
 
 @pytest.mark.integration
 @pytest.mark.filterwarnings('ignore::astropy.wcs.FITSFixedWarning')
-@pytest.mark.parametrize('pool', [PoolDummy(), Pool(2)])
 def test_read_and_sort(pool, datadir):
     assert os.path.isdir(datadir), datadir + " does not exist"
 
@@ -0,0 +1,113 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.wcs import WCS
+from ir_reduce.ldac import read_ldac, write_ldac
+from ir_reduce.refcat_store import RefcatStore, enclosing, footprint, read_sources, separation
+from ir_reduce.run_sextractor_scamp import run_astroref
+from .test_sextractor import fake_binaries  # noqa F401, fixture
+
+
+def random_sources(ra, dec, radius, n, seed=0):
+    rng = np.random.RandomState(seed)
+    return (ra + rng.uniform(-radius, radius, n) / np.cos(np.radians(dec))) % 360, \
+        np.clip(dec + rng.uniform(-radius, radius, n), -90, 90)
+
+
+def write_catalog(path, ra, dec, ldac=True):
+    if ldac:
+        write_ldac(path, fits.Header(), [fits.Column(name='X_WORLD', format='D', array=ra),
+                                         fits.Column(name='Y_WORLD', format='D', array=dec),
+                                         fits.Column(name='MAG', format='E', array=np.arange(len(ra)))])
+    else:
+        fits.BinTableHDU.from_columns([fits.Column(name='RA', format='D', array=ra),
+                                       fits.Column(name='DEC', format='D', array=dec)]).writeto(path)
+
+
+def make_wcs_header(ra, dec, shape=(100, 200)):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [(shape[1] + 1) / 2, (shape[0] + 1) / 2]
+    wcs.wcs.cdelt = [-0.001, 0.001]
+    header = wcs.to_header()
+    header['NAXIS2'], header['NAXIS1'] = shape
+    return header
+
+
+@pytest.fixture
+def store():
+    with tempfile.TemporaryDirectory() as directory:
+        store = RefcatStore(os.path.join(directory, 'store'), tile_size=0.5)
+        catalogs = []
+        for index, (ra, dec, ldac) in enumerate([(359.9, 10., True), (120., 89.5, False), (200., -30., True)]):
+            catalogs.append(os.path.join(directory, f'catalog{index}.cat'))
+            write_catalog(catalogs[-1], *random_sources(ra, dec, 1.5, 3000, index), ldac=ldac)
+        store.ingest(catalogs)
+        yield store, catalogs
+
+
+def test_ingest(store):
+    store, catalogs = store
+    assert sum(store.index['tiles'].values()) == 9000
+    assert store.ingest(catalogs) == 0
+    # the index survives reopening
+    assert RefcatStore(store.directory).index == store.index
+
+
+@pytest.mark.parametrize('ra, dec, radius', [(0.05, 10.3, 0.4), (359.5, 9.2, 1.), (130., 89.8, 0.3),
+                                             (300., 89.9, 0.5), (200.2, -30.5, 0.05), (100., 0., 1.)])
+def test_query(store, ra, dec, radius):
+    store, catalogs = store
+    everything = np.concatenate([read_sources(path) for path in catalogs])
+    expected = everything[separation(everything['X_WORLD'], everything['Y_WORLD'], ra, dec) <= radius]
+    found = store.query(ra, dec, radius)
+    assert sorted(found['X_WORLD'].tolist()) == sorted(expected['X_WORLD'].tolist())
+    assert len(store.tiles_in_cone(ra, dec, radius)) < len(store.index['tiles'])
+
+
+def test_cutout(store):
+    store, catalogs = store
+    path = store.cutout(0.05, 10.3, 0.2)
+    header, sources = read_ldac(path)
+    assert header['CTYPE1'] == 'RA---STG' and np.isclose(header['CRVAL2'], 10.3)
+    assert len(sources) >= len(store.query(0.05, 10.3, 0.2))
+    assert np.all(sources['ERRA_WORLD'] > 0) and np.all(sources['OBSDATE'] == 2000.)
+    # transient_detection reads the third hdu
+    assert len(fits.open(path)[2].data) == len(sources)
+
+    # a pointing nearby reuses the cutout, new sources invalidate it
+    assert store.cutout(0.06, 10.29, 0.2) == path
+    new_catalog = catalogs[0].replace('.cat', '_new.cat')
+    write_catalog(new_catalog, *random_sources(0.05, 10.3, 0.1, 10, 5))
+    store.ingest([new_catalog])
+    assert not os.path.exists(path)
+    assert store.cutout(0.05, 10.3, 0.2) != path
+    assert len(os.listdir(os.path.join(store.directory, 'cutouts'))) == 1
+
+
+def test_footprint():
+    ra, dec, radius = footprint(make_wcs_header(10., 20.))
+    assert np.isclose(ra, 10.) and np.isclose(dec, 20.)
+    assert np.isclose(radius, np.hypot(0.1, 0.05), rtol=1e-3)
+    assert footprint(fits.Header({'NAXIS1': 10, 'NAXIS2': 10})) is None
+
+    ra, dec, radius = enclosing([(359.9, 0., 0.1), (0.1, 0., 0.1)])
+    assert np.isclose(separation(ra, dec, 0., 0.), 0) and np.isclose(radius, 0.2)
+
+
+def test_run_astroref(store, fake_binaries):
+    store, _ = store
+    image = CCDData(np.zeros((100, 200)), unit='electron', wcs=WCS(make_wcs_header(200., -30.)))
+    fake_binaries.refcat_store = store.directory
+    with tempfile.TemporaryDirectory() as working_dir:
+        fake_binaries.working_dir = working_dir
+        run_astroref(image, fake_binaries, verbose=0)
+        cutouts = [name for name in os.listdir(working_dir) if name.startswith('refcat_')]
+        assert len(cutouts) == 1
+        _, sources = read_ldac(os.path.join(working_dir, cutouts[0]))
+        assert len(sources) >= len(store.query(200., -30., 0.11))
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.nddata import CCDData
+from ir_reduce import PoolDummy
+from ir_reduce.frame_store import FrameStore
+from ir_reduce.registration import register, register_shifts
+
+shape = (80, 90)
+true_shifts = [(0., 0.), (3., -7.), (-5.4, 2.3), (10.25, 11.6)]
+
+
+def make_frames():
+    rng = np.random.default_rng(0)
+    stars = rng.uniform(10, 70, (15, 2))
+    fluxes = rng.uniform(500, 5000, 15)
+    rows, columns = np.indices(shape)
+    hot = rng.random(shape) > 0.995  # fixed on the detector, would pull a naive correlation to zero shift
+    frames = []
+    for shift in true_shifts:
+        data = rng.normal(100, 5, shape)
+        for (row, column), flux in zip(stars, fluxes):
+            data += flux * np.exp(-((rows - row - shift[0]) ** 2 + (columns - column - shift[1]) ** 2) / (2 * 1.5 ** 2))
+        data[hot] = 1e5
+        mask = np.zeros(shape, dtype=bool)
+        mask[hot[:, ::-1]] = True  # masked bad pixels somewhere else
+        frames.append(CCDData(data, mask=mask, unit=u.electron))
+    return frames
+
+
+def test_register_shifts(pool):
+    with FrameStore.from_ccds(make_frames()) as store:
+        shifts = register_shifts(store, pool)
+    assert np.allclose(shifts, true_shifts, atol=0.15)
+
+
+def test_register():
+    frames = make_frames()
+    with FrameStore.from_ccds(frames) as store:
+        register(store, PoolDummy())
+        registered = store.to_ccds()
+        assert [image.header['REPROJ'] for image in registered] == ['integer', 'integer', 'shift', 'shift']
+        # the star field is the same in all frames, the hot pixels moved
+        inner = np.s_[20:60, 20:60]
+        for image in registered[1:]:
+            assert np.median(np.abs(image.data[inner] - frames[0].data[inner])) < 10
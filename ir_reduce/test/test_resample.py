@@ -0,0 +1,91 @@
+import tempfile
+
+import ccdproc
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.wcs import WCS
+from ir_reduce.calibration_cache import CalibrationCache
+from ir_reduce.frame_store import FrameStore
+from ir_reduce.resample import ReprojectionContext, reproject_frame, log_paths, strip_wcs
+
+shape = (60, 50)
+
+
+def make_wcs(dx=0., dy=0., rotation=0., projection='TAN', scale=0.234 / 3600):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---' + projection, 'DEC--' + projection]
+    wcs.wcs.crval = [150., 20.]
+    wcs.wcs.crpix = [shape[1] / 2 + dx, shape[0] / 2 + dy]
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    wcs.wcs.cd = [[-scale * cos, scale * sin], [scale * sin, scale * cos]]
+    return wcs
+
+
+def make_frame(wcs, seed=0):
+    rng = np.random.default_rng(seed)
+    return CCDData(rng.normal(100, 10, shape), mask=rng.random(shape) > 0.95, wcs=wcs, unit=u.electron)
+
+
+@pytest.mark.parametrize('wcs, target, path', [(make_wcs(), make_wcs(), 'integer'),
+                                               (make_wcs(3, -5), make_wcs(), 'integer'),
+                                               (make_wcs(3.3, -5.7), make_wcs(), 'shift'),
+                                               (make_wcs(2.2, 1.1, 1e-3), make_wcs(), 'affine'),
+                                               # projection change over a large field
+                                               (make_wcs(2, 3, projection='AIT', scale=1.), make_wcs(scale=1.),
+                                                'full')])
+def test_same_as_wcs_project(wcs, target, path):
+    frame = make_frame(wcs)
+    expected = ccdproc.wcs_project(frame, target)
+    reprojected = reproject_frame(frame, target)
+
+    assert reprojected.header['REPROJ'] == path
+    assert np.allclose(reprojected.data, expected.data, equal_nan=True, atol=1e-6)
+    assert np.all(reprojected.mask == expected.mask)
+    assert reprojected.wcs.wcs.compare(expected.wcs.wcs)
+    assert set(reprojected.header) - {'REPROJ'} == set(expected.header) - {'REPROJ'}
+
+
+def test_reproject_store(pool):
+    frames = [make_frame(make_wcs(dx, dy), seed) for seed, (dx, dy) in enumerate([(0, 0), (1, 2), (0.3, 0.6)])]
+    with FrameStore.from_ccds(frames) as store:
+        store.map(reproject_frame, pool, ReprojectionContext.create(frames[0].wcs, shape, store.directory))
+        counts = log_paths([meta.header for meta in store.metas])
+        assert counts['integer'] == 2 and counts['shift'] == 1
+        for frame, stored in zip(frames, store.to_ccds()):
+            assert np.allclose(stored.data, ccdproc.wcs_project(frame, frames[0].wcs).data, equal_nan=True)
+
+
+def test_strip_wcs():
+    header = make_wcs().to_header()
+    for keyword, value in [('CD1_1', 1e-4), ('CD2_2', 1e-4), ('A_ORDER', 2), ('A_2_0', 1e-6), ('B_ORDER', 2),
+                           ('B_0_2', 1e-6), ('DATE-OBS', '2018-10-01T00:00:00'), ('OBJECT', 'SN 2018xyz')]:
+        header[keyword] = value
+    header['CTYPE1'] += '-SIP'
+    header['CTYPE2'] += '-SIP'
+    stripped = strip_wcs(header)
+    assert set(stripped) == {'DATE-OBS', 'OBJECT'}
+    assert 'CD1_1' in header
+    assert strip_wcs(fits.Header({'OBJECT': 'flat'})) == fits.Header({'OBJECT': 'flat'})
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_context_same_as_wcs_project(use_cache):
+    target = make_wcs(scale=1.)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = CalibrationCache(tmpdir) if use_cache else None
+        context = ReprojectionContext.create(target, shape, tmpdir, cache)
+        assert context.world.shape == (2,) + shape
+
+        for wcs in [make_wcs(2, 3, projection='AIT', scale=1.), make_wcs(1, 1, scale=1.)]:
+            frame = make_frame(wcs)
+            expected = ccdproc.wcs_project(frame, target)
+            reprojected = reproject_frame(frame, context)
+            assert np.allclose(reprojected.data, expected.data, equal_nan=True, atol=1e-6)
+            assert np.all(reprojected.mask == expected.mask)
+
+        if use_cache:
+            again = ReprojectionContext.create(make_wcs(scale=1.), shape, cache=cache)
+            assert again.handle == context.handle
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from ir_reduce import reduce_image
+from ir_reduce.classifier_common import Band
+from ir_reduce.run_sextractor_scamp import Config
+from ir_reduce.server import ReductionServer, dumps, loads, request, submit
+from .test_reduce import write_exposure
+
+
+def test_encoding():
+    config = Config()
+    config.scamp_overrides = ['A=1']
+    decoded = loads(dumps(dict(band_id=Band.Ks, cfg=config, images={'a'})))
+    assert decoded['band_id'] == Band.Ks
+    assert decoded['cfg'].scamp_overrides == ['A=1'] and decoded['cfg'].scamp_cmd == 'scamp'
+    assert decoded['images'] == ['a']
+    with pytest.raises(TypeError):
+        dumps(dict(something=object()))
+
+
+def test_serve(pool):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        header = fits.Header({'INSTRUME': 'NOTCAM', 'IMAGECAT': 'CALIB', 'IMAGETYP': 'FLAT', 'NCFLTNM2': 'J',
+                              'BUNIT': 'count'})
+        flat = os.path.join(tmpdir, 'flatJ.fits')
+        fits.PrimaryHDU(np.full((256, 256), 5000.), header=header).writeto(flat)
+        images = [write_exposure(os.path.join(tmpdir, f'im{i}.fits'), 'J', i) for i in range(3)]
+
+        socket_path = os.path.join(tmpdir, 'server.sock')
+        server = ReductionServer(socket_path, pool, cache_dir=os.path.join(tmpdir, 'cache'))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            output = os.path.join(tmpdir, 'out.fits')
+            for _ in range(2):
+                reply = submit('do_only_reduce', socket_path, bads=[], flats=[flat], images=images, output=output,
+                               band_id=Band.J)
+                assert reply['seconds'] > 0 and reply['waited'] >= 0
+            expected = reduce_image([], [flat], images, Band.J, single_thread=True)
+            assert np.allclose(fits.getdata(output), expected.data, equal_nan=True)
+            # the cache of the server was used
+            assert os.listdir(os.path.join(tmpdir, 'cache'))
+
+            with pytest.raises(RuntimeError):
+                submit('do_only_reduce', socket_path, bads=[], flats=[flat], images=[flat], output=output)
+            with pytest.raises(RuntimeError):
+                request(dict(command='rm -rf'), socket_path)
+
+            status = request(dict(command='status'), socket_path)
+            assert status['done'] == 2 and status['failed'] == 1 and status['queued'] == 0
+            assert status['median_latency'] > 0
+            request(dict(command='shutdown'), socket_path)
+            thread.join(10)
+            assert not thread.is_alive()
+        finally:
+            if thread.is_alive():
+                server.shutdown()
+            server.server_close()
+        assert not os.path.exists(socket_path)
@@ -1,10 +1,21 @@
+import logging
 import pytest
+import subprocess
 from textwrap import dedent
 import tempfile
 from unittest import mock
 import os
 import shutil
-from ir_reduce import run_astroref, parse_key_val_config, is_config_valid, Config
+import stat
+import sys
+import time
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import CCDData, StdDevUncertainty
+from astropy.wcs import WCS
+from ir_reduce import run_astroref, parse_key_val_config, is_config_valid, Config, do_only_astroref
+from ir_reduce.run_sextractor_scamp import output_lines, run_astroref_batch, run_astroref_concurrent, tool_timeout, \
+    write_sextractor_input
 # todo: astroref_file, astroreff_files
 
 
@@ -40,6 +51,45 @@ class ConfigForTest:
         os.remove(self.scamp_filename)
 
 
+# seconds every fake tool run takes
+fake_runtime = 0.3
+# stand-ins for sex and scamp: the catalog contains the input file name, scamp puts it into a header and logs its
+# inputs next to the script
+fake_sex = f"""#!{sys.executable}
+import os, sys, time
+time.sleep({fake_runtime})
+with open(sys.argv[sys.argv.index('-CATALOG_NAME') + 1], 'w') as f:
+    f.write(os.path.basename(sys.argv[1]))
+"""
+fake_scamp = f"""#!{sys.executable}
+import os, sys, time
+time.sleep({fake_runtime})
+catalogs = sys.argv[1:sys.argv.index('-c')]
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'scamp.log'), 'a') as f:
+    f.write(' '.join(catalogs) + '\\n')
+for catalog in catalogs:
+    with open(catalog) as f:
+        name = f.read()
+    with open(catalog.replace('.fits', '.head'), 'w') as f:
+        f.write('COMMENT ' + name + '\\nEND')
+with open('GAIA-DR1_1.cat', 'w') as f:
+    f.write('reference')
+"""
+
+
+@pytest.fixture
+def fake_binaries():
+    """config that runs fake_sex and fake_scamp"""
+    with ConfigForTest() as config, tempfile.TemporaryDirectory() as bindir:
+        for name, script in [('sex', fake_sex), ('scamp', fake_scamp)]:
+            path = os.path.join(bindir, name)
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+            setattr(config, name + '_cmd', path)
+        yield config
+
+
 def recorder(*args, **kwargs):
     return args, kwargs
 
@@ -118,6 +168,7 @@ class TestRun:
             # mock/file setup
             mock_run.run.return_value = mock_process
             mock_process.returncode = 0
+            mock_run.return_value.stdout = mock_run.return_value.stderr = ''
 
             config.working_dir = tmpdir
 
@@ -134,10 +185,116 @@ class TestRun:
     def test_echo_present(self):
         assert shutil.which('echo')
 
-    @pytest.mark.integration  # TODO mark for "need echo present"
-    def test_run_with_fake_binaries(self):
-        pass
+    def test_run_with_fake_binaries(self, fake_binaries):
+        scamp_data, sex_data, reference_cat_data = run_astroref('image.fits', fake_binaries, verbose=0)
+        assert scamp_data == 'COMMENT image.fits\nEND'
+        assert sex_data == b'image.fits' and reference_cat_data == b'reference'
+
+    def test_run_logs_and_timeouts(self, fake_binaries, caplog):
+        image = CCDData(np.zeros((1000, 2000)), unit='electron')
+        with caplog.at_level(logging.INFO), mock.patch('subprocess.run', side_effect=subprocess.run) as run:
+            run_astroref(image, fake_binaries)
+        # the timeouts grow with the image size, like in the pipelined runner
+        assert [call[1]['timeout'] for call in run.call_args_list] == [tool_timeout(2 * 10 ** 6)] * 2
+        ran = [record.getMessage() for record in caplog.records if record.getMessage().startswith('ran [')]
+        assert len(ran) == 2 and fake_binaries.sex_cmd in ran[0] and fake_binaries.scamp_cmd in ran[1]
+        assert output_lines('first\r\x1b[1Mprogress\n\ndone \n') == ['first', 'progress', 'done']
+
+    def test_write_sextractor_input(self):
+        wcs = WCS(naxis=2)
+        wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        wcs.wcs.crval = [10., 20.]
+        image = CCDData(np.arange(12.).reshape(3, 4), unit='electron', wcs=wcs, mask=np.ones((3, 4), bool),
+                        uncertainty=StdDevUncertainty(np.ones((3, 4))),
+                        header=fits.Header({'OBJECT': 'x' * 100, 'EXPTIME': 10.}))
+        image.header.add_history('reduced')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'input.fits')
+            write_sextractor_input(image, path)
+            with fits.open(path) as hdus:
+                hdus.verify('exception')
+                assert len(hdus) == 1 and hdus[0].data.dtype == np.dtype('>f4')
+                assert np.all(hdus[0].data == image.data)
+                header = hdus[0].header
+        assert header['OBJECT'] == 'x' * 100 and header['EXPTIME'] == 10. and 'reduced' in str(header['HISTORY'])
+        assert np.allclose(WCS(header).wcs.crval, [10., 20.])
+
+    def test_write_sextractor_input_sip(self):
+        header = fits.Header({'CTYPE1': 'RA---TAN-SIP', 'CTYPE2': 'DEC--TAN-SIP', 'CRVAL1': 10., 'CRVAL2': 20.,
+                              'CRPIX1': 2., 'CRPIX2': 2., 'CD1_1': -1e-4, 'CD1_2': 0., 'CD2_1': 0., 'CD2_2': 1e-4,
+                              'A_ORDER': 2, 'A_2_0': 1e-5, 'B_ORDER': 2, 'B_0_2': 2e-5, 'OBJECT': 'sip'})
+        image = CCDData(np.zeros((3, 4)), unit='electron', wcs=WCS(header))
+        # a stale CD matrix in the header next to the PC matrix of the WCS
+        image.header.update({'CD1_1': 1., 'CD2_2': 1., 'OBJECT': 'sip'})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'input.fits')
+            write_sextractor_input(image, path)
+            written = fits.getheader(path)
+        assert written['CTYPE1'] == 'RA---TAN-SIP' and written['A_ORDER'] == 2 and written['A_2_0'] == 1e-5
+        assert written['B_0_2'] == 2e-5 and written['OBJECT'] == 'sip'
+        assert 'CD1_1' not in written
+        assert np.allclose(WCS(written).all_pix2world([[3., 1.]], 0), WCS(header).all_pix2world([[3., 1.]], 0))
+
+    @pytest.mark.parametrize('input_dir', [False, True])
+    def test_input_dir(self, fake_binaries, input_dir):
+        image = CCDData(np.zeros((4, 4)), unit='electron')
+        with tempfile.TemporaryDirectory() as working_dir, tempfile.TemporaryDirectory() as tmpdir:
+            fake_binaries.working_dir = working_dir
+            fake_binaries.input_dir = tmpdir if input_dir else ''
+            scamp_data, sex_data, _ = run_astroref(image, fake_binaries, verbose=0)
+            assert sex_data.startswith(b'sextractorInput')
+            # the input only stays in the working directory without input_dir, setup files are never copied
+            assert os.listdir(tmpdir) == []
+            assert ('sextractorInput.fits' in os.listdir(working_dir)) != input_dir
+            assert 'default.param' not in os.listdir(working_dir)
+
+    @pytest.mark.parametrize('working_dir', [False, True])
+    def test_concurrent(self, fake_binaries, working_dir):
+        inputs = [f'image{index}.fits' for index in range(4)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fake_binaries.working_dir = tmpdir if working_dir else ''
+            start = time.perf_counter()
+            results = run_astroref_concurrent(inputs, fake_binaries, max_jobs=len(inputs), verbose=0)
+            seconds = time.perf_counter() - start
+            # every job of every run worked in its own directory
+            run_astroref_concurrent(inputs, fake_binaries, max_jobs=len(inputs), verbose=0)
+            expected = sorted(2 * [f'job{index}' for index in range(len(inputs))]) if working_dir else []
+            assert sorted(name.split('_')[0] for name in os.listdir(tmpdir)) == expected
+        assert [sex_data for _, sex_data, _ in results] == [path.encode() for path in inputs]
+        assert all(reference == b'reference' for _, _, reference in results)
+        # the jobs ran at the same time, one after the other they take 2 * fake_runtime each
+        assert seconds < len(inputs) * fake_runtime
 
     @pytest.mark.integration  # TODO not sure if this is the right mark for network access+testdata needed
     def test_run_with_real_binaries(self):
         pass
+
+    @pytest.mark.parametrize('working_dir', [False, True])
+    def test_single_scamp(self, fake_binaries, working_dir):
+        inputs = [f'image{index}.fits' for index in range(4)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fake_binaries.working_dir = tmpdir if working_dir else ''
+            results = run_astroref_batch(inputs, fake_binaries, verbose=0)
+        assert [scamp_data for scamp_data, _, _ in results] == [f'COMMENT {path}\nEND' for path in inputs]
+        assert [sex_data for _, sex_data, _ in results] == [path.encode() for path in inputs]
+        assert all(reference == b'reference' for _, _, reference in results)
+        with open(os.path.join(os.path.dirname(fake_binaries.scamp_cmd), 'scamp.log')) as f:
+            assert f.read().splitlines() == ['sexout_0.fits sexout_1.fits sexout_2.fits sexout_3.fits']
+
+
+@pytest.mark.parametrize('single_scamp', [False, True])
+def test_do_only_astroref(fake_binaries, single_scamp):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        images = [os.path.join(tmpdir, f'in{index}.fits') for index in range(3)]
+        outputs = [os.path.join(tmpdir, f'out{index}.fits') for index in range(3)]
+        for index, image in enumerate(images):
+            CCDData(np.full((8, 8), float(index)), unit='electron').write(image)
+
+        do_only_astroref(images, outputs, fake_binaries, single_scamp=single_scamp)
+
+        for index, output in enumerate(outputs):
+            assert np.all(CCDData.read(output).data == index)
+            with open(output.replace('.fits', '_scamp.head')) as f:
+                assert f.read().startswith('COMMENT sextractorInput')
+        with open(os.path.join(os.path.dirname(fake_binaries.scamp_cmd), 'scamp.log')) as f:
+            assert len(f.read().splitlines()) == (1 if single_scamp else len(images))
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.nddata import CCDData
+from astropy.stats import SigmaClip
+from ir_reduce import skyscale
+from ir_reduce.frame_store import FrameStore
+from ir_reduce.sky import clipped_sky, running_sky, running_sky_rows
+from numpy import s_
+
+
+def make_stack(n=4, shape=(40, 30)):
+    rng = np.random.default_rng(0)
+    stack = rng.normal(1000, 20, (n,) + shape) + 100 * np.arange(n).reshape(-1, 1, 1)
+    # stars and hot pixels that need to be clipped
+    stack[:, 5:8, 5:8] += 5000
+    stack[1, 10, :] = -3000
+    stack[2, 0, :5] = np.nan
+    return stack
+
+
+@pytest.mark.parametrize('maxiters', [1, 3, 10])
+def test_same_as_sigma_clip(maxiters):
+    stack = make_stack()
+    sky_stats = clipped_sky(stack, maxiters=maxiters)
+    for frame, stats in zip(stack, sky_stats):
+        clipped = SigmaClip(sigma=3., maxiters=maxiters)(frame)
+        assert np.isclose(stats.level, np.ma.median(clipped))
+        assert np.isclose(stats.sigma, clipped.std())
+        assert np.isclose(stats.rejected, np.ma.count_masked(clipped) / frame.size)
+
+
+def test_constant_and_empty():
+    stats = clipped_sky(np.stack([np.full((3, 3), 5.), np.full((3, 3), np.nan)]))
+    assert stats[0].level == 5 and stats[0].sigma == 0 and stats[0].rejected == 0
+    assert np.isnan(stats[1].level) and stats[1].rejected == 1
+
+
+@pytest.mark.parametrize('method', ['subtract', 'divide'])
+def test_skyscale(method, pool):
+    images = [CCDData(frame, unit=u.electron) for frame in make_stack()]
+    levels = [stats.level for stats in clipped_sky(make_stack()[(slice(None),) + s_[10:30, 10:25]])]
+
+    with FrameStore.from_ccds(images) as store:
+        skyscale(store, method, pool, cut=s_[10:30, 10:25])
+        scaled = store.to_ccds()
+        for image, level in zip(scaled, levels):
+            assert np.isclose(image.header['SKYLEVEL'], level)
+        if method == 'subtract':
+            assert np.allclose(scaled[0].data[20:, 20:] + levels[0] - levels[-1], images[0].data[20:, 20:])
+        else:
+            assert np.allclose(scaled[0].data[20:, 20:] * levels[0] / levels[-1], images[0].data[20:, 20:])
+        assert scaled[0].unit == u.electron
+
+
+def naive_running_sky(data, mask, window):
+    n_frames = len(data)
+    window = min(window, n_frames - 1)
+    expected = []
+    for index in range(n_frames):
+        start = int(np.clip(index - window // 2, 0, max(0, n_frames - window - 1)))
+        neighbours = [other for other in range(start, start + window + 1) if other != index]
+        values = np.ma.masked_array(data[neighbours], mask[neighbours] | np.isnan(data[neighbours]))
+        expected.append(data[index] - np.ma.median(values, axis=0).filled(np.nan))
+    return np.array(expected)
+
+
+@pytest.mark.parametrize('window', [1, 2, 4, 5, 20])
+def test_running_sky_same_as_naive(window):
+    rng = np.random.default_rng(1)
+    data = rng.normal(1000, 20, (9, 6, 7)).round()  # rounded for plenty of ties
+    mask = rng.random(data.shape) > 0.8
+    mask[:, 0, 0] = True  # never valid
+    data[3, 2, 2] = np.nan
+
+    expected = naive_running_sky(data, mask, window)
+    running_sky_rows(data, mask, window)
+    assert np.allclose(data, expected, equal_nan=True)
+    assert mask[:, 0, 0].all()
+
+
+def test_running_skyscale(pool):
+    stack = make_stack(7)
+    images = [CCDData(frame, unit=u.electron, mask=np.zeros(frame.shape, dtype=bool)) for frame in stack]
+    images[2].mask[4:9, 4:9] = True
+    expected = naive_running_sky(stack, np.stack([image.mask for image in images]), 3)
+
+    listed = skyscale(images, 'running', pool, window=3)
+    with FrameStore.from_ccds(images) as store:
+        running_sky(store, 3, pool, block_bytes=4 * 30 * 8 * 4)  # small blocks of rows
+        for image, stored, frame in zip(listed, store.to_ccds(), expected):
+            assert np.allclose(image.data, frame, equal_nan=True)
+            assert np.allclose(stored.data, frame, equal_nan=True)
@@ -0,0 +1,158 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+from ir_reduce import Config
+from ir_reduce.ldac import read_ldac
+from ir_reduce.run_sextractor_scamp import prepare_working_dir, run_sextractor, setup_args
+from ir_reduce.source_extraction import background, extract_catalog, extract_sources, read_parameters
+
+# noinspection PyUnresolvedReferences
+from .datadir import datadir  # noqa
+
+
+def synthetic_image(shape=(512, 512), n_stars=60, n_galaxies=10, seed=1):
+    """
+    sky with a gradient and noise, gaussian stars and elongated galaxies, far enough apart not to need deblending
+    :return: image, x, y (0 based), flux and 1 for stars, 0 for galaxies of every source
+    """
+    rng = np.random.RandomState(seed)
+    rows, columns = np.indices(shape)
+    image = 1000 + 0.05 * columns + rng.normal(0, 10, shape)
+    truth = []
+    for n, sigma, elongation, fluxes in [(n_stars, 1.5, 1., (2000, 50000)), (n_galaxies, 5., 0.5, (20000, 80000))]:
+        for _ in range(n):
+            x, y = rng.uniform(40, shape[1] - 40), rng.uniform(40, shape[0] - 40)
+            while any(np.hypot(x - other[0], y - other[1]) < 25 for other in truth):
+                x, y = rng.uniform(40, shape[1] - 40), rng.uniform(40, shape[0] - 40)
+            flux = rng.uniform(*fluxes)
+            image += flux / (2 * np.pi * sigma ** 2 * elongation) * np.exp(
+                -(columns - x) ** 2 / (2 * sigma ** 2) - (rows - y) ** 2 / (2 * (sigma * elongation) ** 2))
+            truth.append((x, y, flux, elongation == 1.))
+    return image, np.array(truth)
+
+
+def match(truth: np.ndarray, x: np.ndarray, y: np.ndarray, max_distance: float = 1.):
+    """index of the closest source to every true one and whether it is closer than max_distance"""
+    distance, index = cKDTree(np.c_[x, y]).query(truth[:, :2])
+    return index, distance < max_distance
+
+
+def test_background():
+    rng = np.random.RandomState(0)
+    rows, columns = np.indices((300, 400))
+    data = 500 + 0.1 * columns + 0.05 * rows + rng.normal(0, 5, (300, 400))
+    mask = np.zeros(data.shape, bool)
+    mask[:70, :70] = True  # a fully masked mesh
+    data[mask] = 1e6
+    back, rms = background(data, mask, mesh=64)
+    error = np.abs(back - (500 + 0.1 * columns + 0.05 * rows))
+    assert np.all(error[~mask] < 10) and np.all(error[128:, 128:] < 3)
+    assert np.allclose(np.median(rms), 5, rtol=0.1)
+
+
+def test_extract_sources():
+    image, truth = synthetic_image()
+    sources = extract_sources(image, settings=dict(DETECT_THRESH=5.))
+    index, matched = match(truth, sources['XWIN_IMAGE'] - 1, sources['YWIN_IMAGE'] - 1)
+    assert matched.mean() > 0.9
+    stars, galaxies = matched & (truth[:, 3] == 1), matched & (truth[:, 3] == 0)
+
+    distance = np.hypot(sources['XWIN_IMAGE'][index] - 1 - truth[:, 0], sources['YWIN_IMAGE'][index] - 1 - truth[:, 1])
+    predicted = np.sqrt(sources['ERRX2WIN_IMAGE'][index] + sources['ERRY2WIN_IMAGE'][index])
+    assert np.median(distance[stars]) < 0.05
+    # the errors are realistic
+    assert 0.3 < np.sqrt(np.mean(distance[stars] ** 2)) / np.sqrt(np.mean(predicted[stars] ** 2)) < 3
+
+    flux_ratio = sources['FLUX_AUTO'][index] / truth[:, 2]
+    assert np.allclose(np.median(flux_ratio[stars]), 1, atol=0.03)
+    assert np.allclose(np.median(flux_ratio[galaxies]), 1, atol=0.1)
+    assert np.median(sources['CLASS_STAR'][index][stars]) > 0.8
+    assert np.median(sources['CLASS_STAR'][index][galaxies]) < 0.2
+    assert np.all(sources['MAG_AUTO'][index][matched] < 0)
+
+
+def test_extract_sources_masked():
+    image, truth = synthetic_image(n_galaxies=0)
+    mask = np.zeros(image.shape, bool)
+    mask[:, :256] = True
+    image[:, 100] = np.nan
+    sources = extract_sources(image, mask, dict(DETECT_THRESH=5.))
+    assert np.all(sources['X_IMAGE'] > 256)
+    _, matched = match(truth, sources['XWIN_IMAGE'] - 1, sources['YWIN_IMAGE'] - 1)
+    assert not np.any(matched[truth[:, 0] < 250]) and np.all(matched[truth[:, 0] > 262])
+
+    # only noise
+    noise = np.random.RandomState(0).normal(1000, 10, (200, 200))
+    assert len(extract_sources(noise, settings=dict(DETECT_THRESH=5.))['NUMBER']) == 0
+
+
+def test_extract_catalog():
+    image, truth = synthetic_image()
+    header = WCS(naxis=2).to_header()
+    header['GAIN'] = 4.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sexout.fits')
+        n_sources = extract_catalog(path, image, header, Config.default())
+        catalog_header, sources = read_ldac(path)
+        assert list(sources.names) == read_parameters(Config.default().sextractor_param)
+        assert len(sources) == n_sources and n_sources >= 0.8 * len(truth)
+        assert catalog_header['GAIN'] == 4.
+        # transient_detection reads the third hdu
+        with fits.open(path) as hdus:
+            assert len(hdus[2].data) == n_sources
+
+
+def test_unsupported_parameter():
+    with tempfile.NamedTemporaryFile('w', suffix='.param') as param:
+        param.write('NUMBER\nVIGNET(5,5)\n')
+        param.flush()
+        with pytest.raises(ValueError):
+            read_parameters(param.name)
+
+
+@pytest.mark.parametrize('as_file', [False, True])
+def test_run_sextractor_native(as_file):
+    image, truth = synthetic_image()
+    config = Config.default()
+    config.native_extractor = True
+    with tempfile.TemporaryDirectory() as working_dir, mock.patch('subprocess.run') as run:
+        input_data = CCDData(image, unit='adu')
+        if as_file:
+            input_data = os.path.join(working_dir, 'image.fits')
+            fits.writeto(input_data, image)
+        catalog = run_sextractor(input_data, config, working_dir, catalog='native.fits', verbose=0)
+        _, sources = read_ldac(os.path.join(working_dir, catalog))
+        run.assert_not_called()
+    assert len(sources) >= 0.8 * len(truth)
+
+
+@pytest.mark.integration
+@pytest.mark.skipif(shutil.which('sex') is None, reason='needs SExtractor')
+def test_compare_with_sextractor(datadir):
+    """on real data the native extractor finds the bright SExtractor sources at the same positions"""
+    image = os.path.abspath(os.path.join(datadir, 'NCAc070888.fits'))
+    config = Config.default()
+    with tempfile.TemporaryDirectory() as working_dir:
+        prepare_working_dir(config, working_dir)
+        subprocess.run(['sex', image, '-c', config.sextractor_config, *setup_args(config), '-CATALOG_NAME', 'sex.fits'],
+                       cwd=working_dir, check=True)
+        _, reference = read_ldac(os.path.join(working_dir, 'sex.fits'))
+        extract_catalog(os.path.join(working_dir, 'native.fits'), fits.getdata(image), fits.getheader(image), config)
+        _, native = read_ldac(os.path.join(working_dir, 'native.fits'))
+
+    bright = reference[(reference['FLAGS'] == 0) & (reference['MAGERR_BEST'] < 0.05)]
+    truth = np.c_[bright['XWIN_IMAGE'], bright['YWIN_IMAGE']]
+    index, matched = match(truth, native['XWIN_IMAGE'], native['YWIN_IMAGE'])
+    assert matched.mean() > 0.9
+    offsets = truth[matched] - np.c_[native['XWIN_IMAGE'], native['YWIN_IMAGE']][index[matched]]
+    assert np.median(np.hypot(*offsets.T)) < 0.1
+    assert np.allclose(np.median(native['FLUX_AUTO'][index[matched]] / bright['FLUX_AUTO'][matched]), 1, atol=0.05)
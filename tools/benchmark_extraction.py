@@ -0,0 +1,56 @@
+"""
+Compare the native source extractor with SExtractor on the test data: run time, how many of the clean SExtractor
+sources are found, centroid offsets and the FLUX_AUTO ratio. Run from the tools directory, images default to
+../testdata/NCAc*.fits, SExtractor is skipped if it is not installed.
+
+usage: python benchmark_extraction.py [image.fits ...]
+"""
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+from scipy.spatial import cKDTree
+
+from ir_reduce import Config
+from ir_reduce.ldac import read_ldac
+from ir_reduce.run_sextractor_scamp import prepare_working_dir, setup_args
+from ir_reduce.source_extraction import extract_catalog
+
+images = sys.argv[1:] or sorted(glob.glob('../testdata/NCAc*.fits'))
+config = Config.default()
+have_sex = shutil.which(config.sex_cmd) is not None
+if not have_sex:
+    print(f'{config.sex_cmd} not found, only timing the native extractor')
+
+print(f'{"image":<20} {"native s":>9} {"sex s":>7} {"native":>7} {"sex":>6} {"found":>6} {"offset":>7} {"flux":>6}')
+for image in images:
+    image = os.path.abspath(image)
+    with tempfile.TemporaryDirectory() as working_dir:
+        start = time.perf_counter()
+        extract_catalog(os.path.join(working_dir, 'native.fits'), fits.getdata(image), fits.getheader(image), config)
+        native_time = time.perf_counter() - start
+        _, native = read_ldac(os.path.join(working_dir, 'native.fits'))
+        if not have_sex:
+            print(f'{os.path.basename(image):<20} {native_time:9.2f} {"":>7} {len(native):7d}')
+            continue
+
+        start = time.perf_counter()
+        prepare_working_dir(config, working_dir)
+        subprocess.run([config.sex_cmd, image, '-c', config.sextractor_config, *setup_args(config), '-CATALOG_NAME',
+                        'sex.fits'], cwd=working_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        sex_time = time.perf_counter() - start
+        _, sex = read_ldac(os.path.join(working_dir, 'sex.fits'))
+
+    clean = sex[sex['FLAGS'] == 0]
+    distance, index = cKDTree(np.c_[native['XWIN_IMAGE'], native['YWIN_IMAGE']]).query(
+        np.c_[clean['XWIN_IMAGE'], clean['YWIN_IMAGE']])
+    found = distance < 1
+    print(f'{os.path.basename(image):<20} {native_time:9.2f} {sex_time:7.2f} {len(native):7d} {len(sex):6d} '
+          f'{found.mean():6.1%} {np.median(distance[found]):7.3f} '
+          f'{np.median(native["FLUX_AUTO"][index[found]] / clean["FLUX_AUTO"][found]):6.3f}')